@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# Benchmark of the hot paths of the pipeline on synthetic data, e.g.
+# python benchmarks/benchmark_pipeline.py --sizes 10000 1000000 --output results.json
+# The synthetic data follow the layout of the real data (ROI position files, MoBIE
+# .txt files and elastix TransformParameters files). elastix and transformix are
+# replaced by local stub executables, so no elastix installation is needed
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+REPO_PATH = os.path.abspath(__file__ + '/../..')
+sys.path.insert(0, REPO_PATH)
+
+import functions.general_functions as gf  # noqa: E402
+from functions import elastix_transform as et  # noqa: E402
+from functions.output_writers import get_output_writer  # noqa: E402
+from functions.register_2D_to_2D import register_2D_to_2D_transformix  # noqa: E402
+from functions.register_2D_to_3D import register_2D_to_3D_affine_array  # noqa: E402
+import folder_register_ARA_to_histology as fr  # noqa: E402
+
+DEFAULT_SIZES = [10000, 1000000, 10000000]
+ROI_FILE_HEADER = ('roiID, roi_size, high_res_x_pos, high_res_y_pos, '
+                   'high_res_pixel_size, registration_image_pixel_size')
+REGISTRATION_IMAGE_SIZE = (600, 400)
+
+TRANSFORMIX_STUB = '''#!{python}
+# transformix stand-in: evaluates the transformation with numpy
+import os
+import sys
+sys.path.insert(0, {repo!r})
+import numpy as np
+from functions import elastix_transform as et
+args = sys.argv[1:]
+out_dir = args[args.index('-out') + 1]
+with open(args[args.index('-def') + 1]) as f:
+    points = np.array(f.read().split()[2:], dtype='float64').reshape(-1, 2)
+chain = et.load_transform_chain(args[args.index('-tp') + 1])
+output = et.transform_points_with_chain(points, chain)
+index = et.points_to_fixed_index(output, chain[-1])
+with open(os.path.join(out_dir, 'outputpoints.txt'), 'w') as f:
+    for i in range(len(points)):
+        f.write('Point\\t{{0}}\\t; InputIndex = [ {{1}} {{2}} ]\\t; InputPoint = [ {{3:.6f}} {{4:.6f}} ]'
+                '\\t; OutputIndexFixed = [ {{5}} {{6}} ]\\t; OutputPoint = [ {{7:.6f}} {{8:.6f}} ]'
+                '\\t; Deformation = [ {{9:.6f}} {{10:.6f}} ]\\n'.format(
+                    i, int(round(points[i, 0])), int(round(points[i, 1])),
+                    points[i, 0], points[i, 1], index[i, 0], index[i, 1],
+                    output[i, 0], output[i, 1],
+                    output[i, 0] - points[i, 0], output[i, 1] - points[i, 1]))
+'''
+
+ELASTIX_STUB = '''#!{python}
+# elastix stand-in: writes fixed transformation files and an empty result image
+import os
+import shutil
+import sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('elastix stub')
+    sys.exit(0)
+out_dir = args[args.index('-out') + 1]
+for name in ['TransformParameters.0.txt', 'TransformParameters.1.txt']:
+    shutil.copy(os.path.join({templates!r}, name), out_dir)
+open(os.path.join(out_dir, 'result.1.tiff'), 'wb').close()
+'''
+
+
+def write_transform_parameters(folder, rng):
+    '''
+    writes an affine TransformParameters.0.txt and a B-spline TransformParameters.1.txt
+    like the ones of elastix with the parameters in registration_parameters
+    '''
+    width, height = REGISTRATION_IMAGE_SIZE
+    geometry = ('(FixedImageDimension 2)\n(MovingImageDimension 2)\n'
+                '(Size {} {})\n(Index 0 0)\n(Spacing 1.0000000000 1.0000000000)\n'
+                '(Origin 0.0000000000 0.0000000000)\n'
+                '(Direction 1.0000000000 0.0000000000 0.0000000000 1.0000000000)\n'
+                '(HowToCombineTransforms "Compose")\n').format(width, height)
+    affine = np.array([1, 0, 0, 1, 0, 0]) + rng.normal(0, [0.05, 0.02, 0.02, 0.05, 5, 5])
+    with open(os.path.join(folder, 'TransformParameters.0.txt'), 'w') as f:
+        f.write('(Transform "AffineTransform")\n(NumberOfParameters 6)\n')
+        f.write('(TransformParameters {})\n'.format(' '.join('{:.6f}'.format(v) for v in affine)))
+        f.write('(InitialTransformParametersFileName "NoInitialTransform")\n')
+        f.write(geometry)
+        f.write('(CenterOfRotationPoint {:.6f} {:.6f})\n'.format(width / 2, height / 2))
+
+    grid_spacing = 16.0
+    grid_size = (int(width / grid_spacing) + 4, int(height / grid_spacing) + 4)
+    coefficients = rng.normal(0, 2, 2 * grid_size[0] * grid_size[1])
+    with open(os.path.join(folder, 'TransformParameters.1.txt'), 'w') as f:
+        f.write('(Transform "BSplineTransform")\n(NumberOfParameters {})\n'.format(len(coefficients)))
+        f.write('(TransformParameters {})\n'.format(' '.join('{:.6f}'.format(v) for v in coefficients)))
+        f.write('(InitialTransformParametersFileName "./TransformParameters.0.txt")\n')
+        f.write(geometry)
+        f.write('(GridSize {} {})\n(GridIndex 0 0)\n'.format(*grid_size))
+        f.write('(GridSpacing {0} {0})\n(GridOrigin {1} {1})\n'.format(grid_spacing,
+                                                                        -1.5 * grid_spacing))
+        f.write('(GridDirection 1 0 0 1)\n(BSplineTransformSplineOrder 3)\n')
+
+
+def write_mobie_file(filepath, rng, ap_position):
+    '''
+    writes a MoBIE .txt file; the view is in line 4, as read by read_mobie_text_output
+    '''
+    rotation = np.eye(3) + rng.normal(0, 0.02, (3, 3))
+    view = np.hstack([rotation, [[rng.normal(0, 50)], [rng.normal(0, 50)], [ap_position]]])
+    with open(filepath, 'w') as f:
+        f.write('Synthetic MoBIE view\n\nnormalizedAffine:\n')
+        f.write(','.join('{:.6f}'.format(v) for v in view.ravel()) + '\n')
+
+
+def make_synthetic_dataset(root, n_cells, n_animals=2, n_images=8, n_rois=20, seed=0):
+    '''
+    creates the files of n_animals animals with n_images registered slices each, and a
+    dataframe of n_cells cells like the output of Inmuno_4channels_analysis.ipynb
+    returns: the dataframe (with the attribute datapath)
+    '''
+    rng = np.random.default_rng(seed)
+    manual_rois = []
+    for a in range(n_animals):
+        animal = 'SYN{:03d}'.format(a)
+        info_path = os.path.join(root, animal, 'ROIs', '000_ManualROIs_info')
+        registration_path = os.path.join(root, animal, 'ROIs', '000_Slices_for_ARA_registration')
+        os.makedirs(info_path)
+        os.makedirs(registration_path)
+        for i in range(n_images):
+            slide, sl = str(i // 4 + 1), str(i % 4)
+            image_name = '_'.join([animal, 'Condition', 'slide-' + slide, 'slice-' + sl])
+            outdir = os.path.join(registration_path, image_name + '_reg_output')
+            os.makedirs(outdir)
+            write_transform_parameters(outdir, rng)
+            write_mobie_file(os.path.join(registration_path, image_name + '.txt'), rng,
+                             3000 + 100 * i)
+            for side, ap in [('L', 'Tail'), ('R', 'Head')]:
+                core_name = '_'.join([image_name, 'manualROI-' + side + '-' + ap])
+                with open(os.path.join(info_path, core_name + '_roi_positions.txt'), 'w') as f:
+                    f.write(ROI_FILE_HEADER + '\n')
+                    for roi in range(1, n_rois + 1):
+                        f.write('{}, 1000, {}, {}, 0.5, 5.0\n'.format(
+                            roi, rng.integers(0, 5000), rng.integers(0, 3500)))
+                manual_rois.append([animal, 'Condition', slide, sl, side, ap, core_name])
+
+    # cells distributed over all manual rois
+    manual_rois = np.array(manual_rois, dtype=object)
+    roi_of_cell = rng.integers(0, len(manual_rois), n_cells)
+    df = pd.DataFrame(manual_rois[roi_of_cell],
+                      columns=['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice',
+                               'Side', 'AP', 'manual_roi_name'])
+    df['ROI'] = rng.integers(1, n_rois + 1, n_cells)
+    df['Center_X'] = rng.uniform(0, 1000, n_cells)
+    df['Center_Y'] = rng.uniform(0, 1000, n_cells)
+    df['cell_label'] = rng.choice(np.array(['tdTomato', 'GFP', 'double'], dtype=object), n_cells)
+    df.attrs['datapath'] = root
+
+    return df
+
+
+def write_stub_executables(root):
+    '''
+    writes the elastix and transformix stubs and a paths file pointing to them
+    returns: path to the paths file (to be used as ELASTIX_PATHS_FILE)
+    '''
+    templates = os.path.join(root, 'stub_templates')
+    os.makedirs(templates)
+    write_transform_parameters(templates, np.random.default_rng(0))
+    stubs = {'elastix': ELASTIX_STUB.format(python=sys.executable, templates=templates),
+             'transformix': TRANSFORMIX_STUB.format(python=sys.executable, repo=REPO_PATH)}
+    for name, content in stubs.items():
+        with open(os.path.join(root, name + '_stub.py'), 'w') as f:
+            f.write(content)
+        os.chmod(os.path.join(root, name + '_stub.py'), 0o755)
+    paths_file = os.path.join(root, 'paths_to_elastix_stubs.txt')
+    with open(paths_file, 'w') as f:
+        f.write('elastix_path = {}\n'.format(os.path.join(root, 'elastix_stub.py')))
+        f.write('transformix_path = {}\n'.format(os.path.join(root, 'transformix_stub.py')))
+
+    return paths_file
+
+
+def timed(function, *args, **kwargs):
+    # runs a function without printing, and returns the time it took and its output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+    return elapsed, output
+
+
+def benchmark_size(root, n_cells, stages):
+    '''
+    times the stages of the pipeline on a synthetic dataset of n_cells cells
+    returns: dictionary of stage name to seconds
+    '''
+    df = make_synthetic_dataset(os.path.join(root, 'data_{}'.format(n_cells)), n_cells)
+    data_path = df.attrs['datapath']
+    times = {}
+
+    times['reg_core_names'], reg_names = timed(gf.make_reg_core_names, df)
+    df['reg_im_corename'] = reg_names
+    times['prereg_coordinates'], df = timed(gf.get_prereg_coordinates, df, data_path)
+
+    images = []
+    for imname, positions in df.groupby('reg_im_corename', observed=True).indices.items():
+        animal_data_path = os.path.join(data_path, df.AnimalID.values[positions[0]])
+        points = np.column_stack([df.x_coord_pre.values[positions],
+                                  df.y_coord_pre.values[positions]])
+        images.append((points,
+                       gf.get_transformation_file_path(animal_data_path, imname),
+                       gf.get_mobie_file_path(animal_data_path, imname)))
+
+    if 'points_numpy' in stages:
+        times['points_numpy'], points_2d = timed(
+            lambda: [et.transform_points(points, tfile) for points, tfile, _ in images])
+    else:
+        points_2d = [points for points, _, _ in images]
+    if 'points_transformix_stub' in stages:
+        times['points_transformix_stub'], _ = timed(
+            lambda: [register_2D_to_2D_transformix(list(points[:, 0]), list(points[:, 1]), tfile)
+                     for points, tfile, _ in images])
+    times['2D_to_3D_affine'], _ = timed(
+        lambda: [register_2D_to_3D_affine_array(points, 25, mfile)
+                 for points, (_, _, mfile) in zip(points_2d, images)])
+
+    # output writers
+    df_out = df[['Center_X', 'Center_Y', 'Center_X', 'cell_label']].copy()
+    df_out.columns = ['x_coord_post', 'y_coord_post', 'z_coord_post', 'cell_label']
+    df_out['cell_index'] = df.index.values
+    for output_format in ['csv', 'parquet', 'feather', 'npy']:
+        if 'write_' + output_format not in stages:
+            continue
+        writer = get_output_writer(output_format, os.path.join(root, 'output_{}'.format(n_cells)))
+
+        def write():
+            writer.write(df_out)
+            writer.close()
+        try:
+            times['write_' + output_format], _ = timed(write)
+        except ImportError as e:
+            print('Skipping {} writer: {}'.format(output_format, e))
+
+    if 'folder_register_stub' in stages:
+        registration_path = os.path.join(data_path, df.AnimalID.values[0],
+                                         'ROIs', '000_Slices_for_ARA_registration')
+        for imname in df.reg_im_corename.cat.categories:
+            if imname.startswith(df.AnimalID.values[0]):
+                for suffix in ['.tif', '_ARA.tif']:
+                    open(os.path.join(registration_path, imname + suffix), 'wb').close()
+                shutil.rmtree(os.path.join(registration_path, imname + '_reg_output'))
+        times['folder_register_stub'], _ = timed(fr.folder_register, registration_path,
+                                                 n_workers=4)
+
+    shutil.rmtree(data_path)
+
+    return times
+
+
+if __name__ == '__main__':
+    all_stages = ['points_numpy', 'points_transformix_stub', 'write_csv', 'write_parquet',
+                  'write_feather', 'write_npy', 'folder_register_stub']
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of cells of the synthetic datasets')
+    parser.add_argument('--stages', nargs='+', default=all_stages, choices=all_stages,
+                        help='optional stages to run (core stages always run)')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='json file where the results are saved')
+    parser.add_argument('--compare', default=None,
+                        help='json file of a previous run, to print the change of each stage')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='histology_to_ara_benchmark_')
+    os.environ['ELASTIX_PATHS_FILE'] = write_stub_executables(root)
+    results = []
+    try:
+        for n_cells in args.sizes:
+            print('Benchmarking {} cells'.format(n_cells))
+            for stage, seconds in benchmark_size(root, n_cells, args.stages).items():
+                print('  {}: {:.3f} s'.format(stage, seconds))
+                results.append({'n_cells': n_cells, 'stage': stage, 'seconds': seconds})
+    finally:
+        shutil.rmtree(root)
+
+    with open(args.output, 'w') as f:
+        json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'pandas': pd.__version__,
+                   'results': results}, f, indent=2)
+    print('Results saved in {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = {(r['n_cells'], r['stage']): r['seconds'] for r in json.load(f)['results']}
+        print('Change with respect to {}:'.format(args.compare))
+        for r in results:
+            key = (r['n_cells'], r['stage'])
+            if key in previous and previous[key] > 0:
+                print('  {} cells, {}: {:.2f}x'.format(key[0], key[1], r['seconds'] / previous[key]))
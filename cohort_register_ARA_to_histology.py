@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# cohort_register_ARA_to_histology.py
+# Registers the slices of all the animals under a folder, with one pool of
+# workers for all of them. The state of each registration is kept in a SQLite
+# file, so that an interrupted run continues where it stopped.
+
+import argparse
+import cProfile
+import sys
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from folder_register_ARA_to_histology import get_registration_jobs
+from folder_register_ARA_to_histology import get_elastix_version
+from folder_register_ARA_to_histology import register_slice
+from folder_register_ARA_to_histology import get_failed_result
+from functions.general_functions import print_run_summary
+from functions import execution_backends as eb
+from functions import registration_queue as rq
+from functions import registration_metrics as rm
+from functions import instrumentation as instr
+
+REGISTRATION_FOLDER = os.path.join('ROIs', '000_Slices_for_ARA_registration')
+
+
+def cohort_register(root_path, n_workers=1, n_threads=None, dry_run=False, staging='copy',
+                    queue_path=None, priorities=None, max_attempts=2, retry_failed=False,
+                    backend=None):
+    '''
+    Registers the ARA screenshots to the histology images of every animal under a folder
+
+    param root_path: folder with one folder per animal (with ROIs/000_Slices_for_ARA_registration)
+    param n_workers: number of registrations to run at the same time
+    param n_threads: number of threads for each elastix job (elastix decides if None)
+    param dry_run: only list the registrations that would be run
+    param staging: 'copy', 'link' or 'direct' (see folder_register)
+    param queue_path: SQLite file with the state of the jobs (by default in root_path)
+    param priorities: dictionary of animal to priority (higher runs first, 0 by default)
+    param max_attempts: number of times a failing registration is run
+    param retry_failed: run again the registrations that failed in previous runs
+    param backend: how elastix is run (see execution_backends.make_backend)
+    returns: list of dictionaries with the outcome of each registration
+    '''
+    if backend is None:
+        backend = eb.get_default_backend()
+    parameters_path = os.path.abspath(__file__ + "/../registration_parameters/")
+    if queue_path is None:
+        queue_path = os.path.join(root_path, rq.QUEUE_NAME)
+    if priorities is None:
+        priorities = {}
+
+    if dry_run:
+        # only read the queue, so that the next run is not changed
+        dry_run_cohort(root_path, parameters_path, get_elastix_version(backend),
+                       rq.read_job_states(queue_path), priorities, max_attempts, retry_failed)
+        return []
+
+    # Find the slices that need to be registered in every animal
+    connection = rq.open_queue(queue_path)
+    if retry_failed:
+        rq.retry_failed_jobs(connection)
+    with instr.span('find_registration_jobs'):
+        elastix_version = get_elastix_version(backend)
+        assert elastix_version != 'unknown', \
+            'elastix can not be run, check custom_paths_to_elastix.txt or ELASTIX_PATH'
+        for folder_path in find_registration_folders(root_path):
+            animal = get_animal_name(folder_path)
+            print('Looking for registrations in {}'.format(animal))
+            jobs = get_registration_jobs(folder_path, parameters_path, elastix_version)
+            rq.add_jobs(connection, jobs, animal, priorities.get(animal, 0))
+            rq.mark_up_to_date(connection, animal, set(job['outdir_path'] for job in jobs))
+
+    print('Registration queue: {}'.format(rq.get_queue_counts(connection)))
+
+    # Perform registrations, taking the next job of the queue when a worker is free
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        running = {}
+        while True:
+            while len(running) < n_workers:
+                job = rq.claim_next_job(connection, max_attempts)
+                if job is None:
+                    break
+                future = executor.submit(register_slice, job, backend, n_threads, staging,
+                                         instr.is_tracing())
+                running[future] = job
+            if len(running) == 0:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = get_failed_result(job, e)
+                instr.merge_trace(result.pop('trace'))
+                if result['metrics'] is not None:
+                    # metrics table of the folder of the slice
+                    rm.update_metrics_table(os.path.dirname(job['outdir_path']),
+                                            [result['metrics']])
+                state = 'done' if result['error'] is None else 'failed'
+                rq.set_job_state(connection, job['outdir_path'], state, result['error'],
+                                 result['wall_time'])
+                results.append(result)
+
+    print_run_summary(results, 'registrations')
+    failed = rq.get_jobs(connection, ['failed'])
+    if len(failed) > 0:
+        print('{} registrations failed after {} attempts (use --retry-failed to run them again)'
+              .format(len(failed), max_attempts))
+    connection.close()
+
+    return results
+
+
+def dry_run_cohort(root_path, parameters_path, elastix_version, job_states, priorities,
+                   max_attempts, retry_failed):
+    '''
+    lists the registrations that a run would do, in the order of the queue
+    param job_states: state and attempts of the jobs in the queue (see read_job_states)
+    '''
+    would_run = []
+    for folder_path in find_registration_folders(root_path):
+        animal = get_animal_name(folder_path)
+        print('Looking for registrations in {}'.format(animal))
+        for job in get_registration_jobs(folder_path, parameters_path, elastix_version,
+                                         dry_run=True):
+            state, attempts = job_states.get(job['outdir_path'], ('pending', 0))
+            if state == 'done' or (state == 'failed' and retry_failed):
+                attempts = 0
+            elif state == 'failed' and attempts >= max_attempts:
+                continue
+            would_run.append((-priorities.get(animal, 0), animal, job['name'], attempts,
+                              job['reason']))
+    for priority, _, name, attempts, reason in sorted(would_run):
+        print('Would register {} (priority {}, {} attempts, {})'.format(name, -priority,
+                                                                        attempts, reason))
+
+
+def find_registration_folders(root_path):
+    '''
+    returns: sorted list of the ROIs/000_Slices_for_ARA_registration folders under root_path
+    '''
+    pattern = os.path.join(root_path, '**', REGISTRATION_FOLDER)
+
+    return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isdir(path))
+
+
+def get_animal_name(folder_path):
+    # AnimalID/ROIs/000_Slices_for_ARA_registration
+    return os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(folder_path))))
+
+
+def parse_priorities(priority_args):
+    '''
+    param priority_args: list of 'animal=priority' strings
+    returns: dictionary of animal to priority
+    '''
+    priorities = {}
+    for priority_arg in priority_args:
+        animal, _, priority = priority_arg.rpartition('=')
+        if animal == '':
+            sys.exit('Priorities must be given as animal=priority, not {}'.format(priority_arg))
+        priorities[animal] = int(priority)
+
+    return priorities
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Register the ARA screenshots to the histology images of all the animals\
+            in a folder, e.g. python cohort_register_ARA_to_histology.py path_to_cohort')
+    parser.add_argument('root_path', help='folder with one folder per animal')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of registrations to run in parallel')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of threads for each elastix job')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the registrations that would be run, without running them')
+    parser.add_argument('--staging', choices=['copy', 'link', 'direct'], default='copy',
+                        help='copy the inputs to each output folder, link them, or pass\
+                            their paths to elastix directly')
+    parser.add_argument('--queue', default=None,
+                        help='SQLite file with the state of the registrations\
+                            (default: registration_queue.sqlite in root_path)')
+    parser.add_argument('--priority', action='append', default=[],
+                        help='animal=priority, animals with higher priority are registered first\
+                            (can be repeated)')
+    parser.add_argument('--max-attempts', type=int, default=2,
+                        help='number of times a failing registration is run')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='run again the registrations that failed in previous runs')
+    parser.add_argument('--backend', choices=eb.BACKEND_NAMES, default=None,
+                        help='run the elastix executable (local, the default), the ITK-elastix\
+                            python bindings (itk) or a fake registration for tests (fake)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which an elastix run is stopped')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='number of times a failed elastix run is repeated (in the same\
+                            attempt of the queue)')
+    parser.add_argument('--trace', default=None,
+                        help='json file where the time of each stage is saved')
+    parser.add_argument('--chrome-trace', action='store_true',
+                        help='save the trace in the Chrome trace event format')
+    parser.add_argument('--profile', default=None,
+                        help='file where the cProfile statistics are saved')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        instr.enable_tracing()
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    results = cohort_register(args.root_path, n_workers=args.workers, n_threads=args.threads,
+                              dry_run=args.dry_run, staging=args.staging, queue_path=args.queue,
+                              priorities=parse_priorities(args.priority),
+                              max_attempts=args.max_attempts, retry_failed=args.retry_failed,
+                              backend=eb.set_default_backend(args.backend, args.timeout,
+                                                             args.retries))
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.trace is not None:
+        instr.write_trace(args.trace, chrome=args.chrome_trace)
+    if any(r['error'] is not None for r in results):
+        sys.exit(1)
@@ -2,78 +2,507 @@
 # Hernando M Vergara Feb 2021
 # folder_register_ARA_to_histology.py
 
+import argparse
+import cProfile
 import sys
 import os
 import glob
+import hashlib
+import json
 import shutil
-from functions.general_functions import get_elastix_paths
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functions.general_functions import print_run_summary
+from functions import execution_backends as eb
+from functions import fast_registration as fr
+from functions import registration_metrics as rm
+from functions import instrumentation as instr
 
+AFFINE_NAME = '01_ARA_affine.txt'
+BSPLINE_NAME = '02_ARA_bspline.txt'
+MANIFEST_NAME = 'registration_manifest.json'
+# log of elastix kept in the output folder when a registration fails
+FAILED_LOG_NAME = 'elastix_run.failed.log'
+# folder of the parameter files and suffix of the output folders of each profile
+REGISTRATION_PROFILES = {'default': {'parameters': 'registration_parameters',
+                                     'suffix': '_reg_output'},
+                         'fast': {'parameters': 'registration_parameters/fast',
+                                  'suffix': '_reg_output_fast'}}
+PROFILES_REPORT_NAME = 'registration_profiles_report.csv'
 
-def folder_register():
 
-    # check that it is run correctly
-    if len(sys.argv) != 2:
-        sys.exit('Wrong call, please run like this:\
-            python folder_register_ARA_to_histology.py path_to_folder')
+def folder_register(folder_path, n_workers=1, n_threads=None, dry_run=False, staging='copy',
+                    registration_profile='default', histology_pixel_size=None, backend=None):
+    '''
+    Registers the ARA screenshots to the histology images of a folder.
+    Slices are registered again when their images, the parameter files or the
+    version of elastix change (see registration_manifest.json in each output folder).
+    The quality metrics of the new registrations are added to registration_metrics.csv
 
+    param folder_path: path to the folder with the images (000_Slices_for_ARA_registration)
+    param n_workers: number of registrations to run at the same time
+    param n_threads: number of threads for each elastix job (elastix decides if None)
+    param dry_run: only list the registrations that would be run
+    param staging: how the inputs reach elastix: 'copy' them to the output folder,
+        'link' them there (hardlink, or symlink, falling back to a copy), or
+        'direct' to pass their absolute paths to elastix
+    param registration_profile: 'default', or 'fast' to register the histology downsampled
+        to the pixel size of the ARA screenshot (results in *_reg_output_fast)
+    param histology_pixel_size: pixel size (um/px) of the histology images (needed
+        by the fast profile)
+    param backend: how elastix is run (output of execution_backends.make_backend, by
+        default the local executable)
+    returns: list of dictionaries with the outcome of each registration
+    '''
     # Specify paths
-    elastix_path, _, = get_elastix_paths()
-    parameters_path = os.path.abspath(__file__ + "/../registration_parameters/")
-    affine_name = '01_ARA_affine.txt'
-    bspline_name = '02_ARA_bspline.txt'
+    if backend is None:
+        backend = eb.get_default_backend()
+    profile = REGISTRATION_PROFILES[registration_profile]
+    parameters_path = os.path.abspath(__file__ + "/../" + profile['parameters'])
+    histology_scale = None
+    if registration_profile == 'fast':
+        assert histology_pixel_size is not None, 'the fast profile needs the histology pixel size'
+        histology_scale = histology_pixel_size / fr.ARA_PIXEL_SIZE
 
-    # Get the directory as the first imput parameter
-    folder_path = sys.argv[1]
     print('Performing registrations in folder {}'.format(os.path.basename(folder_path)))
 
+    # Find the slices that need to be registered
+    with instr.span('find_registration_jobs'):
+        elastix_version = get_elastix_version(backend)
+        assert dry_run or elastix_version != 'unknown', \
+            'elastix can not be run, check custom_paths_to_elastix.txt or ELASTIX_PATH'
+        jobs = get_registration_jobs(folder_path, parameters_path, elastix_version, dry_run,
+                                     profile['suffix'], histology_scale)
+    if dry_run:
+        for job in jobs:
+            print('Would register {} ({})'.format(job['name'], job['reason']))
+        return []
+
+    # Perform registrations (a slice that raises an exception is reported as failed)
+    results = []
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(register_slice, job, backend, n_threads, staging,
+                                       instr.is_tracing()): i for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                try:
+                    results.append((futures[future], future.result()))
+                except Exception as e:
+                    results.append((futures[future], get_failed_result(jobs[futures[future]], e)))
+        results = [result for _, result in sorted(results, key=lambda r: r[0])]
+    else:
+        for job in jobs:
+            try:
+                results.append(register_slice(job, backend, n_threads, staging))
+            except Exception as e:
+                results.append(get_failed_result(job, e))
+    for result in results:
+        instr.merge_trace(result.pop('trace'))
+    metrics = [r['metrics'] for r in results if r.get('metrics') is not None]
+    if len(metrics) > 0:
+        report_outliers(rm.update_metrics_table(folder_path, metrics))
+
+    print_run_summary(results, 'registrations')
+    print('Staging ({}): {:.1f} MB copied, {:.1f} MB not copied'.format(
+        staging,
+        sum(r['bytes_copied'] for r in results) / 1e6,
+        sum(r['bytes_avoided'] for r in results) / 1e6))
+
+    return results
+
+
+def get_registration_jobs(folder_path, parameters_path, elastix_version, dry_run=False,
+                          output_suffix='_reg_output', histology_scale=None):
+    '''
+    Lists the registrations that need to be run in a folder: new slices and slices
+    whose inputs changed since they were registered.
+    Results from before manifests existed are kept, and their manifest is created
+    (unless dry_run)
+    param output_suffix: suffix of the output folder of each slice
+    param histology_scale: if given, the histology is downsampled by this factor
+        before the registration (fast profile)
+    returns: list of dictionaries with the paths needed by register_slice
+    '''
     # Parse the files
     _, histology, _ = split_files_in_registration_folder(folder_path)
 
-    # Perform registrations
-    for i in range(len(histology)):
+    jobs = []
+    for hist_path in sorted(histology):
         # get and define names
-        hist_file = os.path.basename(histology[i])
+        hist_file = os.path.basename(hist_path)
         file_base_name = hist_file.split('.tif')[0]
-        outdir = file_base_name + '_reg_output'
-        outdir_path = os.path.join(folder_path, outdir)
-        ara_file = file_base_name + '_ARA.tif'
+        outdir_path = os.path.join(folder_path, file_base_name + output_suffix)
+        ara_path = os.path.join(folder_path, file_base_name + '_ARA.tif')
 
         # check that the ARA file has been created
-        if not os.path.isfile(os.path.join(folder_path, ara_file)):
+        if not os.path.isfile(ara_path):
             print('Please generate the virtual slice for {}'.format(file_base_name))
             continue
 
-        # check if the registration has already been run
+        job = {'name': file_base_name,
+               'hist_path': hist_path,
+               'ara_path': ara_path,
+               'outdir_path': outdir_path,
+               'affine_path': os.path.join(parameters_path, AFFINE_NAME),
+               'bspline_path': os.path.join(parameters_path, BSPLINE_NAME),
+               'histology_scale': histology_scale}
+
+        # check if the registration has already been run with the same inputs
+        old_manifest = read_registration_manifest(outdir_path)
+        job['manifest'] = make_registration_manifest(job, elastix_version, old_manifest)
         if os.path.exists(os.path.join(outdir_path, 'result.1.tiff')):
-            print('Registration already run for {}, not modifying'.format(file_base_name))
+            if old_manifest is None:
+                print('Registration already run for {}, not modifying'.format(file_base_name))
+                if not dry_run:
+                    write_registration_manifest(outdir_path, job['manifest'])
+                continue
+            changed = get_changed_inputs(old_manifest, job['manifest'])
+            if len(changed) == 0:
+                print('Registration up to date for {}'.format(file_base_name))
+                continue
+            job['reason'] = 'changed: ' + ', '.join(changed)
+        else:
+            job['reason'] = 'not registered'
+
+        jobs.append(job)
+
+    return jobs
+
+
+def register_slice(job, backend, n_threads=None, staging='copy', tracing=False):
+    '''
+    Runs elastix for one slice in its output directory
+    param job: dictionary generated by get_registration_jobs
+    param backend: how elastix is run (see execution_backends.make_backend)
+    param staging: 'copy', 'link' or 'direct' (see folder_register)
+    param tracing: whether the stages are being timed (needed in worker processes)
+    returns: dictionary with the name, wall time, exit code, error, attempts, path to the
+        log of elastix (elastix_run.failed.log if it failed), bytes copied and not copied
+        to the output directory, quality metrics (None if the registration failed) and
+        trace of the job
+    '''
+    with instr.worker_trace(tracing) as trace, instr.span('register_slice', slice=job['name']):
+        result = _register_slice(job, backend, n_threads, staging)
+    result['trace'] = trace
+
+    return result
+
+
+def _register_slice(job, backend, n_threads, staging):
+    hist_file = os.path.basename(job['hist_path'])
+    ara_file = os.path.basename(job['ara_path'])
+    outdir_path = job['outdir_path']
+    print('Registering {} to {}'.format(ara_file, hist_file))
+    start = time.perf_counter()
+
+    # Run elastix in a new folder next to the output directory, which only replaces
+    # the results of a previous registration if the new one works
+    working_dir = tempfile.mkdtemp(prefix=os.path.basename(outdir_path) + '.tmp_',
+                                   dir=os.path.dirname(os.path.abspath(outdir_path)))
+    try:
+        result = _run_registration(job, backend, n_threads, staging, working_dir)
+        if result['error'] is None:
+            replace_output_folder(working_dir, outdir_path)
+            result['log_path'] = os.path.join(outdir_path, eb.LOG_NAMES['elastix'])
+        else:
+            # the results of a previous registration are kept, next to the failed log
+            result['log_path'] = eb.keep_failed_log(
+                result['log_path'], os.path.join(outdir_path, FAILED_LOG_NAME))
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+    wall_time = time.perf_counter() - start
+    result.update({'name': job['name'], 'wall_time': wall_time, 'metrics': None})
+    if result['error'] is None:
+        # the manifest is written last, so the results are not taken as up to date if
+        # the registration is interrupted before
+        write_registration_manifest(outdir_path, dict(job['manifest'], wall_time=wall_time))
+        result['metrics'] = get_slice_metrics(job, wall_time)
+
+    return result
+
+
+def _run_registration(job, backend, n_threads, staging, working_dir):
+    '''
+    runs elastix for one slice in working_dir
+    returns: dictionary with the exit code, error, attempts, path to the log, and bytes
+        copied and not copied to working_dir
+    '''
+    # Copy files to the directory and run there, otherwise elastix is shit
+    input_paths = [job['hist_path'], job['ara_path'], job['affine_path'], job['bspline_path']]
+    bytes_copied = 0
+    bytes_avoided = 0
+    if job.get('histology_scale') is not None:
+        # fast profile: register the histology downsampled to the pixel size of the ARA
+        try:
+            with instr.span('downsample_histology'):
+                downsampled_name, full_size, scales = fr.make_downsampled_histology(
+                    job['hist_path'], working_dir, job['histology_scale'])
+        except (ImportError, OSError, ValueError, AssertionError) as e:
+            return {'returncode': None,
+                    'error': 'could not downsample the histology: {}'.format(e),
+                    'attempts': 0,
+                    'log_path': None,
+                    'bytes_copied': 0,
+                    'bytes_avoided': 0}
+        input_paths = input_paths[1:]
+    with instr.span('stage_inputs', staging=staging):
+        if staging == 'direct':
+            input_names = [os.path.abspath(path) for path in input_paths]
+            bytes_avoided = sum(os.path.getsize(path) for path in input_paths)
+        else:
+            input_names = [os.path.basename(path) for path in input_paths]
+            for path in input_paths:
+                copied = stage_file(path, working_dir, link=(staging == 'link'))
+                if copied:
+                    bytes_copied += os.path.getsize(path)
+                else:
+                    bytes_avoided += os.path.getsize(path)
+    if job.get('histology_scale') is not None:
+        input_names = [downsampled_name] + input_names
+
+    # Run registration (its output is in elastix_run.log)
+    with instr.span('elastix', backend=backend['name']):
+        run = eb.run_elastix(backend, input_names[0], input_names[1], input_names[2:4],
+                             working_dir, n_threads)
+    error = run['error']
+    if error is None and not os.path.exists(os.path.join(working_dir, 'result.1.tiff')):
+        error = 'elastix did not produce result.1.tiff'
+
+    if error is None and job.get('histology_scale') is not None:
+        # map the points of the full resolution histology
+        fr.add_downsampling_to_transform(working_dir, full_size, scales)
+
+    return {'returncode': run['returncode'],
+            'error': error,
+            'attempts': run['attempts'],
+            'log_path': run['log_path'],
+            'bytes_copied': bytes_copied,
+            'bytes_avoided': bytes_avoided}
+
+
+def replace_output_folder(working_dir, outdir_path):
+    '''
+    puts the results of a registration (in working_dir) in place of the output directory
+    '''
+    if os.path.exists(outdir_path):
+        old_path = '{}.old_{}'.format(outdir_path, os.getpid())
+        os.replace(outdir_path, old_path)
+        os.replace(working_dir, outdir_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(working_dir, outdir_path)
+
+
+def get_failed_result(job, exception):
+    '''
+    returns: outcome of a registration that raised an exception (as register_slice)
+    '''
+    return {'name': job['name'],
+            'wall_time': 0,
+            'returncode': None,
+            'error': repr(exception),
+            'attempts': 0,
+            'log_path': None,
+            'bytes_copied': 0,
+            'bytes_avoided': 0,
+            'metrics': None,
+            'trace': None}
+
+
+def get_slice_metrics(job, wall_time=None):
+    '''
+    returns: row of the metrics table for a registered slice, or None if the metrics
+        could not be computed (the registration is kept anyway)
+    '''
+    try:
+        with instr.span('registration_metrics'):
+            metrics = rm.compute_registration_metrics(job['outdir_path'], job['hist_path'])
+    except (OSError, ValueError, KeyError, AssertionError) as e:
+        print('Could not compute the metrics of {}: {}'.format(job['name'], e))
+        return None
+
+    return dict(metrics, slice=job['name'], output_folder=os.path.basename(job['outdir_path']),
+                wall_time=wall_time)
+
+
+def folder_metrics(folder_path, registration_profile='default'):
+    '''
+    Computes the quality metrics of the slices of a folder that are already registered
+    and saves them in registration_metrics.csv
+    returns: the metrics table of the folder
+    '''
+    suffix = REGISTRATION_PROFILES[registration_profile]['suffix']
+    _, histology, _ = split_files_in_registration_folder(folder_path)
+    rows = []
+    for hist_path in sorted(histology):
+        file_base_name = os.path.basename(hist_path).split('.tif')[0]
+        outdir_path = os.path.join(folder_path, file_base_name + suffix)
+        if not os.path.isfile(os.path.join(outdir_path, 'TransformParameters.1.txt')):
+            continue
+        manifest = read_registration_manifest(outdir_path)
+        row = get_slice_metrics({'name': file_base_name, 'hist_path': hist_path,
+                                 'outdir_path': outdir_path},
+                                None if manifest is None else manifest.get('wall_time'))
+        if row is not None:
+            rows.append(row)
+    if len(rows) == 0:
+        print('No registered slices in {}'.format(folder_path))
+        return None
+    table = rm.update_metrics_table(folder_path, rows)
+    report_outliers(table)
+
+    return table
+
+
+def report_outliers(table):
+    outliers = table[table.outlier]
+    print('Registration metrics: {} of {} slices flagged as outliers'.format(
+        len(outliers), len(table)))
+    if len(outliers) > 0:
+        print(outliers[['slice', 'output_folder', 'mutual_information', 'ncc',
+                        'jacobian_negative_fraction']].to_string(index=False))
+
+
+def compare_registration_profiles(folder_path):
+    '''
+    Compares the registrations of the fast profile with those of the default profile,
+    for the slices of a folder registered with both, and saves the report in
+    registration_profiles_report.csv
+    returns: dataframe with the distance between the points mapped by both registrations
+        and the time of each registration (if it is in the manifests)
+    '''
+    _, histology, _ = split_files_in_registration_folder(folder_path)
+    slices = []
+    for hist_path in sorted(histology):
+        file_base_name = os.path.basename(hist_path).split('.tif')[0]
+        outdir_paths = [os.path.join(folder_path,
+                                     file_base_name + REGISTRATION_PROFILES[profile]['suffix'])
+                        for profile in ['fast', 'default']]
+        if not all(os.path.isfile(os.path.join(path, 'TransformParameters.1.txt'))
+                   for path in outdir_paths):
+            continue
+        wall_times = []
+        for path in outdir_paths:
+            manifest = read_registration_manifest(path)
+            wall_times.append(None if manifest is None else manifest.get('wall_time'))
+        slices.append((file_base_name, outdir_paths[0], outdir_paths[1]) + tuple(wall_times))
+
+    report_path = os.path.join(folder_path, PROFILES_REPORT_NAME)
+    report = fr.make_profiles_report(slices, report_path)
+    print('Compared {} slices registered with both profiles, report saved in {}'.format(
+        len(report), report_path))
+    if len(report) > 0:
+        print(report[['slice', 'default_seconds', 'fast_seconds',
+                      'mean_distance_um', 'max_distance_um']].to_string(index=False))
+
+    return report
+
+
+def stage_file(path, outdir_path, link=False):
+    '''
+    puts a file in the output directory, as a hardlink or symlink if link is True
+    and the filesystem allows it, or as a copy
+    returns: True if the file was copied
+    '''
+    staged_path = os.path.join(outdir_path, os.path.basename(path))
+    if os.path.lexists(staged_path):
+        os.remove(staged_path)
+    if link:
+        try:
+            os.link(path, staged_path)
+            return False
+        except OSError:
+            pass
+        try:
+            os.symlink(os.path.abspath(path), staged_path)
+            return False
+        except OSError:
+            pass
+    shutil.copy(path, staged_path)
+
+    return True
+
+
+def get_elastix_version(backend):
+    '''
+    returns the version of elastix of a backend (for the local backend, the output of
+    elastix --version), or 'unknown' if elastix can not be run
+    '''
+    return eb.get_backend_version(backend)
+
+
+def make_registration_manifest(job, elastix_version, old_manifest=None):
+    '''
+    describes the inputs of a registration: size, modification time and sha256 of the
+    images and parameter files, the elastix version and the downsampling of the
+    histology (fast profile).
+    Hashes of old_manifest are reused for files whose size and modification time
+    have not changed
+    '''
+    manifest = {'elastix_version': elastix_version}
+    if job.get('histology_scale') is not None:
+        manifest['histology_scale'] = job['histology_scale']
+    for name, key in [('fixed_image', 'hist_path'),
+                      ('moving_image', 'ara_path'),
+                      ('affine_parameters', 'affine_path'),
+                      ('bspline_parameters', 'bspline_path')]:
+        file_stat = os.stat(job[key])
+        entry = {'file': os.path.basename(job[key]),
+                 'size': file_stat.st_size,
+                 'mtime_ns': file_stat.st_mtime_ns}
+        old_entry = None if old_manifest is None else old_manifest.get(name)
+        if old_entry is not None and all(old_entry.get(k) == entry[k] for k in entry):
+            entry['sha256'] = old_entry['sha256']
+        else:
+            entry['sha256'] = get_file_hash(job[key])
+        manifest[name] = entry
+
+    return manifest
+
+
+def get_changed_inputs(old_manifest, new_manifest):
+    '''
+    returns the names of the inputs that differ between two manifests
+    '''
+    changed = []
+    for name, entry in new_manifest.items():
+        old_entry = old_manifest.get(name)
+        if name == 'elastix_version' and 'unknown' in [entry, old_entry]:
+            # elastix could not be run, which does not mean that its version changed
             continue
+        if not isinstance(entry, dict):
+            if old_entry != entry:
+                changed.append(name)
+        elif old_entry is None or old_entry.get('sha256') != entry['sha256']:
+            changed.append(name)
+
+    return changed
 
-        print('Registering {} to {}'.format(ara_file,
-                                            hist_file))
 
-        # Create output directory
-        if not os.path.exists(outdir_path):
-            os.makedirs(outdir_path)
+def get_file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
 
-        # Copy files to the directory and move there for the registration
-        os.chdir(outdir_path)
-        shutil.copy(os.path.join(parameters_path, affine_name), './')
-        shutil.copy(os.path.join(parameters_path, bspline_name), './')
-        shutil.copy(histology[i], './')
-        shutil.copy(os.path.join(folder_path, ara_file), './')
+    return sha.hexdigest()
 
-        # Run registration
-        regist_command = '{0} -f {1} -m {2} -p {3} -p {4} -out {5} > /dev/null'.format(
-            elastix_path,
-            hist_file,
-            ara_file,
-            affine_name,
-            bspline_name,
-            './')
 
-        os.system(regist_command)
+def read_registration_manifest(outdir_path):
+    manifest_path = os.path.join(outdir_path, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
 
-    print('Done')
+
+def write_registration_manifest(outdir_path, manifest):
+    if not os.path.exists(outdir_path):
+        os.makedirs(outdir_path)
+    with open(os.path.join(outdir_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
 
 
 def split_files_in_registration_folder(path):
@@ -88,4 +517,70 @@ def split_files_in_registration_folder(path):
 
 
 if __name__ == '__main__':
-    folder_register()
+    parser = argparse.ArgumentParser(
+        description='Register the ARA screenshots to the histology images of a folder, e.g.\
+            python folder_register_ARA_to_histology.py path_to_folder')
+    parser.add_argument('folder_path', help='path to 000_Slices_for_ARA_registration')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of registrations to run in parallel')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of threads for each elastix job')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the registrations that would be run, without running them')
+    parser.add_argument('--staging', choices=['copy', 'link', 'direct'], default='copy',
+                        help='copy the inputs to each output folder, link them, or pass\
+                            their paths to elastix directly')
+    parser.add_argument('--registration-profile', choices=list(REGISTRATION_PROFILES),
+                        default='default',
+                        help='fast registers the histology downsampled to the pixel size of the\
+                            ARA screenshot, in *_reg_output_fast folders')
+    parser.add_argument('--histology-pixel-size', type=float, default=None,
+                        help='pixel size (um/px) of the histology images, for the fast profile')
+    parser.add_argument('--compare-profiles', action='store_true',
+                        help='compare the registrations of the fast and default profiles\
+                            (after registering)')
+    parser.add_argument('--backend', choices=eb.BACKEND_NAMES, default=None,
+                        help='run the elastix executable (local, the default), the ITK-elastix\
+                            python bindings (itk) or a fake registration for tests (fake)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which an elastix run is stopped')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='number of times a failed elastix run is repeated')
+    parser.add_argument('--metrics-only', action='store_true',
+                        help='only compute the quality metrics of the registered slices\
+                            (saved in registration_metrics.csv)')
+    parser.add_argument('--trace', default=None,
+                        help='json file where the time of each stage is saved')
+    parser.add_argument('--chrome-trace', action='store_true',
+                        help='save the trace in the Chrome trace event format')
+    parser.add_argument('--profile', default=None,
+                        help='file where the cProfile statistics are saved')
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        instr.enable_tracing()
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    if args.metrics_only:
+        folder_metrics(args.folder_path, args.registration_profile)
+        results = []
+    else:
+        results = folder_register(args.folder_path, n_workers=args.workers,
+                                  n_threads=args.threads, dry_run=args.dry_run,
+                                  staging=args.staging,
+                                  registration_profile=args.registration_profile,
+                                  histology_pixel_size=args.histology_pixel_size,
+                                  backend=eb.set_default_backend(args.backend, args.timeout,
+                                                                 args.retries))
+    if args.compare_profiles:
+        compare_registration_profiles(args.folder_path)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.trace is not None:
+        instr.write_trace(args.trace, chrome=args.chrome_trace)
+    if any(r['error'] is not None for r in results):
+        sys.exit(1)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# Brain region of the cells transformed to the ARA: the annotation volume (.npy, or .nrrd
+# with raw encoding) is memory-mapped, and the region of the voxel closest to each cell
+# is read in slabs of the volume, so only the parts of the file with cells are loaded.
+# Regions can be rolled up to a level of the hierarchy with a structure table
+# (.csv with the columns id, acronym and structure_id_path or parent_structure_id).
+
+import numpy as np
+
+# planes of the volume (along its slowest axis in the file) read at the same time
+ANNOTATION_SLAB_SIZE = 16
+NRRD_TYPES = {'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+              'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+              'ushort': 'u2', 'unsigned short': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+              'short': 'i2', 'signed short': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+              'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+              'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+              'ulonglong': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+              'longlong': 'i8', 'long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+              'float': 'f4', 'double': 'f8'}
+
+
+def open_annotation_volume(filepath):
+    '''
+    memory-maps an annotation volume
+    param filepath: .npy file (indexed [x, y, z], as given by pynrrd or the allensdk) or
+        .nrrd file with raw encoding (x is its fastest axis)
+    returns: dictionary with the memory-mapped array as stored in the file (C order) and
+        the coordinate (0: x, 1: y, 2: z) that indexes each of its axes
+    '''
+    if filepath.endswith('.npy'):
+        volume = np.load(filepath, mmap_mode='r')
+        axes = (0, 1, 2)
+        if volume.flags.f_contiguous and not volume.flags.c_contiguous:
+            volume, axes = volume.T, (2, 1, 0)
+    elif filepath.endswith('.nrrd'):
+        header, data_offset = read_nrrd_header(filepath)
+        if header.get('encoding', 'raw') != 'raw':
+            raise ValueError('{} is {}-encoded and can not be memory-mapped, save it with raw '
+                             'encoding or as .npy'.format(filepath, header['encoding']))
+        if 'data file' in header or 'datafile' in header:
+            raise ValueError('NRRD files with detached data are not supported')
+        dtype = np.dtype(NRRD_TYPES[header['type']])
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+        sizes = [int(s) for s in header['sizes'].split()]
+        assert len(sizes) == 3, 'the annotation volume must be 3D'
+        volume = np.memmap(filepath, dtype=dtype, mode='r', offset=data_offset,
+                           shape=tuple(reversed(sizes)))
+        axes = (2, 1, 0)
+    else:
+        raise ValueError('Annotation volume {} must be .npy or .nrrd'.format(filepath))
+
+    return {'volume': volume, 'axes': axes}
+
+
+def read_nrrd_header(filepath):
+    '''
+    returns: dictionary of the fields of the header of a NRRD file, and the position
+        where the data starts
+    '''
+    header = {}
+    with open(filepath, 'rb') as f:
+        magic = f.readline()
+        assert magic.startswith(b'NRRD'), '{} is not a NRRD file'.format(filepath)
+        for line in iter(f.readline, b''):
+            line = line.decode('latin1').rstrip('\r\n')
+            if line == '':
+                break
+            if line.startswith('#') or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            header[key.strip().lower()] = value.lstrip('=').strip()
+        data_offset = f.tell()
+
+    return header, data_offset
+
+
+def get_nearest_voxels(coords, shape):
+    '''
+    param coords: Nx3 array of x, y, z coordinates (in pixels of the volume)
+    param shape: size of the volume along x, y and z
+    returns: Nx3 array of indexes of the closest voxels, and a boolean array of the
+        points inside the volume
+    '''
+    voxels = np.floor(np.asarray(coords, dtype='float64') + 0.5)
+    inside = np.all((voxels >= 0) & (voxels < np.asarray(shape)), axis=1)
+    voxels[~inside] = 0
+
+    return voxels.astype('int64'), inside
+
+
+def lookup_annotation(annotation, coords, slab_size=ANNOTATION_SLAB_SIZE):
+    '''
+    Region id of the closest voxel of each point (0 for points outside the volume or
+    with nan coordinates)
+    param annotation: output of open_annotation_volume
+    param coords: Nx3 array of x, y, z coordinates (in pixels of the volume, e.g. the
+        x_coord_post, y_coord_post and z_coord_post of points_to_ARA)
+    param slab_size: number of planes of the volume read at the same time
+    returns: array of region ids
+    '''
+    volume, axes = annotation['volume'], annotation['axes']
+    shape = [0, 0, 0]
+    for axis, coordinate in enumerate(axes):
+        shape[coordinate] = volume.shape[axis]
+    coords = np.asarray(coords, dtype='float64').reshape(-1, 3)
+    valid = ~np.any(np.isnan(coords), axis=1)
+    voxels, inside = get_nearest_voxels(np.where(valid[:, None], coords, -1), shape)
+    # index of each point in the axes of the array
+    index = voxels[:, list(axes)]
+
+    ids = np.zeros(len(coords), dtype=volume.dtype)
+    positions = np.flatnonzero(inside)
+    # read the slabs of the slowest axis that have points, in order
+    slabs = index[positions, 0] // slab_size
+    order = np.argsort(slabs, kind='stable')
+    positions, slabs = positions[order], slabs[order]
+    starts = np.flatnonzero(np.diff(slabs, prepend=-1))
+    ends = np.append(starts[1:], len(positions))
+    for start, end in zip(starts, ends):
+        slab_positions = positions[start:end]
+        first_plane = slabs[start] * slab_size
+        slab = np.asarray(volume[first_plane:first_plane + slab_size])
+        slab_index = index[slab_positions]
+        ids[slab_positions] = slab[slab_index[:, 0] - first_plane, slab_index[:, 1],
+                                   slab_index[:, 2]]
+
+    return ids
+
+
+def read_structure_table(filepath):
+    '''
+    reads a table of brain structures (e.g. structures.csv of the Allen atlas)
+    returns: dictionary with the arrays id, acronym and path (list of ids from the root
+        to each structure)
+    '''
+    import pandas as pd
+    structures = pd.read_csv(filepath)
+    ids = structures['id'].values.astype('int64')
+    if 'structure_id_path' in structures.columns:
+        paths = [[int(s) for s in str(path).strip('/').split('/') if s != '']
+                 for path in structures['structure_id_path'].values]
+    else:
+        # build the paths from the parent of each structure
+        parents = dict(zip(ids, structures['parent_structure_id'].values))
+        paths = []
+        for structure_id in ids:
+            path = [int(structure_id)]
+            while not pd.isna(parents.get(path[0], np.nan)):
+                path.insert(0, int(parents[path[0]]))
+            paths.append(path)
+
+    return {'id': ids,
+            'acronym': structures['acronym'].values.astype(str),
+            'path': paths}
+
+
+def get_region_acronyms(ids, structures, outside_name='outside'):
+    '''
+    returns: array with the acronym of each region id (outside_name for 0 or unknown ids)
+    '''
+    names = dict(zip(structures['id'].tolist(), structures['acronym'].tolist()))
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    acronyms = np.array([names.get(int(i), outside_name) for i in unique_ids] + [outside_name])
+
+    return acronyms[inverse.ravel()]
+
+
+def rollup_regions(ids, structures, depth):
+    '''
+    param ids: array of region ids
+    param depth: level of the hierarchy (0 is the root), regions above it are kept
+    returns: array with the ancestor of each region at that depth (0 for unknown ids)
+    '''
+    ancestors = {structure_id: (path[depth] if len(path) > depth else structure_id)
+                 for structure_id, path in zip(structures['id'].tolist(), structures['path'])}
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    rolled = np.array([ancestors.get(int(i), 0) for i in unique_ids] + [0], dtype='int64')
+
+    return rolled[inverse.ravel()]
+
+
+def annotate_cells(df, annotation, structures=None, rollup_depths=()):
+    '''
+    adds the region of each cell to a dataframe with the ARA coordinates
+    (x_coord_post, y_coord_post, z_coord_post)
+    param annotation: output of open_annotation_volume
+    param structures: output of read_structure_table, to add the acronyms and roll-ups
+    param rollup_depths: levels of the hierarchy of the roll-ups
+    returns: the dataframe with the columns region_id (and region_acronym,
+        region_id_depth_N and region_acronym_depth_N if structures is given)
+    '''
+    coords = df[['x_coord_post', 'y_coord_post', 'z_coord_post']].values
+    ids = lookup_annotation(annotation, coords).astype('int64')
+    columns = {'region_id': ids}
+    if structures is not None:
+        columns['region_acronym'] = get_region_acronyms(ids, structures)
+        for depth in rollup_depths:
+            rolled = rollup_regions(ids, structures, depth)
+            columns['region_id_depth_{}'.format(depth)] = rolled
+            columns['region_acronym_depth_{}'.format(depth)] = get_region_acronyms(rolled,
+                                                                                   structures)
+
+    return df.assign(**columns)
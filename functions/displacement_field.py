@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# Dense displacement field of a registered slice: the elastix transformation is evaluated
+# once on every pixel of the fixed image (histology) and saved as a .npy file next to
+# TransformParameters.1.txt, so that later point queries are a bilinear interpolation.
+# The field is made again when any file of the chain of transformations changes.
+
+import sys
+import os
+import json
+import threading
+import numpy as np
+from functions import elastix_transform as et
+from functions import instrumentation as instr
+from functions.transform_functions import read_elastix_parameters
+
+# rows of the fixed image evaluated at the same time when making the field
+FIELD_ROWS_PER_CHUNK = 256
+# random points used to measure the error of the interpolation against exact evaluation
+FIELD_ACCURACY_SAMPLES = 10000
+# maximum error (in pixels) of the field; slices with a larger error are evaluated exactly
+FIELD_TOLERANCE = 0.1
+# type of the saved displacements (float32 is precise to much less than a pixel)
+FIELD_DTYPE = 'float32'
+
+
+def get_field_paths(transformation_file):
+    '''
+    returns: paths to the .npy file of the field and the .json file with its information
+    '''
+    base_path = os.path.splitext(os.path.abspath(transformation_file))[0]
+
+    return base_path + '_field.npy', base_path + '_field.json'
+
+
+def get_chain_paths(transformation_file):
+    '''
+    returns: paths of all the files of the chain of transformations
+    '''
+    chain_paths = []
+    path = transformation_file
+    while path is not None:
+        chain_paths.insert(0, os.path.abspath(path))
+        path = et.get_initial_transform_path(read_elastix_parameters(path), path)
+
+    return chain_paths
+
+
+def _get_sources(chain_paths):
+    # modification time and size of the files the field was made from
+    return [[path, os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in chain_paths]
+
+
+def _index_to_points(cindex, parameters):
+    # continuous index of the fixed image to physical points
+    ndim = cindex.shape[1]
+    spacing = et._get_array(parameters, 'Spacing', np.ones(ndim))
+    origin = et._get_array(parameters, 'Origin', np.zeros(ndim))
+    direction = et._get_array(parameters, 'Direction', np.eye(ndim).ravel()).reshape(ndim, ndim).T
+
+    return cindex @ (direction * spacing).T + origin
+
+
+def _points_to_index(points, parameters):
+    # physical points to continuous index of the fixed image
+    ndim = points.shape[1]
+    spacing = et._get_array(parameters, 'Spacing', np.ones(ndim))
+    origin = et._get_array(parameters, 'Origin', np.zeros(ndim))
+    direction = et._get_array(parameters, 'Direction', np.eye(ndim).ravel()).reshape(ndim, ndim).T
+
+    return np.linalg.solve(direction * spacing, (points - origin).T).T
+
+
+def make_displacement_field(transformation_file, read_parameters=et.read_elastix_parameter_file):
+    '''
+    Evaluates the transformation on every pixel of the fixed image and saves the
+    displacements (Size[1] x Size[0] x 2, FIELD_DTYPE) next to the transformation file
+    param transformation_file: path to the output of elastix (TransformParameters.1.txt)
+    param read_parameters: function used to read each file (e.g. a cached reader)
+    returns: information of the field (size, sources and accuracy)
+    '''
+    field_path, info_path = get_field_paths(transformation_file)
+    chain_paths = get_chain_paths(transformation_file)
+    chain = et.load_transform_chain(transformation_file, read_parameters)
+    size = et._get_array(chain[-1], 'Size').astype(int)
+    sources = _get_sources(chain_paths)
+
+    # write to a temporary file, so that other processes or threads never read half a field
+    tmp_name = '{}.{}'.format(os.getpid(), threading.get_ident())
+    tmp_path = '{}.{}.tmp.npy'.format(os.path.splitext(field_path)[0], tmp_name)
+    with instr.span('make_displacement_field', pixels=int(size[0] * size[1])):
+        field = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=FIELD_DTYPE,
+                                          shape=(int(size[1]), int(size[0]), 2))
+        xs = np.arange(size[0], dtype='float64')
+        for row in range(0, size[1], FIELD_ROWS_PER_CHUNK):
+            rows = np.arange(row, min(row + FIELD_ROWS_PER_CHUNK, size[1]), dtype='float64')
+            cindex = np.column_stack([np.tile(xs, len(rows)), np.repeat(rows, size[0])])
+            points = _index_to_points(cindex, chain[-1])
+            displacement = et.transform_points_with_chain(points, chain) - points
+            field[row:row + len(rows)] = displacement.reshape(len(rows), size[0], 2)
+        field.flush()
+        del field
+        os.replace(tmp_path, field_path)
+
+    info = {'size': size.tolist(), 'sources': sources}
+    info.update(get_field_accuracy(transformation_file, chain=chain,
+                                   field=np.load(field_path, mmap_mode='r')))
+    tmp_path = '{}.{}.tmp'.format(info_path, tmp_name)
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f, indent=1)
+    os.replace(tmp_path, info_path)
+
+    return info
+
+
+def load_displacement_field(transformation_file, read_parameters=et.read_elastix_parameter_file):
+    '''
+    param transformation_file: path to the output of elastix (TransformParameters.1.txt)
+    returns: memory-mapped field and its information. The field is made if it does not
+        exist or if the transformation files changed since it was made
+    '''
+    field_path, info_path = get_field_paths(transformation_file)
+    info = None
+    if os.path.isfile(field_path) and os.path.isfile(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        if info['sources'] != _get_sources(get_chain_paths(transformation_file)):
+            print('Transformation changed, making the displacement field again')
+            info = None
+    if info is None:
+        info = make_displacement_field(transformation_file, read_parameters)
+    instr.count('files_read')
+
+    return np.load(field_path, mmap_mode='r'), info
+
+
+def interpolate_displacement_field(field, points, parameters):
+    '''
+    Bilinear interpolation of the displacement field
+    param field: field from load_displacement_field
+    param points: Nx2 array of x, y positions of the fixed image
+    param parameters: parameters of the last transformation of the chain (fixed image geometry)
+    returns: Nx2 array of transformed points, and a boolean array of the points outside
+        the field (their transformed points are nan)
+    '''
+    cindex = _points_to_index(points, parameters)
+    height, width = field.shape[:2]
+    outside = ((cindex[:, 0] < 0) | (cindex[:, 0] > width - 1) |
+               (cindex[:, 1] < 0) | (cindex[:, 1] > height - 1))
+    cindex = cindex[~outside]
+    x0 = np.minimum(np.floor(cindex[:, 0]).astype(int), max(width - 2, 0))
+    y0 = np.minimum(np.floor(cindex[:, 1]).astype(int), max(height - 2, 0))
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    wx = (cindex[:, 0] - x0)[:, None]
+    wy = (cindex[:, 1] - y0)[:, None]
+    displacement = ((1 - wy) * ((1 - wx) * field[y0, x0] + wx * field[y0, x1]) +
+                    wy * ((1 - wx) * field[y1, x0] + wx * field[y1, x1]))
+
+    transformed = np.full(points.shape, np.nan)
+    transformed[~outside] = points[~outside] + displacement
+
+    return transformed, outside
+
+
+def transform_points_with_field(points, transformation_file, tolerance=FIELD_TOLERANCE,
+                                read_parameters=et.read_elastix_parameter_file):
+    '''
+    Same as elastix_transform.transform_points, using the displacement field of the slice.
+    Points outside of the field, and all the points of slices where the error of the
+    field is larger than the tolerance, are evaluated exactly
+    param tolerance: maximum error (in pixels) of the field, None (or 0) to always use exact
+        evaluation, without making the field
+    returns: Nx2 array of x, y positions (in pixels) in the moving image (ARA slice), and
+        the parameters of the last transformation of the chain
+    '''
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    chain = et.load_transform_chain(transformation_file, read_parameters)
+    if tolerance is None or tolerance <= 0:
+        return et.transform_points_with_chain(points, chain), chain[-1]
+
+    field, info = load_displacement_field(transformation_file, read_parameters)
+    if info['max_error'] > tolerance:
+        print('Displacement field error of {:.3g} pixels, evaluating {} exactly'.format(
+            info['max_error'], transformation_file))
+        return et.transform_points_with_chain(points, chain), chain[-1]
+
+    with instr.span('interpolate_displacement_field', points=len(points)):
+        transformed, outside = interpolate_displacement_field(field, points, chain[-1])
+    if np.any(outside):
+        transformed[outside] = et.transform_points_with_chain(points[outside], chain)
+
+    return transformed, chain[-1]
+
+
+def get_field_accuracy(transformation_file, chain=None, field=None, points=None):
+    '''
+    compares the interpolation of the field with the exact evaluation of the transformation
+    param points: Nx2 array of points of the fixed image (by default random sub-pixel positions)
+    returns: dictionary with the maximum and mean distance (in pixels) between both, and
+        the number of points rounded to a different pixel
+    '''
+    if chain is None:
+        chain = et.load_transform_chain(transformation_file)
+    if field is None:
+        field, _ = load_displacement_field(transformation_file)
+    if points is None:
+        height, width = field.shape[:2]
+        rng = np.random.default_rng(0)
+        cindex = rng.uniform([0, 0], [width - 1, height - 1], size=(FIELD_ACCURACY_SAMPLES, 2))
+        points = _index_to_points(cindex, chain[-1])
+
+    interpolated, outside = interpolate_displacement_field(field, points, chain[-1])
+    exact = et.transform_points_with_chain(points[~outside], chain)
+    interpolated = interpolated[~outside]
+    distance = np.linalg.norm(interpolated - exact, axis=1)
+    n_different = np.sum(np.any(et.points_to_fixed_index(interpolated, chain[-1]) !=
+                                et.points_to_fixed_index(exact, chain[-1]), axis=1))
+
+    return {'max_error': float(np.max(distance, initial=0)),
+            'mean_error': float(np.mean(distance)) if len(distance) > 0 else 0.0,
+            'n_index_different': int(n_different),
+            'n_points': int(len(distance))}
+
+
+if __name__ == '__main__':
+    # check input
+    if len(sys.argv) not in [2, 3]:
+        sys.exit('Arguments missing, please run like this:\
+            python -m functions.displacement_field TransformParameters.1.txt optional:outputpoints.txt')
+    transformation_file = sys.argv[1]
+    field, info = load_displacement_field(transformation_file)
+    print('Displacement field of {} x {} pixels'.format(*info['size']))
+    print('Maximum error against exact evaluation: {} pixels'.format(info['max_error']))
+    print('Points rounded to a different pixel: {} of {}'.format(info['n_index_different'],
+                                                                  info['n_points']))
+    if len(sys.argv) == 3:
+        # compare with a previous transformix run
+        input_points = et.read_transformix_output_points(sys.argv[2], 'InputPoint')
+        output_points, parameters = transform_points_with_field(input_points, transformation_file,
+                                                                tolerance=np.inf)
+        reference_points = et.read_transformix_output_points(sys.argv[2], 'OutputPoint')
+        reference_index = et.read_transformix_output_points(sys.argv[2], 'OutputIndexFixed')
+        output_index = et.points_to_fixed_index(output_points, parameters)
+        print('Maximum distance to transformix output: {} pixels'.format(
+            np.max(np.linalg.norm(output_points - reference_points, axis=1), initial=0)))
+        print('Points rounded to a different pixel than transformix: {}'.format(
+            int(np.sum(np.any(output_index != reference_index, axis=1)))))
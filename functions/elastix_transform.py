@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# Evaluates 2D elastix transformations (TransformParameters.X.txt files) with numpy,
+# so that points can be mapped without launching transformix
+
+import sys
+import os
+import re
+import numpy as np
+
+_token_regex = re.compile(r'"[^"]*"|[^\s"]+')
+
+
+def read_elastix_parameter_file(filepath):
+    '''
+    param filepath: path to an elastix parameter file (e.g. TransformParameters.1.txt)
+    returns: dictionary of parameter name to list of values (floats or strings)
+    '''
+    parameters = {}
+    with open(filepath) as f:
+        for line in f:
+            line = line.split('//')[0].strip()
+            if not line.startswith('(') or not line.endswith(')'):
+                continue
+            tokens = _token_regex.findall(line[1:-1])
+            values = []
+            for token in tokens[1:]:
+                if token.startswith('"'):
+                    values.append(token.strip('"'))
+                else:
+                    try:
+                        values.append(float(token))
+                    except ValueError:
+                        values.append(token)
+            parameters[tokens[0]] = values
+
+    return parameters
+
+
+def get_initial_transform_path(parameters, transformation_file):
+    '''
+    returns the path to the initial transformation of a parameter file, or None.
+    Relative paths are relative to the folder of the transformation file
+    (elastix is run from the output folder)
+    '''
+    initial = parameters.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+    if initial == 'NoInitialTransform':
+        return None
+    working_dir = os.path.dirname(os.path.abspath(transformation_file))
+    initial_path = os.path.join(working_dir, initial)
+    if not os.path.isfile(initial_path):
+        # absolute paths written by another system (e.g. windows elastix)
+        initial_path = os.path.join(working_dir, re.split(r'[\\/]', initial)[-1])
+    assert os.path.isfile(initial_path), 'initial transform {} not found'.format(initial)
+
+    return initial_path
+
+
+def load_transform_chain(transformation_file, read_parameters=read_elastix_parameter_file):
+    '''
+    param transformation_file: path to the last file of the chain (TransformParameters.1.txt)
+    param read_parameters: function used to read each file (e.g. a cached reader)
+    returns: list of parameter dictionaries, from the first transform applied to the last
+    '''
+    chain = []
+    path = transformation_file
+    while path is not None:
+        parameters = read_parameters(path)
+        chain.insert(0, parameters)
+        path = get_initial_transform_path(parameters, path)
+
+    return chain
+
+
+def _get_array(parameters, name, default=None):
+    if name not in parameters:
+        return np.asarray(default, dtype='float64')
+    return np.asarray(parameters[name], dtype='float64')
+
+
+def _cubic_bspline_kernel(x):
+    x = np.abs(x)
+    return np.where(x < 1,
+                    (4 - 6 * x ** 2 + 3 * x ** 3) / 6,
+                    np.where(x < 2, (2 - x) ** 3 / 6, 0))
+
+
+def apply_affine_transform(points, parameters):
+    '''
+    x' = A (x - c) + c + t, A and t from TransformParameters, c the CenterOfRotationPoint
+    '''
+    ndim = points.shape[1]
+    trafo = _get_array(parameters, 'TransformParameters')
+    if parameters['Transform'][0] == 'TranslationTransform':
+        return points + trafo
+    matrix = trafo[:ndim * ndim].reshape(ndim, ndim)
+    translation = trafo[ndim * ndim:]
+    center = _get_array(parameters, 'CenterOfRotationPoint', np.zeros(ndim))
+
+    return (points - center) @ matrix.T + center + translation
+
+
+def apply_bspline_transform(points, parameters):
+    '''
+    Adds the displacement of a cubic B-spline grid to 2D points.
+    Points outside of the region supported by the grid are not displaced (as in elastix)
+    '''
+    order = int(parameters.get('BSplineTransformSplineOrder', [3])[0])
+    if order != 3 or points.shape[1] != 2:
+        raise ValueError('Only 2D cubic B-spline transformations are supported')
+    grid_size = _get_array(parameters, 'GridSize').astype(int)
+    grid_index = _get_array(parameters, 'GridIndex', [0, 0]).astype(int)
+    grid_spacing = _get_array(parameters, 'GridSpacing')
+    grid_origin = _get_array(parameters, 'GridOrigin')
+    grid_direction = _get_array(parameters, 'GridDirection', [1, 0, 0, 1]).reshape(2, 2).T
+    # coefficients are stored with x running fastest, all x displacements first
+    n_nodes = grid_size[0] * grid_size[1]
+    coefficients = _get_array(parameters, 'TransformParameters')
+    coefficients = coefficients.reshape(2, n_nodes)
+
+    # continuous index of each point in the control point grid
+    cindex = np.linalg.solve(grid_direction * grid_spacing, (points - grid_origin).T).T
+    inside = np.all((cindex >= grid_index + 1) & (cindex < grid_index + grid_size - 2), axis=1)
+    start = np.floor(cindex - 1).astype(int) - grid_index
+    start[~inside] = 0
+
+    displacement = np.zeros_like(points)
+    for ky in range(4):
+        wy = _cubic_bspline_kernel(cindex[:, 1] - grid_index[1] - start[:, 1] - ky)
+        for kx in range(4):
+            wx = _cubic_bspline_kernel(cindex[:, 0] - grid_index[0] - start[:, 0] - kx)
+            node = (start[:, 1] + ky) * grid_size[0] + start[:, 0] + kx
+            displacement += (wx * wy)[:, None] * coefficients[:, node].T
+    displacement[~inside] = 0
+
+    return points + displacement
+
+
+def apply_transform(points, parameters):
+    '''
+    applies a single elastix transformation (without its initial transform) to Nx2 points
+    '''
+    transform_name = parameters['Transform'][0]
+    if transform_name in ['AffineTransform', 'TranslationTransform']:
+        return apply_affine_transform(points, parameters)
+    if transform_name in ['BSplineTransform', 'RecursiveBSplineTransform']:
+        return apply_bspline_transform(points, parameters)
+    raise ValueError('Transform {} not supported'.format(transform_name))
+
+
+def transform_points(points, transformation_file):
+    '''
+    param points: Nx2 array of x, y positions (in pixels) of the fixed image (histology)
+    param transformation_file: path to the output of elastix (TransformParameters.1.txt)
+
+    returns: Nx2 array of x, y positions (in pixels) in the moving image (ARA slice),
+    equivalent to the OutputPoint of transformix
+    '''
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    chain = load_transform_chain(transformation_file)
+
+    return transform_points_with_chain(points, chain)
+
+
+def transform_points_with_chain(points, chain):
+    '''
+    same as transform_points but with an already loaded chain of transformations
+    '''
+    transformed = points
+    for parameters in chain:
+        how_to_combine = parameters.get('HowToCombineTransforms', ['Compose'])[0]
+        if how_to_combine == 'Add' and transformed is not points:
+            transformed = transformed + apply_transform(points, parameters) - points
+        else:
+            transformed = apply_transform(transformed, parameters)
+
+    return transformed
+
+
+def points_to_fixed_index(points, parameters):
+    '''
+    rounds physical points to pixel indexes using the fixed image geometry stored in
+    the parameter file, equivalent to the OutputIndexFixed of transformix
+    '''
+    ndim = points.shape[1]
+    spacing = _get_array(parameters, 'Spacing', np.ones(ndim))
+    origin = _get_array(parameters, 'Origin', np.zeros(ndim))
+    direction = _get_array(parameters, 'Direction', np.eye(ndim).ravel()).reshape(ndim, ndim).T
+    cindex = np.linalg.solve(direction * spacing, (points - origin).T).T
+
+    return np.floor(cindex + 0.5).astype('int64')
+
+
+def read_transformix_output_points(filepath, field='OutputIndexFixed'):
+    '''
+    param filepath: outputpoints.txt generated by transformix
+    param field: which entry to read from each line (e.g. InputPoint, OutputPoint)
+    returns: Nxd numpy array with the values of that field
+    '''
+    with open(filepath) as f:
+        text = f.read()
+    values = re.findall(field + r' = \[([^\]]*)\]', text)
+    if len(values) == 0:
+        return np.zeros((0, 2))
+    dtype = 'int64' if 'Index' in field else 'float64'
+    data = np.array(' '.join(values).split(), dtype=dtype)
+
+    return data.reshape(len(values), -1)
+
+
+def compare_with_transformix_output(transformation_file, outputpoints_file):
+    '''
+    evaluates the transformation on the input points of a transformix run and compares
+    the result with the transformix output
+    returns: maximum distance (in pixels) between both OutputPoints, and the number of
+    OutputIndexFixed values that differ
+    '''
+    input_points = read_transformix_output_points(outputpoints_file, 'InputPoint')
+    chain = load_transform_chain(transformation_file)
+    output_points = transform_points_with_chain(input_points, chain)
+    output_index = points_to_fixed_index(output_points, chain[-1])
+
+    reference_points = read_transformix_output_points(outputpoints_file, 'OutputPoint')
+    reference_index = read_transformix_output_points(outputpoints_file, 'OutputIndexFixed')
+    max_distance = np.max(np.linalg.norm(output_points - reference_points, axis=1), initial=0)
+    n_different = int(np.sum(np.any(output_index != reference_index, axis=1)))
+
+    return max_distance, n_different
+
+
+if __name__ == '__main__':
+    # check input
+    if len(sys.argv) != 3:
+        sys.exit('Arguments missing, please run like this:\
+            python elastix_transform.py TransformParameters.1.txt outputpoints.txt')
+    max_distance, n_different = compare_with_transformix_output(sys.argv[1], sys.argv[2])
+    print('Maximum distance to transformix output: {} pixels'.format(max_distance))
+    print('Points rounded to a different pixel: {}'.format(n_different))
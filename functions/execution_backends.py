@@ -0,0 +1,397 @@
+#!/usr/bin/python
+# Ways of running elastix and transformix:
+#   local: the executables (see get_elastix_paths), with their output saved in a log file,
+#          a timeout and retries
+#   itk:   the ITK-elastix python bindings (pip install itk-elastix), in the same process
+#   fake:  deterministic stand-in that needs neither elastix nor its bindings: the ARA
+#          screenshot is scaled to the histology, and points are transformed with numpy.
+#          Useful to test the pipeline and its throughput (FAKE_BACKEND_SECONDS sets the
+#          time each fake registration takes)
+# A backend is a dictionary made by make_backend, so it can be sent to worker processes.
+# The default one can be set with set_default_backend or the environment variables
+# HISTOLOGY_ELASTIX_BACKEND, HISTOLOGY_ELASTIX_TIMEOUT and HISTOLOGY_ELASTIX_RETRIES.
+
+import os
+import re
+import shutil
+import subprocess
+import time
+import numpy as np
+from functions import elastix_transform as et
+from functions import instrumentation as instr
+from functions.transform_functions import get_elastix_paths
+
+BACKEND_NAMES = ['local', 'itk', 'fake']
+BACKEND_ENVIRONMENT_VARIABLE = 'HISTOLOGY_ELASTIX_BACKEND'
+TIMEOUT_ENVIRONMENT_VARIABLE = 'HISTOLOGY_ELASTIX_TIMEOUT'
+RETRIES_ENVIRONMENT_VARIABLE = 'HISTOLOGY_ELASTIX_RETRIES'
+FAKE_SECONDS_ENVIRONMENT_VARIABLE = 'FAKE_BACKEND_SECONDS'
+# files (in the output folder) where the output of elastix and transformix is saved
+LOG_NAMES = {'elastix': 'elastix_run.log', 'transformix': 'transformix_run.log'}
+# characters of the end of the log given as error when a run fails
+ERROR_LOG_LENGTH = 500
+
+_default_backend = None
+
+
+def make_backend(name=None, timeout=None, retries=0):
+    '''
+    param name: 'local', 'itk' or 'fake' (by default, HISTOLOGY_ELASTIX_BACKEND or 'local')
+    param timeout: seconds after which a run of elastix or transformix is stopped
+        (not possible with the itk backend)
+    param retries: number of times a failed run is repeated
+    returns: dictionary with the configuration of the backend
+    '''
+    if name is None:
+        name = os.environ.get(BACKEND_ENVIRONMENT_VARIABLE, 'local')
+    assert name in BACKEND_NAMES, 'backend must be one of {}, not {}'.format(BACKEND_NAMES, name)
+    backend = {'name': name, 'timeout': timeout, 'retries': int(retries)}
+    if name == 'local':
+        backend['elastix_path'], backend['transformix_path'] = get_elastix_paths()
+    elif name == 'itk':
+        try:
+            import itk  # noqa: F401
+        except ImportError:
+            raise ImportError('the itk backend needs ITK-elastix (pip install itk-elastix)')
+    else:
+        backend['fake_seconds'] = float(os.environ.get(FAKE_SECONDS_ENVIRONMENT_VARIABLE, 0))
+
+    return backend
+
+
+def set_default_backend(name=None, timeout=None, retries=0):
+    '''
+    sets the backend used when none is given (also in the worker processes started later)
+    '''
+    global _default_backend
+    _default_backend = make_backend(name, timeout, retries)
+    os.environ[BACKEND_ENVIRONMENT_VARIABLE] = _default_backend['name']
+    for variable, value in [(TIMEOUT_ENVIRONMENT_VARIABLE, timeout),
+                            (RETRIES_ENVIRONMENT_VARIABLE, retries)]:
+        if value is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = str(value)
+
+    return _default_backend
+
+
+def get_default_backend():
+    global _default_backend
+    if _default_backend is None:
+        timeout = os.environ.get(TIMEOUT_ENVIRONMENT_VARIABLE)
+        _default_backend = make_backend(None, None if timeout is None else float(timeout),
+                                        int(os.environ.get(RETRIES_ENVIRONMENT_VARIABLE, 0)))
+
+    return _default_backend
+
+
+def get_backend_version(backend):
+    '''
+    returns: version of elastix used by a backend ('unknown' if it can not be run)
+    '''
+    if backend['name'] == 'fake':
+        return 'fake backend'
+    if backend['name'] == 'itk':
+        import itk
+        return 'itk-elastix {}'.format(itk.Version.GetITKVersion())
+    try:
+        instr.count('subprocesses')
+        process = subprocess.run([backend['elastix_path'], '--version'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 timeout=backend['timeout'])
+        return process.stdout.decode(errors='replace').strip() or 'unknown'
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unknown'
+
+
+def run_elastix(backend, fixed, moving, parameter_files, outdir_path, n_threads=None):
+    '''
+    Registers the moving image to the fixed image, saving the results (TransformParameters.N.txt
+    and result.N.tiff) in outdir_path
+    param fixed, moving, parameter_files: paths, relative to outdir_path or absolute
+    param n_threads: number of threads of elastix (elastix decides if None)
+    returns: dictionary with the exit code (None if elastix could not be run), the error
+        (None if it worked), the number of attempts and the path to the log
+    '''
+    run = {'local': _run_elastix_local, 'itk': _run_elastix_itk, 'fake': _run_elastix_fake}
+    log_path = os.path.join(outdir_path, LOG_NAMES['elastix'])
+
+    def attempt():
+        returncode, error = run[backend['name']](backend, fixed, moving, parameter_files,
+                                                 outdir_path, n_threads, log_path)
+        last_file = 'TransformParameters.{}.txt'.format(len(parameter_files) - 1)
+        if error is None and not os.path.isfile(os.path.join(outdir_path, last_file)):
+            error = 'elastix did not produce {}'.format(last_file)
+        return returncode, error
+
+    return _run_with_retries(attempt, backend, log_path)
+
+
+def run_transformix(backend, points_file, transformation_file, outdir_path):
+    '''
+    Transforms the points of points_file, saving them in outdir_path/outputpoints.txt
+    param points_file, transformation_file: paths, relative to outdir_path or absolute
+    returns: dictionary with the exit code, error, number of attempts and path to the log
+        (as run_elastix)
+    '''
+    run = {'local': _run_transformix_local, 'itk': _run_transformix_itk,
+           'fake': _run_transformix_fake}
+    log_path = os.path.join(outdir_path, LOG_NAMES['transformix'])
+
+    def attempt():
+        returncode, error = run[backend['name']](backend, points_file, transformation_file,
+                                                 outdir_path, log_path)
+        if error is None and not os.path.isfile(os.path.join(outdir_path, 'outputpoints.txt')):
+            error = 'transformix did not produce outputpoints.txt'
+        return returncode, error
+
+    return _run_with_retries(attempt, backend, log_path)
+
+
+def keep_failed_log(log_path, keep_path):
+    '''
+    moves the log of a failed run out of its temporary folder, before it is removed
+    returns: keep_path, or None if there was no log or it could not be moved
+    '''
+    if log_path is None or not os.path.isfile(log_path):
+        return None
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(keep_path)), exist_ok=True)
+        shutil.move(log_path, keep_path)
+    except OSError:
+        return None
+
+    return keep_path
+
+
+def _run_with_retries(attempt, backend, log_path):
+    for attempts in range(1, backend['retries'] + 2):
+        returncode, error = attempt()
+        if error is None:
+            break
+        print('Attempt {} of {} failed: {}'.format(attempts, backend['retries'] + 1,
+                                                     error.splitlines()[-1]))
+
+    return {'returncode': returncode,
+            'error': error,
+            'attempts': attempts,
+            'log_path': log_path}
+
+
+def _run_command(command, cwd, log_path, timeout):
+    '''
+    runs a command, with its output (stdout and stderr) in log_path
+    returns: exit code (None if it could not be run) and error (None if it worked)
+    '''
+    instr.count('subprocesses')
+    try:
+        with open(log_path, 'wb') as log:
+            process = subprocess.run(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                                     timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None, '{} timed out after {} s'.format(os.path.basename(command[0]), timeout)
+    except OSError as e:
+        return None, str(e)
+    if process.returncode != 0:
+        return process.returncode, _read_log_end(log_path) or '{} failed'.format(
+            os.path.basename(command[0]))
+
+    return 0, None
+
+
+def _read_log_end(log_path):
+    with open(log_path, 'rb') as f:
+        f.seek(max(os.path.getsize(log_path) - ERROR_LOG_LENGTH, 0))
+        return f.read().decode(errors='replace').strip()
+
+
+def _in_dir(outdir_path, path):
+    return path if os.path.isabs(path) else os.path.join(outdir_path, path)
+
+
+def _run_elastix_local(backend, fixed, moving, parameter_files, outdir_path, n_threads,
+                       log_path):
+    # run it in the output directory, otherwise elastix is shit
+    command = [backend['elastix_path'], '-f', fixed, '-m', moving]
+    for parameter_file in parameter_files:
+        command += ['-p', parameter_file]
+    command += ['-out', './']
+    if n_threads is not None:
+        command += ['-threads', str(n_threads)]
+
+    return _run_command(command, outdir_path, log_path, backend['timeout'])
+
+
+def _run_transformix_local(backend, points_file, transformation_file, outdir_path, log_path):
+    command = [backend['transformix_path'],
+               '-def', points_file,
+               '-out', '.',
+               '-tp', transformation_file]
+
+    return _run_command(command, outdir_path, log_path, backend['timeout'])
+
+
+def _run_elastix_itk(backend, fixed, moving, parameter_files, outdir_path, n_threads,
+                     log_path):
+    import itk
+    try:
+        if n_threads is not None:
+            itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(n_threads)
+        fixed_image = itk.imread(_in_dir(outdir_path, fixed), itk.F)
+        moving_image = itk.imread(_in_dir(outdir_path, moving), itk.F)
+        parameter_object = itk.ParameterObject.New()
+        for parameter_file in parameter_files:
+            parameter_object.AddParameterFile(_in_dir(outdir_path, parameter_file))
+        result_image, result_parameters = itk.elastix_registration_method(
+            fixed_image, moving_image, parameter_object=parameter_object,
+            log_to_console=False, log_to_file=True, log_file_name=os.path.basename(log_path),
+            output_directory=outdir_path)
+        # write the chain of transformations as elastix does
+        for i in range(result_parameters.GetNumberOfParameterMaps()):
+            if i > 0:
+                result_parameters.SetParameter(i, 'InitialTransformParametersFileName',
+                                               'TransformParameters.{}.txt'.format(i - 1))
+            result_parameters.WriteParameterFile(
+                result_parameters.GetParameterMap(i),
+                os.path.join(outdir_path, 'TransformParameters.{}.txt'.format(i)))
+        itk.imwrite(result_image, os.path.join(
+            outdir_path, 'result.{}.tiff'.format(result_parameters.GetNumberOfParameterMaps() - 1)))
+    except Exception as e:
+        return None, repr(e)
+
+    return 0, None
+
+
+def _run_transformix_itk(backend, points_file, transformation_file, outdir_path, log_path):
+    import itk
+    from functions.displacement_field import get_chain_paths
+    try:
+        parameter_object = itk.ParameterObject.New()
+        for path in get_chain_paths(_in_dir(outdir_path, transformation_file)):
+            parameter_object.AddParameterFile(path)
+        # transformix needs a moving image, although it is not used for points
+        moving_image = itk.image_from_array(np.zeros((1, 1), dtype='float32'))
+        itk.transformix_pointset(moving_image, parameter_object,
+                                 fixed_point_set_file_name=_in_dir(outdir_path, points_file),
+                                 output_directory=outdir_path, log_to_console=False,
+                                 log_to_file=True, log_file_name=os.path.basename(log_path))
+    except Exception as e:
+        return None, repr(e)
+
+    return 0, None
+
+
+def _wait_fake_seconds(backend, program):
+    # time that a fake run takes, stopped by the timeout
+    seconds = backend['fake_seconds']
+    if backend['timeout'] is not None and seconds > backend['timeout']:
+        time.sleep(backend['timeout'])
+        return '{} timed out after {} s'.format(program, backend['timeout'])
+    time.sleep(seconds)
+
+    return None
+
+
+def _fake_error(log_path, returncode, error):
+    # the fake runs also leave a log when they fail
+    with open(log_path, 'a') as f:
+        f.write('ERROR: {}\n'.format(error))
+
+    return returncode, error
+
+
+def _run_elastix_fake(backend, fixed, moving, parameter_files, outdir_path, n_threads,
+                      log_path):
+    '''
+    maps the histology to the ARA screenshot scaling one into the other, and writes that
+    as the first elastix transformation (followed by identities, one per parameter file)
+    '''
+    from functions.fast_registration import read_image, write_image
+    with open(log_path, 'w') as f:
+        f.write('fake elastix: {} to {}\n'.format(moving, fixed))
+    error = _wait_fake_seconds(backend, 'elastix')
+    if error is not None:
+        return _fake_error(log_path, None, error)
+    try:
+        fixed_image = np.squeeze(read_image(_in_dir(outdir_path, fixed)))
+        moving_image = np.squeeze(read_image(_in_dir(outdir_path, moving)))
+    except (ImportError, OSError, ValueError) as e:
+        return _fake_error(log_path, None, str(e))
+    if fixed_image.ndim != 2 or moving_image.ndim != 2:
+        return _fake_error(log_path, 1, 'the fake backend only registers 2D images')
+    size = (fixed_image.shape[1], fixed_image.shape[0])
+    scales = [moving_image.shape[1] / size[0], moving_image.shape[0] / size[1]]
+
+    # pixel i of the histology covers pixels i * scale to (i + 1) * scale of the screenshot
+    parameters = [scales[0], 0, 0, scales[1], 0.5 * scales[0] - 0.5, 0.5 * scales[1] - 0.5]
+    for i in range(len(parameter_files)):
+        initial = 'NoInitialTransform' if i == 0 else 'TransformParameters.{}.txt'.format(i - 1)
+        with open(os.path.join(outdir_path, 'TransformParameters.{}.txt'.format(i)), 'w') as f:
+            f.write('\n'.join([
+                '(Transform "AffineTransform")',
+                '(NumberOfParameters 6)',
+                '(TransformParameters {})'.format(' '.join(repr(float(p)) for p in parameters)),
+                '(InitialTransformParametersFileName "{}")'.format(initial),
+                '(HowToCombineTransforms "Compose")',
+                '(FixedImageDimension 2)',
+                '(MovingImageDimension 2)',
+                '(Size {} {})'.format(*size),
+                '(Index 0 0)',
+                '(Spacing 1.0000000000 1.0000000000)',
+                '(Origin 0.0000000000 0.0000000000)',
+                '(Direction 1.0000000000 0.0000000000 0.0000000000 1.0000000000)',
+                '(UseDirectionCosines "true")',
+                '(CenterOfRotationPoint 0.0000000000 0.0000000000)',
+                '(DefaultPixelValue 0)',
+                '(ResultImageFormat "tiff")',
+                '']))
+        parameters = [1, 0, 0, 1, 0, 0]
+
+    # screenshot resampled (nearest pixel) on the histology
+    xs, ys = np.meshgrid(np.arange(size[0]), np.arange(size[1]))
+    points = np.column_stack([xs.ravel(), ys.ravel()]).astype('float64')
+    mapped = np.floor(et.transform_points(points, os.path.join(
+        outdir_path, 'TransformParameters.{}.txt'.format(len(parameter_files) - 1))) + 0.5)
+    mapped = mapped.astype('int64').reshape(size[1], size[0], 2)
+    result = moving_image[np.clip(mapped[:, :, 1], 0, moving_image.shape[0] - 1),
+                          np.clip(mapped[:, :, 0], 0, moving_image.shape[1] - 1)]
+    write_image(os.path.join(outdir_path, 'result.{}.tiff'.format(len(parameter_files) - 1)),
+                result)
+    with open(log_path, 'a') as f:
+        f.write('{} scaled by {} {}\n'.format(moving, 1 / scales[0], 1 / scales[1]))
+
+    return 0, None
+
+
+def _run_transformix_fake(backend, points_file, transformation_file, outdir_path, log_path):
+    '''
+    transforms the points with numpy, and writes them as transformix does
+    '''
+    with open(log_path, 'w') as f:
+        f.write('fake transformix: {} with {}\n'.format(points_file, transformation_file))
+    error = _wait_fake_seconds(backend, 'transformix')
+    if error is not None:
+        return _fake_error(log_path, None, error)
+    with open(_in_dir(outdir_path, points_file)) as f:
+        lines = f.read().split('\n', 2)
+    if not re.match(r'(point|index)$', lines[0].strip()) or len(lines) < 3:
+        return _fake_error(log_path, 1, 'invalid points file {}'.format(points_file))
+    points = np.array(lines[2].split(), dtype='float64').reshape(-1, 2)
+    chain = et.load_transform_chain(_in_dir(outdir_path, transformation_file))
+    output = et.transform_points_with_chain(points, chain)
+    index = et.points_to_fixed_index(output, chain[-1])
+
+    with open(os.path.join(outdir_path, 'outputpoints.txt'), 'w') as f:
+        for i in range(len(points)):
+            f.write('Point\t{}\t; InputIndex = [ {} {} ]\t; InputPoint = [ {:.6f} {:.6f} ]'
+                    '\t; OutputIndexFixed = [ {} {} ]\t; OutputPoint = [ {:.6f} {:.6f} ]'
+                    '\t; Deformation = [ {:.6f} {:.6f} ]\n'.format(
+                        i, int(round(points[i, 0])), int(round(points[i, 1])),
+                        points[i, 0], points[i, 1], index[i, 0], index[i, 1],
+                        output[i, 0], output[i, 1],
+                        output[i, 0] - points[i, 0], output[i, 1] - points[i, 1]))
+    with open(log_path, 'a') as f:
+        f.write('{} points transformed\n'.format(len(points)))
+
+    return 0, None
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# Fast registration profile: the histology is downsampled to the pixel size of the
+# ARA screenshot before running elastix, and a scaling transformation is added at the
+# start of the chain of elastix transformations, so that they keep mapping the points
+# of the full resolution histology.
+
+import os
+import re
+import numpy as np
+import pandas as pd
+from functions import elastix_transform as et
+
+# pixel size (um/px) of the ARA screenshots made with the default MoBIE parameters
+ARA_PIXEL_SIZE = 22.619
+# name of the transformation added at the start of the chain
+DOWNSAMPLING_TRANSFORM_NAME = 'TransformParameters.downsampling.txt'
+DOWNSAMPLED_HISTOLOGY_NAME = 'histology_downsampled.tif'
+# spacing (in pixels of the histology) of the points used to compare two registrations
+PROFILE_COMPARISON_STEP = 8
+
+
+def read_image(filepath):
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError('the fast registration profile needs tifffile (pip install tifffile)')
+
+    return tifffile.imread(filepath)
+
+
+def write_image(filepath, image):
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError('the fast registration profile needs tifffile (pip install tifffile)')
+    tifffile.imwrite(filepath, image)
+
+
+def get_area_weights(n_in, n_out):
+    '''
+    returns: n_out x n_in matrix with the fraction of each input pixel covered by each
+        output pixel (divided by the size of the output pixel), so that its product with
+        a line of pixels averages them
+    '''
+    edges = np.arange(n_out + 1) * n_in / n_out
+    starts = np.arange(n_in)
+    overlap = (np.minimum(edges[1:, None], starts[None, :] + 1) -
+               np.maximum(edges[:-1, None], starts[None, :]))
+
+    return np.clip(overlap, 0, None) * n_out / n_in
+
+
+def downsample_image(image, scale):
+    '''
+    Downsamples a 2D image by averaging the pixels covered by each new pixel
+    param scale: size of the new image relative to the original (< 1)
+    returns: downsampled image (same type as image), and the scale in x and y
+        (slightly different from scale, as the new size is rounded)
+    '''
+    assert image.ndim == 2, 'only 2D images can be downsampled'
+    height, width = image.shape
+    new_height = max(int(round(height * scale)), 1)
+    new_width = max(int(round(width * scale)), 1)
+    downsampled = (get_area_weights(height, new_height) @ image.astype('float64') @
+                   get_area_weights(width, new_width).T)
+    if np.issubdtype(image.dtype, np.integer):
+        info = np.iinfo(image.dtype)
+        downsampled = np.clip(np.round(downsampled), info.min, info.max)
+
+    return downsampled.astype(image.dtype), (new_width / width, new_height / height)
+
+
+def make_downsampled_histology(hist_path, outdir_path, scale):
+    '''
+    saves the downsampled histology in the output directory
+    returns: name of the downsampled image, size (x, y) of the original image, and the
+        scale in x and y
+    '''
+    image = read_image(hist_path)
+    downsampled, scales = downsample_image(image, scale)
+    write_image(os.path.join(outdir_path, DOWNSAMPLED_HISTOLOGY_NAME), downsampled)
+
+    return DOWNSAMPLED_HISTOLOGY_NAME, (image.shape[1], image.shape[0]), scales
+
+
+def add_downsampling_to_transform(outdir_path, full_size, scales):
+    '''
+    Adds the downsampling of the histology at the start of the chain of elastix
+    transformations (TransformParameters.0.txt and TransformParameters.1.txt), so that
+    they map points of the full resolution histology. Pixel i of the downsampled image
+    covers pixels i / scale to (i + 1) / scale of the original, so a point x of the
+    original is at (x + 0.5) * scale - 0.5 in the downsampled image.
+    The size of the fixed image is set to the size of the full resolution histology
+    param full_size: size (x, y) of the full resolution histology
+    param scales: scale in x and y of the downsampled histology
+    '''
+    first_path = os.path.join(outdir_path, 'TransformParameters.0.txt')
+    with open(first_path) as f:
+        first_text = f.read()
+    size_line = '(Size {} {})'.format(*full_size)
+
+    # scaling transformation, with the geometry of the full resolution histology
+    parameters = [scales[0], 0, 0, scales[1], 0.5 * scales[0] - 0.5, 0.5 * scales[1] - 0.5]
+    downsampling_text = '\n'.join([
+        '(Transform "AffineTransform")',
+        '(NumberOfParameters 6)',
+        '(TransformParameters {})'.format(' '.join(repr(float(p)) for p in parameters)),
+        '(InitialTransformParametersFileName "NoInitialTransform")',
+        '(HowToCombineTransforms "Compose")',
+        '(FixedImageDimension 2)',
+        '(MovingImageDimension 2)',
+        size_line,
+        '(Index 0 0)',
+        '(Spacing 1.0000000000 1.0000000000)',
+        '(Origin 0.0000000000 0.0000000000)',
+        '(Direction 1.0000000000 0.0000000000 0.0000000000 1.0000000000)',
+        '(UseDirectionCosines "true")',
+        '(CenterOfRotationPoint 0.0000000000 0.0000000000)',
+        '']) + '\n'.join(line for line in first_text.splitlines()
+                         if re.match(r'\((FixedInternalImagePixelType|MovingInternalImagePixelType|'
+                                     r'ResampleInterpolator|Resampler|DefaultPixelValue|'
+                                     r'ResultImageFormat|ResultImagePixelType|'
+                                     r'CompressResultImage) ', line)) + '\n'
+    with open(os.path.join(outdir_path, DOWNSAMPLING_TRANSFORM_NAME), 'w') as f:
+        f.write(downsampling_text)
+
+    # point the chain to the downsampling and use the full size of the histology
+    for name, initial in [('TransformParameters.0.txt', DOWNSAMPLING_TRANSFORM_NAME),
+                          ('TransformParameters.1.txt', None)]:
+        path = os.path.join(outdir_path, name)
+        with open(path) as f:
+            text = f.read()
+        if initial is not None:
+            text = re.sub(r'\(InitialTransformParametersFileName "[^"]*"\)',
+                          '(InitialTransformParametersFileName "{}")'.format(initial), text)
+        text = re.sub(r'\(Size [^)]*\)', size_line, text)
+        with open(path, 'w') as f:
+            f.write(text)
+
+
+def compare_registrations(transformation_file, reference_file, step=PROFILE_COMPARISON_STEP):
+    '''
+    maps a grid of points of the histology with two registrations of the same slice
+    param transformation_file: TransformParameters.1.txt of the registration to evaluate
+    param reference_file: TransformParameters.1.txt of the reference registration
+    param step: spacing (in pixels) of the grid of points
+    returns: dictionary with the mean, 95th percentile and maximum distance (in pixels
+        of the ARA screenshot) between the points mapped by both registrations
+    '''
+    reference_chain = et.load_transform_chain(reference_file)
+    size = np.asarray(reference_chain[-1]['Size'], dtype=int)
+    xs, ys = np.meshgrid(np.arange(0, size[0], step), np.arange(0, size[1], step))
+    points = np.column_stack([xs.ravel(), ys.ravel()]).astype('float64')
+
+    distance = np.linalg.norm(et.transform_points(points, transformation_file) -
+                              et.transform_points_with_chain(points, reference_chain), axis=1)
+
+    return {'mean_distance': float(np.mean(distance)),
+            'p95_distance': float(np.percentile(distance, 95)),
+            'max_distance': float(np.max(distance))}
+
+
+def make_profiles_report(slices, report_path):
+    '''
+    Compares the registrations of the fast profile with those of the default profile
+    param slices: list of (name, fast output directory, default output directory,
+        fast wall time, default wall time)
+    param report_path: .csv file where the report is saved
+    returns: dataframe with one row per slice: distances in pixels and um of the ARA
+        screenshot, and the time of both registrations
+    '''
+    rows = []
+    for name, fast_dir, default_dir, fast_time, default_time in slices:
+        row = {'slice': name, 'fast_seconds': fast_time, 'default_seconds': default_time}
+        row.update(compare_registrations(os.path.join(fast_dir, 'TransformParameters.1.txt'),
+                                         os.path.join(default_dir, 'TransformParameters.1.txt')))
+        for key in ['mean_distance', 'p95_distance', 'max_distance']:
+            row[key + '_um'] = row[key] * ARA_PIXEL_SIZE
+        rows.append(row)
+    report = pd.DataFrame(rows, columns=['slice', 'default_seconds', 'fast_seconds',
+                                         'mean_distance', 'p95_distance', 'max_distance',
+                                         'mean_distance_um', 'p95_distance_um',
+                                         'max_distance_um'])
+    if len(report) > 0:
+        report['speedup'] = report.default_seconds / report.fast_seconds
+    report.to_csv(report_path, index=False)
+
+    return report
@@ -2,95 +2,25 @@
 
 import numpy as np
 import os
+import json
 import pandas as pd
-
-
-def parameters_to_matrix(trafo):
-    # function from https://github.com/constantinpape/elf
-    """ Parameter vector to affine matrix.
-    Assumes parameter vector layed out as
-    2d:
-        [a00, a01, a02, a10, a11, a12]
-    3d:
-        [a00, a01, a02, a03, a10, a11, a12, a13, a20, a21, a22, a23]
-    """
-    if len(trafo) == 12:
-        sub_matrix = np.zeros((3, 3), dtype='float64')
-        sub_matrix[0, 0] = trafo[0]
-        sub_matrix[0, 1] = trafo[1]
-        sub_matrix[0, 2] = trafo[2]
-
-        sub_matrix[1, 0] = trafo[4]
-        sub_matrix[1, 1] = trafo[5]
-        sub_matrix[1, 2] = trafo[6]
-
-        sub_matrix[2, 0] = trafo[8]
-        sub_matrix[2, 1] = trafo[9]
-        sub_matrix[2, 2] = trafo[10]
-
-        shift = [trafo[3], trafo[7], trafo[11]]
-
-        matrix = np.zeros((4, 4))
-        matrix[:3, :3] = sub_matrix
-        matrix[:3, 3] = shift
-        matrix[3, 3] = 1
-
-    elif len(trafo) == 6:
-        sub_matrix = np.zeros((2, 2), dtype='float64')
-        sub_matrix[0, 0] = trafo[0]
-        sub_matrix[0, 1] = trafo[1]
-
-        sub_matrix[1, 0] = trafo[3]
-        sub_matrix[1, 1] = trafo[4]
-
-        shift = [trafo[2], trafo[5]]
-
-        matrix = np.zeros((3, 3))
-        matrix[:2, :2] = sub_matrix
-        matrix[:2, 2] = shift
-        matrix[2, 2] = 1
-
-    else:
-        raise ValueError(f"Invalid number of parameters {len(trafo)}")
-
-    return matrix
-
-
-def transform_coordinate(coord, matrix):
-    # function from https://github.com/constantinpape/elf
-    # x = matrix[0, 0] * coord[0] + matrix[0, 1] * coord[1] + matrix[0, 2] * coord[2] + matrix[0, 3]
-    # y = matrix[1, 0] * coord[0] + matrix[1, 1] * coord[1] + matrix[1, 2] * coord[2] + matrix[1, 3]
-    # z = matrix[2, 0] * coord[0] + matrix[2, 1] * coord[1] + matrix[2, 2] * coord[2] + matrix[2, 3]
-    ndim = len(coord)
-    return tuple(sum(coord[jj] * matrix[ii, jj] for jj in range(ndim)) + matrix[ii, -1] for ii in range(ndim))
-
-
-def read_mobie_text_output(filepath):
-    # reads the bdv from a .txt file of the MoBIE output
-    with open(filepath) as fp:
-        for i, line in enumerate(fp):
-            if i == 3:
-                view = line.strip()
-                break
-    pview = np.array(view.split(','))
-    pview = [float(i) for i in pview]
-
-    return pview
-
-
-def get_elastix_paths():
-    # this is where the file is supposed to be:
-    infofile_path = os.path.abspath(__file__ + "/../../custom_paths_to_elastix.txt")
-    file = open(infofile_path)
-    lines = file.readlines()
-    for line in lines:
-        if line.startswith('elastix_path = '):
-            ep = line.split('elastix_path = ')[1].strip()
-        if line.startswith('transformix_path = '):
-            tp = line.split('transformix_path = ')[1].strip()
-    file.close()
-
-    return(ep, tp)
+from functions import instrumentation as instr
+from functions import transform_functions as tfn
+# helpers that only need numpy, imported here so that they are also available from this module
+from functions.transform_functions import (  # noqa: F401
+    parameters_to_matrix, transform_coordinate, transform_coordinates, read_mobie_text_output,
+    get_elastix_paths, get_mobie_view_matrix, read_elastix_parameters, set_disk_cache,
+    cached_parse, get_transformation_file_path, get_mobie_file_path)
+
+# memory used while transforming a dataframe, relative to the memory of its input columns
+PROCESSING_MEMORY_FACTOR = 4
+# types of the columns of the roi position files, and name of the table of all of them
+ROI_COLUMN_TYPES = {'roiID': str,
+                    'high_res_x_pos': 'int64',
+                    'high_res_y_pos': 'int64',
+                    'registration_image_pixel_size': 'float64',
+                    'high_res_pixel_size': 'float64'}
+ROI_TABLE_NAME = 'roi_positions_table.npz'
 
 
 def make_reg_core_name_from_series(series_data):
@@ -118,6 +48,40 @@ def make_core_name_from_series(series_data):
     return name
 
 
+def make_reg_core_names(df):
+    '''
+    column-wise version of make_reg_core_name_from_series for a whole dataframe
+    outputs: categorical series with names like PH301_A2A-Ai14_slide-1_slice-0
+    '''
+    return _make_categorical_names(
+        df, ['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice'],
+        lambda animal, condition, slide, sl: '_'.join([animal, condition,
+                                                       'slide-' + str(slide),
+                                                       'slice-' + str(sl)]))
+
+
+def make_core_names(df):
+    '''
+    column-wise version of make_core_name_from_series for a whole dataframe
+    outputs: categorical series with names like PH301_A2A-Ai14_slide-1_slice-0_manualROI-L-Tail
+    '''
+    return _make_categorical_names(
+        df, ['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice', 'Side', 'AP'],
+        lambda animal, condition, slide, sl, side, ap: '_'.join([animal, condition,
+                                                                 'slide-' + str(slide),
+                                                                 'slice-' + str(sl),
+                                                                 'manualROI-' + side + '-' + ap]))
+
+
+def _make_categorical_names(df, columns, make_name):
+    # build the name once for each combination of values, not once per row
+    codes, uniques = pd.MultiIndex.from_frame(df[columns]).factorize()
+    names, name_codes = np.unique([make_name(*values) for values in uniques],
+                                  return_inverse=True)
+
+    return pd.Series(pd.Categorical.from_codes(name_codes[codes], names), index=df.index)
+
+
 def get_prereg_coordinates(df, data_path):
     '''
     df is a panda dataframe with specific columns
@@ -126,41 +90,151 @@ def get_prereg_coordinates(df, data_path):
     '''
     assert isinstance(df, pd.DataFrame), 'Data not pandas dataframe'
 
-    # create two columns to hold data
-    df['x_coord_pre'] = np.nan
-    df['y_coord_pre'] = np.nan
-
-    # get the individual manual rois
-    ind_rois = df.manual_roi_name.unique()
-    # iterate over each manually draw roi
-    for roiname in ind_rois:
-        # get the indexes of the cells belonging to that roi
-        sub_idx = df[df.manual_roi_name == roiname].index.values
-        # get the path to the file with roi information
-        mr_file = get_manual_rois_file_path(df.loc[sub_idx], data_path)
-        # generate a dataframe from that file
-        roi_df = create_dataframe_from_roi_file(mr_file)
-
-        # iterate over the indexes
-        for index, row in df.loc[sub_idx].iterrows():
-            # get roi number
-            rn = str(row.ROI)
-            roi_df_bool = roi_df.roiID == rn
-            # get high resolution x and y values
-            hr_x = int(roi_df[roi_df_bool].high_res_x_pos) + float(row.Center_X)
-            hr_y = int(roi_df[roi_df_bool].high_res_y_pos) + float(row.Center_Y)
-            # adjust resolution
-            reg_im_res = float(roi_df[roi_df_bool].registration_image_pixel_size)
-            coords_res = float(roi_df[roi_df_bool].high_res_pixel_size)
-            lr_x = int(hr_x * coords_res / reg_im_res)
-            lr_y = int(hr_y * coords_res / reg_im_res)
-            # assign to dataframe columns
-            df.at[index, 'x_coord_pre'] = lr_x
-            df.at[index, 'y_coord_pre'] = lr_y
+    if len(df) == 0:
+        df['x_coord_pre'] = np.nan
+        df['y_coord_pre'] = np.nan
+        return df
+
+    # read the file of each manually drawn roi once, into a single table
+    with instr.span('read_roi_files'):
+        rois_df = load_manual_rois_positions(df, data_path)
+
+    # match every cell to its roi (manual roi name and roi number)
+    with instr.span('merge_rois'):
+        cells_df = pd.DataFrame({'manual_roi_name': df.manual_roi_name.values,
+                                 'roiID': df.ROI.astype(str).values})
+        cells_df = cells_df.merge(rois_df, on=['manual_roi_name', 'roiID'],
+                                  how='left', validate='many_to_one')
+    assert not cells_df.high_res_pixel_size.isna().any(), 'cells without roi information'
+
+    # get high resolution x and y values
+    hr_x = cells_df.high_res_x_pos.values + df.Center_X.values.astype('float64')
+    hr_y = cells_df.high_res_y_pos.values + df.Center_Y.values.astype('float64')
+    # adjust resolution (truncating like int())
+    reg_im_res = cells_df.registration_image_pixel_size.values
+    coords_res = cells_df.high_res_pixel_size.values
+    df['x_coord_pre'] = np.trunc(hr_x * coords_res / reg_im_res)
+    df['y_coord_pre'] = np.trunc(hr_y * coords_res / reg_im_res)
 
     return df
 
 
+def load_manual_rois_positions(df, data_path):
+    '''
+    reads the roi information of all the manual rois in df into a single dataframe
+    with typed columns, and the manual_roi_name each roi belongs to
+    '''
+    rois_list = []
+    # the roi files of each animal are read from a single table
+    for animal, animal_positions in df.groupby('AnimalID', sort=False, observed=True).indices.items():
+        animal_df = df.iloc[animal_positions]
+        rois_table = load_animal_rois_table(os.path.join(data_path, animal))
+        # file of each manually drawn roi
+        rois_groups = animal_df.groupby('manual_roi_name', sort=False, observed=True).indices
+        for roiname, positions in rois_groups.items():
+            core_name = make_core_name_from_series(animal_df.iloc[positions[0]])
+            roi_df = rois_table.get(core_name)
+            if roi_df is None:
+                raise FileNotFoundError(get_manual_rois_file_path(animal_df.iloc[positions[:1]],
+                                                                  data_path))
+            roi_df = roi_df.copy()
+            roi_df['manual_roi_name'] = roiname
+            rois_list.append(roi_df)
+
+    rois_df = pd.concat(rois_list, ignore_index=True)
+    rois_df = rois_df[['manual_roi_name'] + list(ROI_COLUMN_TYPES)]
+
+    return rois_df
+
+
+def load_animal_rois_table(animal_path):
+    '''
+    reads all the roi position files of an animal (ROIs/000_ManualROIs_info) into
+    one table. The table is saved in that folder (roi_positions_table.npz) and read
+    from there while the roi files do not change
+    returns: dictionary of core name (as in make_core_name_from_series) to a dataframe
+        with the columns in ROI_COLUMN_TYPES
+    '''
+    rois_dir = os.path.join(animal_path, 'ROIs', '000_ManualROIs_info')
+    sources = sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                     for entry in os.scandir(rois_dir)
+                     if entry.name.endswith('_roi_positions.txt'))
+    key = ('roi_table', os.path.abspath(rois_dir), tuple(sources))
+    rois_table = tfn._get_parsed_file(key)
+    if rois_table is not None:
+        instr.count('cache_hits')
+        return rois_table
+
+    table_path = os.path.join(rois_dir, ROI_TABLE_NAME)
+    table = _read_rois_table(table_path, sources)
+    if table is None:
+        table = _make_rois_table(rois_dir, sources)
+        try:
+            tfn._write_disk_cache_file(table_path, table, evict=False)
+        except OSError:
+            print('Could not save the table of roi positions in {}'.format(rois_dir))
+    else:
+        instr.count('cache_hits')
+
+    # split the table by file
+    columns = pd.DataFrame({column: table[column] for column in ROI_COLUMN_TYPES})
+    files = pd.Series(table['core_name']).groupby(table['core_name'], sort=False).indices
+    rois_table = {name: columns.iloc[positions].reset_index(drop=True)
+                  for name, positions in files.items()}
+
+    tfn._add_parsed_file(key, rois_table)
+
+    return rois_table
+
+
+def _read_rois_table(table_path, sources):
+    # the saved table, if it was made from the same files
+    if not os.path.isfile(table_path):
+        return None
+    with np.load(table_path, allow_pickle=False) as data:
+        table = {name: data[name] for name in data.files}
+    saved_sources = list(zip(table['source_names'].tolist(), table['source_mtimes'].tolist(),
+                             table['source_sizes'].tolist()))
+    if saved_sources != sources:
+        return None
+
+    return table
+
+
+def _make_rois_table(rois_dir, sources):
+    # all the roi files in one table, with the core name of the file of each roi
+    rois_list = []
+    for name, _, _ in sources:
+        roi_df = read_roi_positions_file(os.path.join(rois_dir, name))
+        instr.count('files_read')
+        roi_df['core_name'] = name[:-len('_roi_positions.txt')]
+        rois_list.append(roi_df)
+    if len(rois_list) > 0:
+        rois_df = pd.concat(rois_list, ignore_index=True)
+    else:
+        rois_df = pd.DataFrame({column: pd.Series(dtype=column_type) for column, column_type
+                                in dict(ROI_COLUMN_TYPES, core_name=str).items()})
+
+    table = {column: rois_df[column].to_numpy().astype(column_type)
+             for column, column_type in ROI_COLUMN_TYPES.items()}
+    table['core_name'] = rois_df['core_name'].to_numpy().astype(str)
+    table['source_names'] = np.array([name for name, _, _ in sources], dtype=str)
+    table['source_mtimes'] = np.array([mtime for _, mtime, _ in sources], dtype='int64')
+    table['source_sizes'] = np.array([size for _, _, size in sources], dtype='int64')
+
+    return table
+
+
+def read_roi_positions_file(filepath):
+    '''
+    typed and faster version of create_dataframe_from_roi_file: reads a roi position
+    file with the C parser of pandas
+    returns: dataframe with typed columns (ROI_COLUMN_TYPES, others as read by pandas)
+    '''
+    return pd.read_csv(filepath, sep=',', skipinitialspace=True, engine='c',
+                       dtype=ROI_COLUMN_TYPES)
+
+
 def create_dataframe_from_roi_file(filepath):
     '''
     creates a dataframe with information of rois
@@ -201,26 +275,170 @@ def get_manual_rois_file_path(df, data_path):
     return (manual_roi_path)
 
 
-def get_transformation_file_path(general_path, image_name):
+def read_dataframe(filepath):
     '''
-    generates the path to the file with the elastix transformation
+    reads a dataframe saved as pickle, parquet or feather (depending on the extension)
     '''
-    registration_file_path = 'ROIs/000_Slices_for_ARA_registration/'
-    out_path = os.path.join(general_path,
-                            registration_file_path,
-                            image_name + '_reg_output',
-                            'TransformParameters.1.txt')
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in ['.parquet', '.pq']:
+        return pd.read_parquet(filepath)
+    if extension in ['.feather', '.arrow']:
+        return pd.read_feather(filepath)
 
-    return out_path
+    return pd.read_pickle(filepath)
 
 
-def get_mobie_file_path(general_path, image_name):
+def read_dataframe_chunks(filepath, memory_budget, columns):
     '''
-    generates the path to the file with the mobie position
+    reads a dataframe in chunks of rows small enough to be processed within
+    memory_budget (in bytes).
+    Parquet and feather files are read one chunk at a time. Pickle files can only be
+    read completely, so only the processing is done in chunks
+    param columns: columns to read
+    yields: dataframes with the columns, the original index and the attrs (e.g. datapath)
     '''
-    registration_file_path = 'ROIs/000_Slices_for_ARA_registration/'
-    out_path = os.path.join(general_path,
-                            registration_file_path,
-                            image_name + '.txt')
-
-    return out_path
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in ['.parquet', '.pq', '.feather', '.arrow']:
+        for chunk in _read_arrow_chunks(filepath, memory_budget, columns,
+                                        parquet=extension in ['.parquet', '.pq']):
+            yield chunk
+        return
+
+    df = pd.read_pickle(filepath)
+    attrs = df.attrs
+    df = df[columns]
+    chunk_rows = _get_chunk_rows(df.iloc[:1000], memory_budget)
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].copy()
+        chunk.attrs = dict(attrs)
+        yield chunk
+
+
+def keep_groups_together(chunks, columns):
+    '''
+    moves the rows at the end of every chunk that have the same values in columns to the
+    next chunk, so that a group of consecutive rows (e.g. the cells of an image) is not
+    split between two chunks
+    param chunks: iterable of dataframes
+    param columns: columns that identify the group of a row
+    yields: dataframes with the same rows, in the same order, and the attrs
+    '''
+    carry = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if carry is not None:
+            attrs = chunk.attrs
+            chunk = pd.concat([carry, chunk])
+            chunk.attrs = dict(attrs)
+        keys = chunk[columns]
+        same_as_last = (keys == keys.iloc[-1]).all(axis=1).values
+        different = np.flatnonzero(~same_as_last)
+        # first row of the group at the end of the chunk
+        start = different[-1] + 1 if len(different) > 0 else 0
+        carry = chunk.iloc[start:].copy()
+        carry.attrs = dict(chunk.attrs)
+        if start > 0:
+            head = chunk.iloc[:start].copy()
+            head.attrs = dict(chunk.attrs)
+            yield head
+    if carry is not None:
+        yield carry
+
+
+def _get_chunk_rows(sample_df, memory_budget):
+    # number of rows that can be processed with the memory budget
+    bytes_per_row = sample_df.memory_usage(deep=True).sum() / max(len(sample_df), 1)
+    return max(1000, int(memory_budget / (PROCESSING_MEMORY_FACTOR * bytes_per_row)))
+
+
+def _read_arrow_chunks(filepath, memory_budget, columns, parquet=True):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is needed to read parquet and feather files')
+
+    if parquet:
+        parquet_file = pq.ParquetFile(filepath)
+        schema = parquet_file.schema_arrow
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(filepath))
+        schema = reader.schema
+    # attributes and index saved by pandas
+    metadata = schema.metadata or {}
+    attrs = json.loads(metadata.get(b'PANDAS_ATTRS', b'{}'))
+    index_columns = json.loads(metadata.get(b'pandas', b'{}')).get('index_columns', [])
+    named_index = [c for c in index_columns if isinstance(c, str)]
+    range_index = [c for c in index_columns if isinstance(c, dict) and c.get('kind') == 'range']
+    read_columns = columns + named_index
+
+    def batches_to_dataframe(batches, offset):
+        table = pa.Table.from_batches(batches).select(read_columns)
+        chunk = table.replace_schema_metadata(None).to_pandas()
+        if len(named_index) > 0:
+            chunk = chunk.set_index(named_index)
+            chunk.index.names = [None if n.startswith('__index_level_') else n
+                                 for n in chunk.index.names]
+        else:
+            start = range_index[0]['start'] if len(range_index) > 0 else 0
+            step = range_index[0]['step'] if len(range_index) > 0 else 1
+            chunk.index = pd.RangeIndex(start + step * offset,
+                                        start + step * (offset + len(chunk)), step)
+        chunk.attrs = dict(attrs)
+        return chunk
+
+    if parquet:
+        batches = parquet_file.iter_batches(batch_size=1000, columns=read_columns)
+        sample_batch = next(batches, None)
+        if sample_batch is None:
+            return
+        chunk_rows = _get_chunk_rows(batches_to_dataframe([sample_batch], 0), memory_budget)
+        offset = 0
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=read_columns):
+            yield batches_to_dataframe([batch], offset)
+            offset += batch.num_rows
+        return
+
+    # feather files are read batch by batch from the memory map
+    chunk_rows = None
+    offset = 0
+    pending = []
+    n_pending = 0
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        if chunk_rows is None:
+            chunk_rows = _get_chunk_rows(batches_to_dataframe([batch.slice(0, 1000)], 0),
+                                         memory_budget)
+        while batch.num_rows > 0:
+            n_rows = min(batch.num_rows, chunk_rows - n_pending)
+            pending.append(batch.slice(0, n_rows))
+            n_pending += n_rows
+            batch = batch.slice(n_rows)
+            if n_pending == chunk_rows:
+                yield batches_to_dataframe(pending, offset)
+                offset += n_pending
+                pending = []
+                n_pending = 0
+    if n_pending > 0:
+        yield batches_to_dataframe(pending, offset)
+
+
+def print_run_summary(results, description):
+    '''
+    prints the wall time, exit code and errors of a list of jobs
+    results is a list of dictionaries with keys name, wall_time, error and optionally
+    returncode and log_path (error is None for jobs that succeeded)
+    '''
+    failed = [r for r in results if r['error'] is not None]
+    print('Summary of {}:'.format(description))
+    for r in results:
+        line = '  {}: {:.1f} s'.format(r['name'], r['wall_time'])
+        if 'returncode' in r:
+            line += ', exit code {}'.format(r['returncode'])
+        print(line)
+    print('{} of {} {} failed'.format(len(failed), len(results), description))
+    for r in failed:
+        print('  FAILED {}: {}'.format(r['name'], r['error']))
+        if r.get('log_path') is not None:
+            print('    log: {}'.format(r['log_path']))
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# Opt-in timing of the stages of the pipeline. Nothing is recorded unless
+# enable_tracing() is called, e.g. with --trace in the command line scripts.
+# with span('stage_name'): ...   times a stage
+# count('points', n)              adds to a counter
+# write_trace(path)               saves the spans and counters as json
+
+import os
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+_trace = {'enabled': False, 'pid': None, 'events': [], 'counters': Counter()}
+_lock = threading.Lock()
+
+
+def enable_tracing():
+    '''
+    starts recording spans and counters in this process
+    '''
+    _trace['enabled'] = True
+    _trace['pid'] = os.getpid()
+    _trace['events'] = []
+    _trace['counters'] = Counter()
+
+
+def is_tracing():
+    return _trace['enabled']
+
+
+@contextmanager
+def span(name, **args):
+    '''
+    records the start and duration of the code in the with block
+    param args: extra information saved with the span (e.g. the image name)
+    '''
+    if not _trace['enabled']:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        event = {'name': name,
+                 'start': start,
+                 'duration': time.time() - start,
+                 'pid': os.getpid(),
+                 'tid': threading.get_ident(),
+                 'args': args}
+        with _lock:
+            _trace['events'].append(event)
+
+
+def count(name, n=1):
+    '''
+    adds n to the counter name (e.g. points, files_read, subprocesses)
+    '''
+    if _trace['enabled']:
+        with _lock:
+            _trace['counters'][name] += n
+
+
+@contextmanager
+def worker_trace(tracing):
+    '''
+    used by functions that may run in a worker process: in the process that enabled
+    the tracing it does nothing, in other processes it records the spans of the with
+    block in the yielded dictionary, to be passed to merge_trace in the main process
+    param tracing: whether the main process is tracing
+    '''
+    if not tracing or (_trace['enabled'] and _trace['pid'] == os.getpid()):
+        yield None
+        return
+    enable_tracing()
+    collected = {}
+    try:
+        yield collected
+    finally:
+        collected['events'] = _trace['events']
+        collected['counters'] = dict(_trace['counters'])
+        _trace['enabled'] = False
+
+
+def merge_trace(collected):
+    '''
+    adds the spans and counters recorded by worker_trace in another process
+    '''
+    if collected is None or not _trace['enabled']:
+        return
+    with _lock:
+        _trace['events'] += collected['events']
+        _trace['counters'].update(collected['counters'])
+
+
+def get_stage_totals():
+    '''
+    returns: dictionary of span name to number of calls and total seconds
+    '''
+    totals = {}
+    for event in _trace['events']:
+        total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0})
+        total['calls'] += 1
+        total['seconds'] += event['duration']
+
+    return totals
+
+
+def write_trace(path, chrome=False):
+    '''
+    saves the recorded spans and counters as json
+    param chrome: use the Chrome trace event format (for chrome://tracing or Perfetto)
+    '''
+    events = sorted(_trace['events'], key=lambda e: e['start'])
+    t0 = events[0]['start'] if len(events) > 0 else time.time()
+    if chrome:
+        trace_events = [{'name': e['name'], 'ph': 'X', 'ts': (e['start'] - t0) * 1e6,
+                         'dur': e['duration'] * 1e6, 'pid': e['pid'], 'tid': e['tid'],
+                         'args': e['args']} for e in events]
+        end = max([e['start'] + e['duration'] for e in events], default=t0)
+        trace_events += [{'name': name, 'ph': 'C', 'ts': (end - t0) * 1e6,
+                          'pid': _trace['pid'], 'args': {name: value}}
+                         for name, value in _trace['counters'].items()]
+        output = {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+    else:
+        output = {'stages': get_stage_totals(),
+                  'counters': dict(_trace['counters']),
+                  'events': [dict(e, start=e['start'] - t0) for e in events]}
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=1, default=str)
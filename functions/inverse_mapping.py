@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# Maps points of the 3D atlas back to the histology of an animal: each point is assigned
+# to the closest slice (MoBIE plane), projected on it with the MoBIE view matrix, and the
+# elastix transformation of that slice is inverted numerically (Newton iterations on all
+# the points of the slice at once). Only numpy is needed.
+
+import sys
+import os
+import glob
+import numpy as np
+from functions import elastix_transform as et
+from functions.transform_functions import get_mobie_view_matrix
+from functions.transform_functions import read_elastix_parameters
+from functions.transform_functions import get_transformation_file_path
+
+# slices checked on each side of the position of a point along the slicing direction
+PLANE_CANDIDATES = 2
+# step (in pixels) of the finite differences used for the jacobian of the transformation
+JACOBIAN_STEP = 1e-3
+# stop the newton iterations when the error is smaller than this (in pixels of the ARA slice)
+INVERSION_TOLERANCE = 1e-3
+INVERSION_MAX_ITERATIONS = 20
+# points where the determinant of the jacobian is smaller than this are not inverted
+SINGULAR_DETERMINANT = 1e-10
+
+
+def load_slice_planes(animal_data_path, registration_suffix='_reg_output'):
+    '''
+    finds the registered slices of an animal (MoBIE .txt file and elastix output)
+    returns: list of slice names, array (n_slices x 4 x 4) of MoBIE view matrices (atlas
+        in um to view), and list of paths to the transformation files
+    '''
+    registration_folder = os.path.join(animal_data_path, 'ROIs', '000_Slices_for_ARA_registration')
+    names = []
+    matrices = []
+    transformation_files = []
+    for mobie_file in sorted(glob.glob(os.path.join(registration_folder, '*.txt'))):
+        name = os.path.splitext(os.path.basename(mobie_file))[0]
+        transformation_file = get_transformation_file_path(animal_data_path, name,
+                                                           registration_suffix)
+        if not os.path.isfile(transformation_file):
+            continue
+        names.append(name)
+        matrices.append(get_mobie_view_matrix(mobie_file, inverted=False))
+        transformation_files.append(transformation_file)
+
+    return names, np.array(matrices).reshape(-1, 4, 4), transformation_files
+
+
+def make_plane_index(matrices):
+    '''
+    Index of the slice planes along the slicing direction (mean normal of the planes),
+    so that the closest planes to a point are found with a binary search
+    param matrices: n_slices x 4 x 4 MoBIE view matrices (the plane of a slice is z = 0
+        in its view)
+    returns: dictionary with the normal, and the offsets of the planes along it (sorted)
+        and their order
+    '''
+    normals = matrices[:, 2, :3] / np.linalg.norm(matrices[:, 2, :3], axis=1)[:, None]
+    # all normals pointing to the same side (views of MoBIE can face either side)
+    signs = np.sign(normals @ normals[0])
+    normals *= signs[:, None]
+    normal = normals.mean(axis=0)
+    normal /= np.linalg.norm(normal)
+    # offset of the point of each plane closest to the origin of the atlas, along the
+    # flipped normals
+    plane_distances = -matrices[:, 2, 3] / np.linalg.norm(matrices[:, 2, :3], axis=1) * signs
+    offsets = (plane_distances[:, None] * normals) @ normal
+    order = np.argsort(offsets)
+
+    return {'normal': normal, 'offsets': offsets[order], 'order': order}
+
+
+def find_closest_planes(points, matrices, index, candidates=PLANE_CANDIDATES):
+    '''
+    param points: Nx3 array of positions in the atlas (um)
+    param matrices: n_slices x 4 x 4 MoBIE view matrices
+    param index: output of make_plane_index
+    param candidates: number of planes checked on each side of each point
+    returns: array with the closest slice of each point, and the distance (um) to its plane
+    '''
+    position = np.searchsorted(index['offsets'], points @ index['normal'])
+    n_slices = len(index['offsets'])
+    best_slice = np.full(len(points), -1)
+    best_distance = np.full(len(points), np.inf)
+    for shift in range(-candidates, candidates):
+        candidate = index['order'][np.clip(position + shift, 0, n_slices - 1)]
+        rows = matrices[candidate, 2]
+        distance = np.abs(np.einsum('ij,ij->i', rows[:, :3], points) + rows[:, 3])
+        distance /= np.linalg.norm(rows[:, :3], axis=1)
+        closer = distance < best_distance
+        best_slice[closer] = candidate[closer]
+        best_distance[closer] = distance[closer]
+
+    return best_slice, best_distance
+
+
+def get_affine_part(chain):
+    '''
+    returns: matrix A and vector b of the composition of the affine transformations of
+        a chain (p -> A p + b), ignoring the B-spline transformations
+    '''
+    matrix = np.eye(2)
+    shift = np.zeros(2)
+    for parameters in chain:
+        if parameters['Transform'][0] not in ['AffineTransform', 'TranslationTransform']:
+            continue
+        step_shift = et.apply_affine_transform(np.zeros((1, 2)), parameters)[0]
+        step_matrix = (et.apply_affine_transform(np.eye(2), parameters) - step_shift).T
+        matrix = step_matrix @ matrix
+        shift = step_matrix @ shift + step_shift
+
+    return matrix, shift
+
+
+def invert_transform_chain(targets, chain, tolerance=INVERSION_TOLERANCE,
+                           max_iterations=INVERSION_MAX_ITERATIONS):
+    '''
+    Finds the points of the fixed image (histology) that the chain of elastix
+    transformations maps to targets, with newton iterations started at the inverse
+    of the affine part of the chain
+    param targets: Nx2 array of positions in the moving image (ARA slice)
+    returns: Nx2 array of positions in the histology, and a boolean array of the points
+        that converged
+    '''
+    targets = np.asarray(targets, dtype='float64').reshape(-1, 2)
+    matrix, shift = get_affine_part(chain)
+    points = np.linalg.solve(matrix, (targets - shift).T).T
+    converged = np.zeros(len(points), dtype=bool)
+    active = np.arange(len(points))
+    # the last pass only checks the points updated in the last iteration
+    for iteration in range(max_iterations + 1):
+        current = points[active]
+        residual = et.transform_points_with_chain(current, chain) - targets[active]
+        done = np.linalg.norm(residual, axis=1) < tolerance
+        converged[active[done]] = True
+        active, current, residual = active[~done], current[~done], residual[~done]
+        if len(active) == 0 or iteration == max_iterations:
+            break
+        # jacobian by finite differences, one column per coordinate
+        jacobian = np.empty((len(active), 2, 2))
+        mapped = residual + targets[active]
+        for axis in range(2):
+            step = np.zeros(2)
+            step[axis] = JACOBIAN_STEP
+            jacobian[:, :, axis] = (et.transform_points_with_chain(current + step, chain) -
+                                    mapped) / JACOBIAN_STEP
+        # points where the transformation folds can not be inverted (they do not converge)
+        invertible = np.abs(np.linalg.det(jacobian)) > SINGULAR_DETERMINANT
+        active, current, residual = active[invertible], current[invertible], residual[invertible]
+        points[active] = current - np.linalg.solve(jacobian[invertible],
+                                                   residual[:, :, None])[:, :, 0]
+
+    return points, converged
+
+
+def ara_to_histology(points, animal_data_path, resolution=25, max_distance=None,
+                     registration_suffix='_reg_output'):
+    '''
+    Maps points of the 3D atlas to the histology of an animal (inverse of points_to_ARA)
+    param points: Nx3 array of x, y, z coordinates (in pixels) in the ARA
+    param animal_data_path: path to the data of the animal
+    param resolution: resolution in um/px of the ARA (e.g. 25)
+    param max_distance: points further than this (um) from every slice are not mapped
+    returns: dictionary with the name of the closest slice of each point ('' if not
+        mapped), the distance (um) to it, the Nx2 x, y position (in pixels) in the
+        registration image of that slice (nan if not mapped) and whether the inversion
+        of the transformation converged
+    '''
+    names, matrices, transformation_files = load_slice_planes(animal_data_path,
+                                                              registration_suffix)
+    assert len(names) > 0, 'no registered slices in {}'.format(animal_data_path)
+    points_um = np.asarray(points, dtype='float64').reshape(-1, 3) * int(resolution)
+
+    slice_of_points, distance = find_closest_planes(points_um, matrices, make_plane_index(matrices))
+    if max_distance is not None:
+        slice_of_points[distance > max_distance] = -1
+
+    histology = np.full((len(points_um), 2), np.nan)
+    converged = np.zeros(len(points_um), dtype=bool)
+    for slice_number in np.unique(slice_of_points[slice_of_points >= 0]):
+        positions = np.flatnonzero(slice_of_points == slice_number)
+        # position in the ARA slice (the view of MoBIE)
+        matrix = matrices[slice_number]
+        view = points_um[positions] @ matrix[:3, :3].T + matrix[:3, 3]
+        chain = et.load_transform_chain(transformation_files[slice_number], read_elastix_parameters)
+        histology[positions], converged[positions] = invert_transform_chain(view[:, :2], chain)
+
+    slice_names = np.array([''] + names)[slice_of_points + 1]
+
+    return {'slice': slice_names,
+            'distance': distance,
+            'histology': histology,
+            'converged': converged}
+
+
+if __name__ == '__main__':
+    # check input
+    if len(sys.argv) not in [3, 4]:
+        sys.exit('Arguments missing, please run like this:\
+            python -m functions.inverse_mapping path_to_animal points.npy optional:resolution_of_ARA')
+    # Nx3 array of ARA coordinates
+    ara_points = np.load(sys.argv[2])
+    mapped = ara_to_histology(ara_points, sys.argv[1],
+                              resolution=int(sys.argv[3]) if len(sys.argv) == 4 else 25)
+    output_path = os.path.splitext(sys.argv[2])[0] + '_histology.npz'
+    np.savez(output_path, **mapped)
+    print('{} of {} points mapped, saved in {}'.format(
+        np.sum(mapped['converged']), len(ara_points), output_path))
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# Writers for the ARA coordinates of the cells. All of them can be written in chunks:
+# call write() once for each chunk of the dataframe and close() at the end
+
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+COORDINATE_COLUMNS = ['x_coord_post', 'y_coord_post', 'z_coord_post']
+# size of the header of the .npy files, fixed so that it can be rewritten when closing
+NPY_HEADER_SIZE = 128
+
+
+def get_output_writer(output_format, file_base_path):
+    '''
+    param output_format: 'csv', 'parquet', 'feather' or 'npy'
+    param file_base_path: path of the output, without extension
+    returns: writer with the methods write(df) and close(), and the attribute path
+    '''
+    writers = {'csv': CSVWriter,
+               'parquet': ParquetWriter,
+               'feather': FeatherWriter,
+               'npy': NpyBundleWriter}
+    if output_format not in writers:
+        raise ValueError('Output format {} not supported'.format(output_format))
+
+    return writers[output_format](file_base_path)
+
+
+def _typed_columns(df, categories):
+    '''
+    types of the columns in the binary formats: float32 coordinates, int64 indexes, and
+    categorical text columns (e.g. cell_label)
+    param categories: dictionary of column to list of its categories, extended with the
+        new values of each chunk (so the codes of earlier chunks stay valid)
+    '''
+    df = df.copy()
+    for column in df.columns:
+        if column in COORDINATE_COLUMNS:
+            df[column] = df[column].astype('float32')
+        elif column == 'cell_index':
+            df[column] = df[column].astype('int64')
+        elif not pd.api.types.is_numeric_dtype(df[column].dtype):
+            column_categories = categories.setdefault(column, [])
+            values = np.asarray(df[column].values).astype(str)
+            known = set(column_categories)
+            column_categories += [v for v in pd.unique(values) if v not in known]
+            df[column] = pd.Categorical(values, categories=column_categories)
+
+    return df
+
+
+def _arrow_table(df, categories, schema=None):
+    # table of a chunk, with the schema of the first chunk
+    import pyarrow as pa
+    df = _typed_columns(df, categories)
+    if schema is None:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            # the same type of codes as the .npy files, whatever the number of categories
+            if pa.types.is_dictionary(field.type):
+                schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), pa.string())))
+
+    return pa.Table.from_pandas(df, preserve_index=False, schema=schema)
+
+
+class CSVWriter:
+    '''
+    writes a .csv file, as df.to_csv
+    '''
+    def __init__(self, file_base_path):
+        self.path = file_base_path + '.csv'
+        self.first_chunk = True
+
+    def write(self, df):
+        df.to_csv(self.path, index=False,
+                  mode='w' if self.first_chunk else 'a', header=self.first_chunk)
+        self.first_chunk = False
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    '''
+    writes a .parquet file, one row group per chunk (needs pyarrow)
+    '''
+    def __init__(self, file_base_path):
+        self.path = file_base_path + '.parquet'
+        self.writer = None
+        self.categories = {}
+
+    def write(self, df):
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            table = _arrow_table(df, self.categories)
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = _arrow_table(df, self.categories, self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class FeatherWriter:
+    '''
+    writes an uncompressed .feather (arrow IPC) file that can be memory-mapped,
+    one record batch per chunk (needs pyarrow). The categories of each chunk extend
+    those of the previous ones, written as dictionary deltas
+    '''
+    def __init__(self, file_base_path):
+        self.path = file_base_path + '.feather'
+        self.sink = None
+        self.writer = None
+        self.schema = None
+        self.categories = {}
+
+    def write(self, df):
+        import pyarrow as pa
+        if self.writer is None:
+            table = _arrow_table(df, self.categories)
+            self.sink = pa.OSFile(self.path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, table.schema,
+                                          options=pa.ipc.IpcWriteOptions(
+                                              emit_dictionary_deltas=True))
+            self.schema = table.schema
+        else:
+            table = _arrow_table(df, self.categories, self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.sink.close()
+
+
+class NpyBundleWriter:
+    '''
+    writes a folder of .npy files that can be opened with np.load(..., mmap_mode='r'):
+    coords.npy (Nx3 float32 x, y, z coordinates) and one file for every other column.
+    Numeric columns keep their type; other columns (e.g. text labels) are saved as
+    int32 codes (<column>_codes.npy) and their categories (<column>_categories.npy)
+    '''
+    def __init__(self, file_base_path):
+        self.path = file_base_path + '_npy'
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.files = {}
+        self.categories = {}
+
+    def _append(self, name, values):
+        values = np.ascontiguousarray(values)
+        if name not in self.files:
+            f = open(os.path.join(self.path, name + '.npy'), 'wb')
+            f.write(_npy_header(values.dtype, (0,) + values.shape[1:]))
+            self.files[name] = [f, values.dtype, values.shape[1:], 0]
+        f, dtype, row_shape, n_rows = self.files[name]
+        # the type of a file is fixed by the first chunk (e.g. floats are not truncated
+        # to the integers of the first chunk)
+        if not np.can_cast(values.dtype, dtype, casting='safe'):
+            raise ValueError('{} is {} in this chunk, but {} in the first chunk'.format(
+                name, values.dtype, dtype))
+        f.write(values.astype(dtype, copy=False).tobytes())
+        self.files[name][3] = n_rows + values.shape[0]
+
+    def write(self, df):
+        df = _typed_columns(df, self.categories)
+        self._append('coords', df[COORDINATE_COLUMNS].values)
+        for column in df.columns:
+            if column in COORDINATE_COLUMNS:
+                continue
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                self._append(column + '_codes', df[column].cat.codes.values.astype('int32'))
+            else:
+                self._append(column, df[column].values)
+
+    def close(self):
+        # write the final number of rows in the headers
+        for f, dtype, row_shape, n_rows in self.files.values():
+            f.seek(0)
+            f.write(_npy_header(dtype, (n_rows,) + row_shape))
+            f.close()
+        for column, categories in self.categories.items():
+            np.save(os.path.join(self.path, column + '_categories.npy'),
+                    np.array(categories, dtype=str))
+
+
+def _npy_header(dtype, shape):
+    # .npy version 1.0 header, padded to NPY_HEADER_SIZE bytes
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# Long-lived process that transforms batches of points, so that shell pipelines do not
+# start python for every slice. It reads one json request per line, from stdin or from
+# the connections to a unix socket, and writes one json response per line:
+#   {"transformation_file": ".../TransformParameters.1.txt", "points": [[x, y], ...],
+#    "mobie_file": ".../slice.txt" (optional), "resolution": 25, "engine": "numpy"}
+#   -> {"coords": [[x, y, z], ...]} (or [[x, y], ...] in the ARA slice without mobie_file)
+#   -> {"error": "..."} if the request failed
+# e.g. python -m functions.point_server < requests.jsonl > responses.jsonl
+# Only numpy is imported, and the parsed files are cached between requests.
+
+import argparse
+import contextlib
+import json
+import os
+import socketserver
+import sys
+import numpy as np
+from functions import elastix_transform as et
+from functions import displacement_field as dfield
+from functions import execution_backends as eb
+from functions.transform_functions import read_elastix_parameters
+from functions.transform_functions import set_disk_cache
+from functions.register_2D_to_2D import run_transformix_on_points
+from functions.register_2D_to_3D import register_2D_to_3D_affine_array
+
+
+def transform_request(request, engine='numpy', resolution=25):
+    '''
+    param request: dictionary with the transformation_file and the points (list of x, y),
+        and optionally the mobie_file, resolution and engine ('numpy', 'field' or 'transformix')
+    param engine, resolution: used when they are not in the request
+    returns: dictionary with the transformed coordinates, or the error
+    '''
+    try:
+        points = np.asarray(request['points'], dtype='float64').reshape(-1, 2)
+        transformation_file = request['transformation_file']
+        engine = request.get('engine', engine)
+        if not os.path.isfile(transformation_file):
+            return {'error': 'no transformation file {}'.format(transformation_file)}
+
+        if engine == 'transformix':
+            indexes = run_transformix_on_points(points, transformation_file)
+        elif engine in ['numpy', 'field']:
+            tolerance = dfield.FIELD_TOLERANCE if engine == 'field' else None
+            transformed, parameters = dfield.transform_points_with_field(
+                points, transformation_file, tolerance, read_elastix_parameters)
+            indexes = et.points_to_fixed_index(transformed, parameters)
+        else:
+            return {'error': 'engine {} not supported'.format(engine)}
+
+        if request.get('mobie_file') is None:
+            return {'coords': indexes.tolist()}
+        coords = register_2D_to_3D_affine_array(indexes, request.get('resolution', resolution),
+                                                request['mobie_file'])
+        return {'coords': coords.tolist()}
+    except Exception as e:
+        return {'error': repr(e)}
+
+
+def serve_lines(input_stream, output_stream, engine='numpy', resolution=25):
+    '''
+    answers every line of input_stream (a json request) with a line in output_stream
+    '''
+    for line in input_stream:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            response = transform_request(json.loads(line), engine, resolution)
+        except ValueError as e:
+            response = {'error': 'invalid request: {}'.format(e)}
+        output_stream.write(json.dumps(response) + '\n')
+        output_stream.flush()
+
+
+def serve_socket(socket_path, engine='numpy', resolution=25):
+    '''
+    answers the requests sent to a unix socket, one thread per connection
+    '''
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_lines((line.decode() for line in self.rfile), _SocketWriter(self.wfile),
+                        engine, resolution)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        print('Transforming points sent to {}'.format(socket_path), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+class _SocketWriter:
+    # text interface to the binary stream of a socket connection
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        self.wfile.write(text.encode())
+
+    def flush(self):
+        self.wfile.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Transform batches of points sent as json lines, e.g.\
+            python -m functions.point_server < requests.jsonl > responses.jsonl')
+    parser.add_argument('--socket', default=None,
+                        help='path of a unix socket to listen to, instead of stdin')
+    parser.add_argument('--engine', choices=['numpy', 'field', 'transformix'], default='numpy',
+                        help='engine used when the request does not give one')
+    parser.add_argument('--backend', choices=eb.BACKEND_NAMES, default=None,
+                        help='how transformix is run: the executable (local, the default), the\
+                            ITK-elastix python bindings (itk) or numpy, for tests (fake)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a transformix run is stopped')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='number of times a failed transformix run is repeated')
+    parser.add_argument('--resolution', type=int, default=25,
+                        help='resolution of the ARA in um/px, when the request does not give one')
+    parser.add_argument('--cache-dir', default=None,
+                        help='folder to keep parsed transformation files between runs')
+    args = parser.parse_args()
+
+    set_disk_cache(args.cache_dir)
+    eb.set_default_backend(args.backend, args.timeout, args.retries)
+    # stdout is only for the responses, other messages go to stderr
+    responses_stream = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.socket is None:
+            serve_lines(sys.stdin, responses_stream, args.engine, args.resolution)
+        else:
+            serve_socket(args.socket, args.engine, args.resolution)
@@ -1,8 +1,17 @@
 #!/usr/bin/python
 
 import sys
-from functions.general_functions import get_elastix_paths
+from functions.transform_functions import read_elastix_parameters
+from functions import execution_backends as eb
+from functions import elastix_transform as et
+from functions import displacement_field as dfield
+from functions import instrumentation as instr
 import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 
 def register_2D_to_2D_transformix(x_coordinates, y_coordinates, transformation_file):
@@ -24,51 +33,177 @@ def register_2D_to_2D_transformix(x_coordinates, y_coordinates, transformation_f
         print('run elastix on all images first')
         return None
 
-    # define paths
-    _, transformix_path = get_elastix_paths()
-    working_dir = os.path.dirname(transformation_file)
-    transformation_file_name = os.path.basename(transformation_file)
-    # file to generate
-    tr_input_file_name = 'inputpoints.txt'
-    tr_input_file_path = os.path.join(working_dir, tr_input_file_name)
-    # name of file generated by transformix
-    tr_output_file_name = 'outputpoints.txt'
-
-    # create the file of points that transformix needs
-    tif = open(tr_input_file_path, 'w')
-    tif.write('point\n')
-    tif.write('{}\n'.format(n_points))
-    for i in range(n_points):
-        tif.write('{} {}\n'.format(x_coordinates[i], y_coordinates[i]))
-    tif.close()
-
-    # run transformix
-    # Change directory and run local, otherwise elastix is shit
-    os.chdir(working_dir)
-    transform_command = '{0} -def {1} -out {2} -tp {3} > /dev/null'.format(
-        transformix_path,
-        tr_input_file_name,
-        '.',
-        transformation_file_name)
-
-    os.system(transform_command)
-
-    # parse the output
-    assert os.path.isfile(tr_output_file_name), 'attempted to run transformix on nothing...'
-    tof = open(tr_output_file_name, 'r')
-    transformed_points = []
-    lines = tof.readlines()
-    for line in lines:
-        part1 = line.split(';')[3]
-        part2 = part1.split(' ')
-        tr_x = int(part2[4])
-        tr_y = int(part2[5])
-        transformed_points.append(tuple([tr_x, tr_y]))
-    tof.close()
+    points = np.column_stack([np.asarray(x_coordinates, dtype='float64'),
+                              np.asarray(y_coordinates, dtype='float64')])
+    transformed_points = run_transformix_on_points(points, transformation_file)
+
+    return [tuple(p) for p in transformed_points.tolist()]
+
+
+def register_2D_to_2D_transformix_batch(jobs, n_workers=1, tmp_root=None):
+    '''
+    Runs transformix on the points of several images, each one in its own temporary
+    folder, so that several analyses of the same animal can run at the same time
+    param jobs: dictionary of image name to (Nx2 array of x, y coordinates, path to the
+        output of elastix)
+    param n_workers: maximum number of transformix processes running at the same time
+    param tmp_root: folder where the temporary folders are created
+        (by default, the folder of each transformation file)
+
+    returns: dictionary of image name to Nx2 array of x, y coordinates (in pixels) for
+        the ARA slice, or None if transformix failed for that image
+    '''
+    def run_job(name):
+        points, transformation_file = jobs[name]
+        if not os.path.isfile(transformation_file):
+            print('run elastix on all images first: {}'.format(name))
+            return None
+        try:
+            return run_transformix_on_points(points, transformation_file, tmp_root)
+        except (AssertionError, OSError, RuntimeError) as e:
+            print('transformix failed for {}: {}'.format(name, e))
+            return None
+
+    names = list(jobs.keys())
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(run_job, names))
+
+    return dict(zip(names, results))
+
+
+def run_transformix_on_points(points, transformation_file, tmp_root=None, backend=None):
+    '''
+    Runs transformix in a new temporary folder, with a copy of the transformation files
+    param points: Nx2 array of x, y coordinates (in pixels) of the image
+    param transformation_file: path to the output of elastix
+    param tmp_root: folder where the temporary folder is created (by default the folder
+        of the transformation file, which transformix can always read)
+    param backend: how transformix is run (see execution_backends.make_backend, by
+        default the local executable)
+    returns: Nx2 array with the OutputIndexFixed of transformix (a RuntimeError is raised
+        if transformix fails, with the path where its log is kept in tmp_root)
+    '''
+    if backend is None:
+        backend = eb.get_default_backend()
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    if tmp_root is None:
+        tmp_root = os.path.dirname(os.path.abspath(transformation_file))
+    working_dir = tempfile.mkdtemp(prefix='transformix_', dir=tmp_root)
+    try:
+        # copy the chain of transformations, pointing to the copies
+        transformation_file_name = copy_transform_chain(transformation_file, working_dir)
+
+        # create the file of points that transformix needs
+        with instr.span('transformix_write_points'):
+            with open(os.path.join(working_dir, 'inputpoints.txt'), 'w') as tif:
+                tif.write('point\n{}\n'.format(len(points)))
+                np.savetxt(tif, points, fmt='%.17g')
+
+        # run transformix (the end of its output is in the error if it fails)
+        with instr.span('transformix', points=len(points), backend=backend['name']):
+            run = eb.run_transformix(backend, 'inputpoints.txt', transformation_file_name,
+                                     working_dir)
+        if run['error'] is not None:
+            log_path = eb.keep_failed_log(run['log_path'], working_dir + '.failed.log')
+            raise RuntimeError('transformix failed: {} (log in {})'.format(run['error'],
+                                                                           log_path))
+
+        # parse the output
+        tr_output_file_path = os.path.join(working_dir, 'outputpoints.txt')
+        with instr.span('transformix_parse_points'):
+            transformed_points = et.read_transformix_output_points(tr_output_file_path,
+                                                                   'OutputIndexFixed')
+        assert len(transformed_points) == len(points), 'transformix did not transform all points'
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
 
     return transformed_points
 
 
+def copy_transform_chain(transformation_file, working_dir):
+    '''
+    copies a transformation file and its initial transformations to working_dir,
+    with the InitialTransformParametersFileName pointing to the copies
+    returns: name of the copy of transformation_file
+    '''
+    chain_paths = []
+    path = transformation_file
+    while path is not None:
+        chain_paths.insert(0, path)
+        path = et.get_initial_transform_path(read_elastix_parameters(path), path)
+
+    initial_name = 'NoInitialTransform'
+    for i, path in enumerate(chain_paths):
+        with open(path) as f:
+            text = f.read()
+        text = re.sub(r'\(InitialTransformParametersFileName "[^"]*"\)',
+                      '(InitialTransformParametersFileName "{}")'.format(initial_name), text)
+        initial_name = 'TransformParameters.{}.txt'.format(i)
+        with open(os.path.join(working_dir, initial_name), 'w') as f:
+            f.write(text)
+
+    return initial_name
+
+
+def register_2D_to_2D_numpy(x_coordinates, y_coordinates, transformation_file):
+    '''
+    Same as register_2D_to_2D_transformix, but the elastix transformation is evaluated
+    in this process with numpy instead of launching transformix
+    param x_coordinate: list of x coordinates (in pixels) of the image
+    param y_coordinate: list of y coordinates (in pixels) of the image
+    param transformation_file: path to the output of elastix
+
+    returns transformed_points: list of x, y coordinates (tuples) (in pixels), for the ARA slice
+    '''
+
+    # check that all the inputs are correct
+    assert isinstance(x_coordinates, list), 'please pass a list for the x coordinates'
+    assert isinstance(y_coordinates, list), 'please pass a list for the y coordinates'
+    assert len(x_coordinates) == len(y_coordinates), 'lists of different length'
+    # check that elastix has been run
+    if os.path.isfile(transformation_file) is False:
+        print('run elastix on all images first')
+        return None
+
+    points = np.column_stack([np.asarray(x_coordinates, dtype='float64'),
+                              np.asarray(y_coordinates, dtype='float64')])
+    chain = et.load_transform_chain(transformation_file, read_elastix_parameters)
+    # round to pixels like the OutputIndexFixed of transformix
+    indexes = et.points_to_fixed_index(et.transform_points_with_chain(points, chain), chain[-1])
+
+    return [tuple(i) for i in indexes.tolist()]
+
+
+def register_2D_to_2D_field(x_coordinates, y_coordinates, transformation_file,
+                            tolerance=dfield.FIELD_TOLERANCE):
+    '''
+    Same as register_2D_to_2D_numpy, but the points are interpolated in the displacement
+    field of the slice, which is made the first time and reused in later calls
+    param tolerance: maximum error (in pixels) of the field, slices with a larger error
+        are evaluated exactly (None to always evaluate exactly)
+
+    returns transformed_points: list of x, y coordinates (tuples) (in pixels), for the ARA slice
+    '''
+
+    # check that all the inputs are correct
+    assert isinstance(x_coordinates, list), 'please pass a list for the x coordinates'
+    assert isinstance(y_coordinates, list), 'please pass a list for the y coordinates'
+    assert len(x_coordinates) == len(y_coordinates), 'lists of different length'
+    # check that elastix has been run
+    if os.path.isfile(transformation_file) is False:
+        print('run elastix on all images first')
+        return None
+
+    points = np.column_stack([np.asarray(x_coordinates, dtype='float64'),
+                              np.asarray(y_coordinates, dtype='float64')])
+    transformed, parameters = dfield.transform_points_with_field(points, transformation_file,
+                                                                 tolerance, read_elastix_parameters)
+    # round to pixels like the OutputIndexFixed of transformix
+    indexes = et.points_to_fixed_index(transformed, parameters)
+
+    return [tuple(i) for i in indexes.tolist()]
+
+
 if __name__ == '__main__':
     # check input
     if len(sys.argv) != 4:
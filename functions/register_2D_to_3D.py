@@ -3,9 +3,8 @@
 
 import sys
 import numpy as np
-from functions.general_functions import transform_coordinate
-from functions.general_functions import parameters_to_matrix
-from functions.general_functions import read_mobie_text_output
+from functions.transform_functions import transform_coordinates
+from functions.transform_functions import get_mobie_view_matrix
 import os
 
 
@@ -30,34 +29,36 @@ def register_2D_to_3D_affine(x_coordinates, y_coordinates, res, textfile):
         print("I don't find the text file")
         return None
 
-    # initialize list to return
-    transformed_points_list = []
+    points = np.column_stack([np.asarray(x_coordinates, dtype='float64'),
+                              np.asarray(y_coordinates, dtype='float64')])
+    transformed_points = register_2D_to_3D_affine_array(points, res, textfile)
 
-    # get the view from bdv
-    bdv_view = read_mobie_text_output(textfile)
+    return [tuple(p) for p in transformed_points.tolist()]
 
-    # transform to matrix form and pad
-    trafo = parameters_to_matrix(bdv_view)
 
-    # calculate the inverse the matrix
-    trafo = np.linalg.inv(trafo)
+def register_2D_to_3D_affine_array(points, res, textfile):
+    '''
+    Same as register_2D_to_3D_affine, for numpy arrays
+    param points: Nx2 array of x, y coordinates (in pixels) of the image
+    param res: resolution in um/px of the ARA (e.g. 25)
+    param textfile: path to the output of the MoBIE position
+
+    returns: Nx3 array of x, y, z coordinates (in pixels), for the ARA Xum/px
+    '''
+    # get the view from bdv, in matrix form and inverted (cached)
+    trafo = get_mobie_view_matrix(textfile, inverted=True)
 
-    # points need to be in pixel coordinates
-    for i in range(n_points):
-        x_coordinate = x_coordinates[i]
-        y_coordinate = y_coordinates[i]
-        # append a 0 at the end
-        pos0 = [int(x_coordinate), int(y_coordinate), 0]
+    # points need to be in pixel coordinates, with a 0 at the end
+    points = np.trunc(np.asarray(points, dtype='float64').reshape(-1, 2))
+    pos0 = np.hstack([points, np.zeros((points.shape[0], 1))])
 
-        # transform
-        reg0 = transform_coordinate(pos0, trafo)
+    # transform
+    reg0 = transform_coordinates(pos0, trafo)
 
-        # convert from micrometers to pixels
-        resolution = int(res)
-        pixel_adjusted = [x / resolution for x in reg0]
-        transformed_points_list.append(tuple(pixel_adjusted))
+    # convert from micrometers to pixels
+    resolution = int(res)
 
-    return transformed_points_list
+    return reg0 / resolution
 
 
 if __name__ == '__main__':
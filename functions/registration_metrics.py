@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# Quality of the registrations: similarity between the histology and the registered
+# ARA screenshot (result.1.tiff), and statistics of the jacobian determinant of the
+# elastix transformation (values <= 0 mean that the deformation folds).
+# The metrics of the slices of a folder are kept in registration_metrics.csv, with a
+# column that flags the slices that are very different from the rest.
+
+import os
+import numpy as np
+import pandas as pd
+from functions import elastix_transform as et
+from functions import fast_registration as fr
+
+METRICS_TABLE_NAME = 'registration_metrics.csv'
+METRICS_COLUMNS = ['slice', 'output_folder', 'mutual_information', 'ncc',
+                   'jacobian_min', 'jacobian_max', 'jacobian_mean', 'jacobian_std',
+                   'jacobian_negative_fraction', 'wall_time', 'outlier']
+# spacing (in pixels of the histology) of the grid where the jacobian is evaluated
+JACOBIAN_GRID_STEP = 4
+MUTUAL_INFORMATION_BINS = 32
+# slices with a robust z-score of the similarity below this are flagged as outliers
+OUTLIER_Z_SCORE = -3
+
+
+def normalized_cross_correlation(fixed, moving, mask=None):
+    '''
+    returns: normalized cross correlation of two images (of the pixels in mask)
+    '''
+    if mask is None:
+        mask = np.ones(fixed.shape, dtype=bool)
+    if not np.any(mask):
+        return np.nan
+    a = fixed[mask].astype('float64')
+    b = moving[mask].astype('float64')
+    a -= a.mean()
+    b -= b.mean()
+    norm = np.sqrt(np.sum(a * a) * np.sum(b * b))
+
+    return float(np.sum(a * b) / norm) if norm > 0 else np.nan
+
+
+def mutual_information(fixed, moving, mask=None, bins=MUTUAL_INFORMATION_BINS):
+    '''
+    returns: mutual information (in nats) of the intensities of two images, from their
+        joint histogram (of the pixels in mask)
+    '''
+    if mask is None:
+        mask = np.ones(fixed.shape, dtype=bool)
+    if not np.any(mask):
+        return np.nan
+    joint, _, _ = np.histogram2d(fixed[mask].ravel(), moving[mask].ravel(), bins=bins)
+    joint /= joint.sum()
+    marginals = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+    nonzero = joint > 0
+
+    return float(np.sum(joint[nonzero] * np.log(joint[nonzero] / marginals[nonzero])))
+
+
+def jacobian_determinant_statistics(transformation_file, step=JACOBIAN_GRID_STEP):
+    '''
+    evaluates the transformation on a grid over the fixed image and computes the
+    determinant of its jacobian by finite differences
+    returns: dictionary with the min, max, mean and std of the determinant and the
+        fraction of the grid where it is <= 0
+    '''
+    chain = et.load_transform_chain(transformation_file)
+    size = np.asarray(chain[-1]['Size'], dtype=int)
+    xs = np.arange(0, size[0], step, dtype='float64')
+    ys = np.arange(0, size[1], step, dtype='float64')
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    points = np.column_stack([grid_x.ravel(), grid_y.ravel()])
+    mapped = et.transform_points_with_chain(points, chain).reshape(len(ys), len(xs), 2)
+
+    # derivatives of the mapped x and y along the x and y of the grid
+    if len(xs) < 2 or len(ys) < 2:
+        return {'jacobian_' + key: np.nan for key in ['min', 'max', 'mean', 'std',
+                                                     'negative_fraction']}
+    dx_dy, dx_dx = np.gradient(mapped[:, :, 0], ys, xs)
+    dy_dy, dy_dx = np.gradient(mapped[:, :, 1], ys, xs)
+    determinant = dx_dx * dy_dy - dx_dy * dy_dx
+
+    return {'jacobian_min': float(determinant.min()),
+            'jacobian_max': float(determinant.max()),
+            'jacobian_mean': float(determinant.mean()),
+            'jacobian_std': float(determinant.std()),
+            'jacobian_negative_fraction': float(np.mean(determinant <= 0))}
+
+
+def compute_registration_metrics(outdir_path, hist_path):
+    '''
+    Similarity of the histology and the registered ARA (in the pixels covered by the
+    ARA), and jacobian of the transformation. The jacobian maps pixels of the histology
+    to pixels of the ARA screenshot, so for the fast profile it includes the downsampling
+    param outdir_path: output folder of elastix
+    param hist_path: histology used as fixed image (the downsampled histology of the
+        fast profile is used if it is in the output folder)
+    returns: dictionary with the metrics (nan for those that can not be computed)
+    '''
+    metrics = {'mutual_information': np.nan, 'ncc': np.nan}
+    metrics.update(jacobian_determinant_statistics(
+        os.path.join(outdir_path, 'TransformParameters.1.txt')))
+
+    downsampled_path = os.path.join(outdir_path, fr.DOWNSAMPLED_HISTOLOGY_NAME)
+    if os.path.isfile(downsampled_path):
+        hist_path = downsampled_path
+    try:
+        fixed = np.squeeze(fr.read_image(hist_path))
+        moving = np.squeeze(fr.read_image(os.path.join(outdir_path, 'result.1.tiff')))
+    except (ImportError, OSError, ValueError) as e:
+        print('Similarity of {} not computed: {}'.format(os.path.basename(outdir_path), e))
+        return metrics
+    if fixed.shape != moving.shape:
+        print('Similarity of {} not computed: images of different size'.format(
+            os.path.basename(outdir_path)))
+        return metrics
+    # only where the ARA covers the histology (elastix fills the rest with 0)
+    mask = moving != 0
+    metrics['mutual_information'] = mutual_information(fixed, moving, mask)
+    metrics['ncc'] = normalized_cross_correlation(fixed, moving, mask)
+
+    return metrics
+
+
+def flag_outliers(table):
+    '''
+    flags the slices whose similarity (mutual information or ncc) is much lower than
+    that of the rest of the slices registered with the same profile (robust z-score
+    below OUTLIER_Z_SCORE), or whose transformation folds.
+    The profile of a slice is the suffix of its output folder (e.g. _reg_output_fast)
+    '''
+    outlier = table['jacobian_negative_fraction'].fillna(0).values > 0
+    profiles = np.array([folder[len(name):] if folder.startswith(name) else folder
+                         for name, folder in zip(table['slice'].astype(str),
+                                                 table['output_folder'].astype(str))])
+    for profile in np.unique(profiles):
+        rows = profiles == profile
+        for column in ['mutual_information', 'ncc']:
+            values = table[column].values[rows].astype('float64')
+            if np.all(np.isnan(values)):
+                continue
+            median = np.nanmedian(values)
+            # median absolute deviation, scaled to the standard deviation of a normal
+            # distribution
+            mad = np.nanmedian(np.abs(values - median)) * 1.4826
+            if mad > 0:
+                outlier[rows] |= (values - median) / mad < OUTLIER_Z_SCORE
+    table['outlier'] = outlier
+
+    return table
+
+
+def update_metrics_table(folder_path, rows):
+    '''
+    adds (or replaces) the metrics of some slices in the registration_metrics.csv of
+    a folder, and flags the outliers again
+    param rows: list of dictionaries with the METRICS_COLUMNS (except outlier)
+    returns: the table
+    '''
+    table_path = os.path.join(folder_path, METRICS_TABLE_NAME)
+    new_table = pd.DataFrame(rows, columns=METRICS_COLUMNS[:-1])
+    if os.path.isfile(table_path):
+        table = pd.read_csv(table_path)
+        replaced = table.set_index(['slice', 'output_folder']).index.isin(
+            new_table.set_index(['slice', 'output_folder']).index)
+        table = pd.concat([table[~replaced][METRICS_COLUMNS[:-1]], new_table],
+                          ignore_index=True)
+    else:
+        table = new_table
+    table = flag_outliers(table.sort_values(['output_folder', 'slice'], ignore_index=True))
+
+    # write to a temporary file first, so that an interrupted run does not break the table
+    tmp_path = '{}.{}.tmp'.format(table_path, os.getpid())
+    table.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, table_path)
+
+    return table
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Queue of registration jobs stored in a SQLite file, so that a run over many
+# animals can be interrupted and resumed. Jobs are dictionaries generated by
+# get_registration_jobs (folder_register_ARA_to_histology.py), stored as json.
+# States: pending -> running -> done or failed (failed jobs are retried while
+# they have attempts left)
+
+import json
+import os
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+QUEUE_NAME = 'registration_queue.sqlite'
+
+
+def open_queue(queue_path):
+    '''
+    opens (or creates) the queue, and puts back to pending the jobs that were
+    running when a previous run was interrupted
+    returns: sqlite3 connection
+    '''
+    connection = sqlite3.connect(queue_path)
+    connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              outdir_path TEXT PRIMARY KEY,
+                              name TEXT,
+                              animal TEXT,
+                              job TEXT,
+                              priority INTEGER DEFAULT 0,
+                              state TEXT DEFAULT 'pending',
+                              attempts INTEGER DEFAULT 0,
+                              error TEXT,
+                              wall_time REAL,
+                              updated REAL)''')
+    with connection:
+        connection.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+
+    return connection
+
+
+def read_job_states(queue_path):
+    '''
+    reads the queue without modifying it (or creating it, if it does not exist)
+    returns: dictionary of outdir_path to (state, attempts)
+    '''
+    if not os.path.isfile(queue_path):
+        return {}
+    connection = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(queue_path))),
+                                 uri=True)
+    try:
+        rows = connection.execute('SELECT outdir_path, state, attempts FROM jobs').fetchall()
+    finally:
+        connection.close()
+
+    return {outdir_path: (state, attempts) for outdir_path, state, attempts in rows}
+
+
+def add_jobs(connection, jobs, animal, priority=0):
+    '''
+    adds the jobs of an animal to the queue, as pending. Jobs already in the queue
+    keep their state and number of attempts, unless they were done (their inputs
+    changed, so they are registered again)
+    '''
+    with connection:
+        for job in jobs:
+            connection.execute('''INSERT INTO jobs (outdir_path, name, animal, job, priority, updated)
+                                  VALUES (?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT(outdir_path) DO UPDATE SET
+                                      job = excluded.job,
+                                      priority = excluded.priority,
+                                      attempts = CASE WHEN state = 'done' THEN 0 ELSE attempts END,
+                                      state = CASE WHEN state = 'done' THEN 'pending' ELSE state END,
+                                      updated = excluded.updated''',
+                               (job['outdir_path'], job['name'], animal, json.dumps(job),
+                                priority, time.time()))
+
+
+def mark_up_to_date(connection, animal, outdir_paths):
+    '''
+    marks as done the unfinished jobs of an animal that are not in outdir_paths
+    (registered since they were queued, e.g. by another run)
+    '''
+    rows = connection.execute("SELECT outdir_path FROM jobs WHERE animal = ? AND state != 'done'",
+                              (animal,)).fetchall()
+    with connection:
+        for (outdir_path,) in rows:
+            if outdir_path not in outdir_paths:
+                set_job_state(connection, outdir_path, 'done')
+
+
+def retry_failed_jobs(connection):
+    '''
+    puts back to pending all the failed jobs, with no attempts used
+    '''
+    with connection:
+        connection.execute("UPDATE jobs SET state = 'pending', attempts = 0 WHERE state = 'failed'")
+
+
+def claim_next_job(connection, max_attempts):
+    '''
+    marks as running the pending job with the highest priority (or a failed job with
+    attempts left)
+    returns: the job dictionary, or None if there are no jobs left
+    '''
+    row = connection.execute('''SELECT outdir_path, job FROM jobs
+                                WHERE state = 'pending' OR (state = 'failed' AND attempts < ?)
+                                ORDER BY priority DESC, animal, name LIMIT 1''',
+                             (max_attempts,)).fetchone()
+    if row is None:
+        return None
+    with connection:
+        connection.execute('''UPDATE jobs SET state = 'running', attempts = attempts + 1,
+                              updated = ? WHERE outdir_path = ?''', (time.time(), row[0]))
+
+    return json.loads(row[1])
+
+
+def set_job_state(connection, outdir_path, state, error=None, wall_time=None):
+    with connection:
+        connection.execute('''UPDATE jobs SET state = ?, error = ?, wall_time = ?, updated = ?
+                              WHERE outdir_path = ?''',
+                           (state, error, wall_time, time.time(), outdir_path))
+
+
+def get_queue_counts(connection):
+    '''
+    returns: dictionary of state to number of jobs
+    '''
+    return dict(connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+def get_jobs(connection, states):
+    '''
+    returns: list of (animal, name, priority, state, attempts, error) of the jobs in those states
+    '''
+    query = '''SELECT animal, name, priority, state, attempts, error FROM jobs
+               WHERE state IN ({}) ORDER BY priority DESC, animal, name'''.format(
+        ', '.join('?' * len(states)))
+
+    return connection.execute(query, list(states)).fetchall()
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# Helpers of the transformation of points that only need numpy (no pandas), so that
+# the transformation scripts start fast. They are also available from general_functions
+
+import numpy as np
+import os
+import hashlib
+import glob
+import shutil
+import threading
+import zipfile
+from collections import OrderedDict
+from functions.elastix_transform import read_elastix_parameter_file
+from functions import instrumentation as instr
+
+# parsed files kept in memory, keyed by kind of file, path, modification time and size.
+# Use _get_parsed_file and _add_parsed_file, they hold the lock (the point server and
+# the thread executor read files from several threads)
+_parsed_files_cache = OrderedDict()
+_parsed_files_cache_lock = threading.Lock()
+PARSED_FILES_CACHE_SIZE = 512
+# optional folder where parsed files are stored between runs (see set_disk_cache)
+_disk_cache = {'cache_dir': None, 'max_entries': 4096}
+# start of the names of the files of the disk cache (only these files are evicted)
+DISK_CACHE_PREFIX = 'parsecache_'
+
+
+def parameters_to_matrix(trafo):
+    # function from https://github.com/constantinpape/elf
+    """ Parameter vector to affine matrix.
+    Assumes parameter vector layed out as
+    2d:
+        [a00, a01, a02, a10, a11, a12]
+    3d:
+        [a00, a01, a02, a03, a10, a11, a12, a13, a20, a21, a22, a23]
+    """
+    if len(trafo) == 12:
+        sub_matrix = np.zeros((3, 3), dtype='float64')
+        sub_matrix[0, 0] = trafo[0]
+        sub_matrix[0, 1] = trafo[1]
+        sub_matrix[0, 2] = trafo[2]
+
+        sub_matrix[1, 0] = trafo[4]
+        sub_matrix[1, 1] = trafo[5]
+        sub_matrix[1, 2] = trafo[6]
+
+        sub_matrix[2, 0] = trafo[8]
+        sub_matrix[2, 1] = trafo[9]
+        sub_matrix[2, 2] = trafo[10]
+
+        shift = [trafo[3], trafo[7], trafo[11]]
+
+        matrix = np.zeros((4, 4))
+        matrix[:3, :3] = sub_matrix
+        matrix[:3, 3] = shift
+        matrix[3, 3] = 1
+
+    elif len(trafo) == 6:
+        sub_matrix = np.zeros((2, 2), dtype='float64')
+        sub_matrix[0, 0] = trafo[0]
+        sub_matrix[0, 1] = trafo[1]
+
+        sub_matrix[1, 0] = trafo[3]
+        sub_matrix[1, 1] = trafo[4]
+
+        shift = [trafo[2], trafo[5]]
+
+        matrix = np.zeros((3, 3))
+        matrix[:2, :2] = sub_matrix
+        matrix[:2, 2] = shift
+        matrix[2, 2] = 1
+
+    else:
+        raise ValueError(f"Invalid number of parameters {len(trafo)}")
+
+    return matrix
+
+
+def transform_coordinate(coord, matrix):
+    # function from https://github.com/constantinpape/elf
+    # x = matrix[0, 0] * coord[0] + matrix[0, 1] * coord[1] + matrix[0, 2] * coord[2] + matrix[0, 3]
+    # y = matrix[1, 0] * coord[0] + matrix[1, 1] * coord[1] + matrix[1, 2] * coord[2] + matrix[1, 3]
+    # z = matrix[2, 0] * coord[0] + matrix[2, 1] * coord[1] + matrix[2, 2] * coord[2] + matrix[2, 3]
+    ndim = len(coord)
+    return tuple(sum(coord[jj] * matrix[ii, jj] for jj in range(ndim)) + matrix[ii, -1] for ii in range(ndim))
+
+
+def transform_coordinates(coords, matrix):
+    '''
+    batched version of transform_coordinate
+    param coords: Nxd array of coordinates
+    param matrix: (d+1)x(d+1) affine matrix (output of parameters_to_matrix)
+    returns: Nxd array of transformed coordinates
+    '''
+    coords = np.asarray(coords, dtype='float64')
+    # pad to homogeneous coordinates and apply the matrix in one go
+    padded = np.hstack([coords, np.ones((coords.shape[0], 1))])
+    return (padded @ matrix.T)[:, :-1]
+
+
+def read_mobie_text_output(filepath):
+    # reads the bdv from a .txt file of the MoBIE output
+    with open(filepath) as fp:
+        for i, line in enumerate(fp):
+            if i == 3:
+                view = line.strip()
+                break
+    pview = np.array(view.split(','))
+    pview = [float(i) for i in pview]
+
+    return pview
+
+
+def get_elastix_paths():
+    '''
+    returns: paths to the elastix and transformix executables. For each one, the
+        environment variable ELASTIX_PATH (or TRANSFORMIX_PATH) is used if it is set,
+        then the path in custom_paths_to_elastix.txt if it exists, and then the
+        executable found in the PATH
+    '''
+    # this is where the file is supposed to be (unless another one is given in ELASTIX_PATHS_FILE):
+    infofile_path = os.environ.get('ELASTIX_PATHS_FILE',
+                                   os.path.abspath(__file__ + "/../../custom_paths_to_elastix.txt"))
+    paths = {}
+    if os.path.isfile(infofile_path):
+        paths = cached_parse(infofile_path, _parse_elastix_paths, 'elastix_paths')
+        paths = {key: str(value) for key, value in paths.items()}
+    for program in ['elastix', 'transformix']:
+        key = program + '_path'
+        if os.environ.get(program.upper() + '_PATH'):
+            paths[key] = os.environ[program.upper() + '_PATH']
+        elif not os.path.isfile(paths.get(key, '')):
+            # e.g. the windows path of the file on another machine
+            paths[key] = shutil.which(program) or paths.get(key) or program
+
+    return(paths['elastix_path'], paths['transformix_path'])
+
+
+def _parse_elastix_paths(infofile_path):
+    ep = ''
+    tp = ''
+    file = open(infofile_path)
+    lines = file.readlines()
+    for line in lines:
+        if line.startswith('elastix_path = '):
+            ep = line.split('elastix_path = ')[1].strip()
+        if line.startswith('transformix_path = '):
+            tp = line.split('transformix_path = ')[1].strip()
+    file.close()
+
+    return {'elastix_path': np.array(ep), 'transformix_path': np.array(tp)}
+
+
+def get_mobie_view_matrix(filepath, inverted=True):
+    '''
+    param filepath: .txt file of the MoBIE output
+    param inverted: return the inverse of the view matrix (the one that maps the
+        ARA slice to the 3D atlas)
+    returns: 4x4 affine matrix of the MoBIE view
+    '''
+    matrices = cached_parse(filepath, _parse_mobie_view_matrix, 'mobie_view')
+
+    return matrices['inverse'] if inverted else matrices['matrix']
+
+
+def _parse_mobie_view_matrix(filepath):
+    matrix = parameters_to_matrix(read_mobie_text_output(filepath))
+    return {'matrix': matrix, 'inverse': np.linalg.inv(matrix)}
+
+
+def read_elastix_parameters(filepath):
+    '''
+    cached version of elastix_transform.read_elastix_parameter_file
+    returns: dictionary of parameter name to numpy array of values
+    '''
+    return dict(cached_parse(filepath, _parse_elastix_parameters, 'elastix_parameters'))
+
+
+def _parse_elastix_parameters(filepath):
+    parameters = read_elastix_parameter_file(filepath)
+    return {name: np.asarray(values) for name, values in parameters.items()}
+
+
+def set_disk_cache(cache_dir, max_entries=4096):
+    '''
+    stores the parsed files in cache_dir (as parsecache_*.npz files) so that they last
+    between runs. The least recently used of these files are removed when there are more
+    than max_entries (other files in cache_dir are not touched).
+    Use cache_dir=None to disable it
+    '''
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    _disk_cache['cache_dir'] = cache_dir
+    _disk_cache['max_entries'] = max_entries
+
+
+def cached_parse(filepath, parser, kind):
+    '''
+    parses a file only if it has changed since the last time it was parsed
+    param filepath: path to the file
+    param parser: function that reads the file and returns a dictionary of numpy arrays
+    param kind: name of the type of file (part of the key of the cache)
+    returns: the dictionary generated by parser (do not modify it)
+    '''
+    path = os.path.abspath(filepath)
+    file_stat = os.stat(path)
+    key = (kind, path, file_stat.st_mtime_ns, file_stat.st_size)
+
+    # look in memory
+    value = _get_parsed_file(key)
+    if value is not None:
+        instr.count('cache_hits')
+        return value
+
+    # look on disk, otherwise parse the file
+    cache_dir = _disk_cache['cache_dir']
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, DISK_CACHE_PREFIX
+                                  + hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                value = {name: data[name] for name in data.files}
+            # mark as recently used
+            os.utime(cache_file)
+            instr.count('cache_hits')
+        except FileNotFoundError:
+            # not in the cache, or evicted by another thread or process
+            value = None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # broken file (e.g. from an interrupted run), it is made again
+            value = None
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+    if value is None:
+        value = parser(path)
+        instr.count('files_read')
+        if cache_dir is not None:
+            _write_disk_cache_file(cache_file, value)
+
+    _add_parsed_file(key, value)
+
+    return value
+
+
+def _get_parsed_file(key):
+    # returns: the parsed file in memory (marked as recently used), or None
+    with _parsed_files_cache_lock:
+        value = _parsed_files_cache.get(key)
+        if value is not None:
+            _parsed_files_cache.move_to_end(key)
+    return value
+
+
+def _add_parsed_file(key, value):
+    # keeps a parsed file in memory, removing the least recently used one if it is full
+    with _parsed_files_cache_lock:
+        _parsed_files_cache[key] = value
+        if len(_parsed_files_cache) > PARSED_FILES_CACHE_SIZE:
+            _parsed_files_cache.popitem(last=False)
+
+
+def _write_disk_cache_file(cache_file, value, evict=True):
+    # write to a temporary file first, so other processes or threads never read half a file
+    tmp_file = '{}.{}.{}.tmp'.format(cache_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **value)
+    os.replace(tmp_file, cache_file)
+    if not evict:
+        return
+
+    # remove the least recently used files
+    cache_files = glob.glob(os.path.join(os.path.dirname(cache_file),
+                                         DISK_CACHE_PREFIX + '*.npz'))
+    n_extra = len(cache_files) - _disk_cache['max_entries']
+    if n_extra > 0:
+        try:
+            cache_files.sort(key=os.path.getmtime)
+        except OSError:
+            # another thread or process is evicting them
+            return
+        for old_file in cache_files[:n_extra]:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+
+def get_transformation_file_path(general_path, image_name, output_suffix='_reg_output'):
+    '''
+    generates the path to the file with the elastix transformation
+    output_suffix is the suffix of the output folder (_reg_output_fast for the fast profile)
+    '''
+    registration_file_path = 'ROIs/000_Slices_for_ARA_registration/'
+    out_path = os.path.join(general_path,
+                            registration_file_path,
+                            image_name + output_suffix,
+                            'TransformParameters.1.txt')
+
+    return out_path
+
+
+def get_mobie_file_path(general_path, image_name):
+    '''
+    generates the path to the file with the mobie position
+    '''
+    registration_file_path = 'ROIs/000_Slices_for_ARA_registration/'
+    out_path = os.path.join(general_path,
+                            registration_file_path,
+                            image_name + '.txt')
+
+    return out_path
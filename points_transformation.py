@@ -3,95 +3,317 @@
 # Second, calling register_2D_to_3D.py
 
 from functions.register_2D_to_2D import register_2D_to_2D_transformix
-from functions.register_2D_to_3D import register_2D_to_3D_affine
+from functions.register_2D_to_2D import register_2D_to_2D_numpy
+from functions.register_2D_to_2D import register_2D_to_2D_field
+from functions.displacement_field import FIELD_TOLERANCE
+from functions.register_2D_to_3D import register_2D_to_3D_affine_array
 import functions.general_functions as gf
-import sys
+from functions.output_writers import get_output_writer
+from functions import atlas_annotation as atlas
+from functions import instrumentation as instr
+from functions import execution_backends as eb
+import argparse
+import cProfile
 import os
-import pandas as pd
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 
+# columns of the input dataframe needed for the transformation
+INPUT_COLUMNS = ['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice', 'Side', 'AP',
+                 'manual_roi_name', 'ROI', 'Center_X', 'Center_Y', 'cell_label']
+# columns that identify the registration image of a cell
+REG_IMAGE_COLUMNS = ['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice']
+OUTPUT_COLUMNS = ['x_coord_post', 'y_coord_post', 'z_coord_post', 'cell_label', 'cell_index']
 
-def points_to_ARA(path_to_dataframe, resolution=25):
+
+def points_to_ARA(path_to_dataframe, resolution=25, point_engine='transformix',
+                  n_workers=1, executor='process', cache_dir=None,
+                  memory_budget=None, data_path=None, output_format='csv',
+                  field_tolerance=FIELD_TOLERANCE, registration_suffix='_reg_output',
+                  annotation_path=None, structures_path=None, rollup_depths=()):
     '''
     This script transforms points (outputs from Inmuno_4channels_analysis.ipynb in
     CellProfiler_AnalysisPipelines) to the 3D atlas in two steps
 
-    param path_to_dataframe: absolute path to the dataframe
+    param path_to_dataframe: absolute path to the dataframe (.pkl, .parquet or .feather)
     param resolution: resolution of ARA in um/px
-    returns: nothing, it saves a .csv file in the same directory as the input
+    param point_engine: 'transformix' to call transformix, 'numpy' to evaluate
+        the elastix transformation in this process, or 'field' to interpolate a
+        displacement field saved next to the transformation of each slice
+    param n_workers: number of images to transform at the same time
+    param executor: 'process' or 'thread' pool used when n_workers > 1
+    param cache_dir: folder where parsed transformation and MoBIE files are kept
+        between runs (optional)
+    param memory_budget: if given (in bytes), the dataframe is processed and saved in
+        chunks of rows that fit in this budget (streaming mode). The cells of an image
+        are kept in the same chunk, so they should be stored next to each other
+    param data_path: path to the images, if it is not in the attributes of the dataframe
+    param output_format: 'csv', 'parquet', 'feather' or 'npy' (folder of .npy files)
+    param field_tolerance: maximum error (in pixels) of the displacement fields, slices
+        with a larger error are evaluated exactly (None or 0 to always evaluate exactly,
+        without making the fields)
+    param registration_suffix: suffix of the folders with the elastix output
+        ('_reg_output_fast' for the fast registration profile)
+    param annotation_path: annotation volume of the ARA at this resolution (.npy or raw
+        .nrrd), to add the region of each cell (optional)
+    param structures_path: table of the brain structures (.csv), to add the acronyms of
+        the regions and their roll-ups (optional)
+    param rollup_depths: levels of the hierarchy of structures of the roll-ups
+    returns: nothing, it saves the coordinates in the same directory as the input
     '''
     # check that file exists
     assert os.path.isfile(path_to_dataframe), 'file does not exist'
+    gf.set_disk_cache(cache_dir)
+
+    # atlas annotation, memory-mapped
+    annotation = None
+    structures = None
+    if annotation_path is not None:
+        assert os.path.isfile(annotation_path), 'annotation volume does not exist'
+        assert structures_path is not None or len(rollup_depths) == 0, \
+            'the roll-ups need the table of structures'
+        annotation = atlas.open_annotation_volume(annotation_path)
+        if structures_path is not None:
+            structures = atlas.read_structure_table(structures_path)
 
     # read input from the notebook
-    df = pd.read_pickle(path_to_dataframe)
     print('Transforming points in {}'.format(os.path.basename(path_to_dataframe)))
+    if memory_budget is None:
+        df = gf.read_dataframe(path_to_dataframe)
+        chunks = [df]
+    else:
+        # the cells of an image are kept in the same chunk, so that it is transformed once
+        chunks = gf.keep_groups_together(
+            gf.read_dataframe_chunks(path_to_dataframe, memory_budget, INPUT_COLUMNS),
+            REG_IMAGE_COLUMNS)
+
+    # output file
+    outpath = os.path.dirname(path_to_dataframe)
+    fbasename = os.path.splitext(os.path.basename(path_to_dataframe))[0]
+    writer = get_output_writer(output_format,
+                               os.path.join(outpath, '_'.join([fbasename, 'ARA_coordinates'])))
+
+    pool = None
+    if n_workers > 1:
+        pool_class = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}[executor]
+        pool = pool_class(max_workers=n_workers)
+
+    results = []
+    chunks = iter(chunks)
+    while True:
+        with instr.span('read_input'):
+            df = next(chunks, None)
+        if df is None:
+            break
+        instr.count('points', len(df))
+        # get the path to the images
+        if data_path is None:
+            data_path = df.attrs['datapath']
+        df_tr, chunk_results = transform_dataframe(df, data_path, resolution, point_engine,
+                                                   pool, cache_dir, field_tolerance,
+                                                   registration_suffix)
+        results += chunk_results
+        if annotation is not None:
+            with instr.span('annotate_cells', rows=len(df_tr)):
+                df_tr = atlas.annotate_cells(df_tr, annotation, structures, rollup_depths)
+        # save output, appending chunks
+        with instr.span('write_output', rows=len(df_tr)):
+            writer.write(df_tr)
+        del df, df_tr
+    with instr.span('write_output'):
+        writer.close()
 
-    # get the path to the images
-    data_path = df.attrs['datapath']
+    if pool is not None:
+        pool.shutdown()
 
+    gf.print_run_summary(results, 'images')
+
+
+def transform_dataframe(df, data_path, resolution=25, point_engine='transformix',
+                        pool=None, cache_dir=None, field_tolerance=FIELD_TOLERANCE,
+                        registration_suffix='_reg_output'):
+    '''
+    Transforms the cells of a dataframe to the 3D atlas
+    param pool: executor in which the images are transformed (optional)
+    returns: dataframe with the OUTPUT_COLUMNS, and the list of results of each image
+    '''
     # get the registration image core name for every row
-    df['reg_im_corename'] = df.apply(gf.make_reg_core_name_from_series, axis=1)
+    with instr.span('core_names'):
+        df['reg_im_corename'] = gf.make_reg_core_names(df)
 
     # get the positions of the cells in the downsample image (the one used for registration)
-    df_tr = gf.get_prereg_coordinates(df, data_path)
-
-    # create three columns to hold data
-    df_tr['x_coord_post'] = np.nan
-    df_tr['y_coord_post'] = np.nan
-    df_tr['z_coord_post'] = np.nan
-
-    # for each image
-    ind_images = df_tr.reg_im_corename.unique()
-    # iterate over each manually draw roi
-    for imname in ind_images:
-        print('Registering cells on {}'.format(imname))
-        # get the indexes of the cells belonging to that image
-        sub_idx = df_tr[df_tr.reg_im_corename == imname].index.values
-        # get path to transformation file
-        animal_data_path = os.path.join(df_tr.attrs['datapath'],
-                                        df_tr.loc[sub_idx].AnimalID.unique()[0])
-        trans_file_path = gf.get_transformation_file_path(animal_data_path, imname)
-        # get the xs and ys values
-        xs_2d = list(df_tr.loc[sub_idx].x_coord_pre)
-        ys_2d = list(df_tr.loc[sub_idx].y_coord_pre)
-        # apply transformix
-        tr_2d = register_2D_to_2D_transformix(xs_2d, ys_2d, trans_file_path)
-
-        # get their positions in the 3D space
-        if tr_2d is not None:  # transformix was successful
-            xs_tr_2d = [i[0] for i in tr_2d]
-            ys_tr_2d = [i[1] for i in tr_2d]
-            # get the mobie position file
-            mobie_file_path = gf.get_mobie_file_path(animal_data_path, imname)
-            # apply 2D to 3D transformation
-            tr_3d = register_2D_to_3D_affine(xs_tr_2d, ys_tr_2d, resolution, mobie_file_path)
-            # update columns
-            df_tr.at[sub_idx, 'x_coord_post'] = [i[0] for i in tr_3d]
-            df_tr.at[sub_idx, 'y_coord_post'] = [i[1] for i in tr_3d]
-            df_tr.at[sub_idx, 'z_coord_post'] = [i[2] for i in tr_3d]
+    with instr.span('prereg_coordinates'):
+        df_tr = gf.get_prereg_coordinates(df, data_path)
+
+    # one job for each image
+    jobs = []
+    images = df_tr.groupby('reg_im_corename', sort=False, observed=True).indices
+    # positions are the rows of the cells belonging to each image
+    for imname, positions in images.items():
+        animal_data_path = os.path.join(data_path, df_tr.AnimalID.values[positions[0]])
+        jobs.append((positions,
+                     [imname, animal_data_path,
+                      df_tr.x_coord_pre.values[positions],
+                      df_tr.y_coord_pre.values[positions],
+                      resolution, point_engine, cache_dir, instr.is_tracing(),
+                      field_tolerance, registration_suffix]))
+
+    # transform the points of every image
+    with instr.span('transform_images', images=len(jobs)):
+        if pool is not None:
+            futures = [pool.submit(transform_image_points, *job_args) for _, job_args in jobs]
+            results = [future.result() for future in futures]
+        else:
+            results = [transform_image_points(*job_args) for _, job_args in jobs]
+    for result in results:
+        instr.merge_trace(result.pop('trace'))
+
+    # gather the results in three columns
+    coords_post = np.full((len(df_tr), 3), np.nan)
+    for (positions, _), result in zip(jobs, results):
+        if result['coords'] is not None:
+            coords_post[positions] = result['coords']
+        # the coordinates are already in the dataframe
+        result['coords'] = None
+    df_tr['x_coord_post'] = coords_post[:, 0]
+    df_tr['y_coord_post'] = coords_post[:, 1]
+    df_tr['z_coord_post'] = coords_post[:, 2]
 
     # create a new column with the indexes of the cells (for checking them if needed)
     df_tr['cell_index'] = df_tr.index.values
     # subselect dataframe
-    df_tr = df_tr[['x_coord_post', 'y_coord_post', 'z_coord_post', 'cell_label', 'cell_index']]
-    # save output as csv
-    outpath = os.path.dirname(path_to_dataframe)
-    fbasename = os.path.splitext(os.path.basename(path_to_dataframe))[0]
-    file_out_path = os.path.join(outpath, '_'.join([fbasename, 'ARA_coordinates.csv']))
-    df_tr.to_csv(file_out_path, index=False)
+    df_tr = df_tr[OUTPUT_COLUMNS]
+
+    return df_tr, results
+
+
+def transform_image_points(imname, animal_data_path, xs_2d, ys_2d, resolution, point_engine,
+                           cache_dir=None, tracing=False, field_tolerance=FIELD_TOLERANCE,
+                           registration_suffix='_reg_output'):
+    '''
+    Transforms the points of one registration image to the 3D atlas
+
+    param imname: registration image core name
+    param animal_data_path: path to the data of the animal
+    param xs_2d, ys_2d: arrays of x and y coordinates in the registration image
+    param cache_dir: folder of the disk cache of parsed files (needed in worker processes)
+    param tracing: whether the stages are being timed (needed in worker processes)
+    param field_tolerance: maximum error (in pixels) of the displacement field ('field' engine)
+    param registration_suffix: suffix of the folders with the elastix output
+    returns: dictionary with the name, wall time and error of the job, the
+        Nx3 array of coordinates in the ARA (None if it failed) and its trace
+    '''
+    print('Registering cells on {}'.format(imname))
+    start = time.perf_counter()
+    if cache_dir is not None:
+        gf.set_disk_cache(cache_dir)
+    register_2D_to_2D = {'transformix': register_2D_to_2D_transformix,
+                         'numpy': register_2D_to_2D_numpy,
+                         'field': lambda x, y, f: register_2D_to_2D_field(x, y, f, field_tolerance)
+                         }[point_engine]
+    coords = None
+    error = None
+    with instr.worker_trace(tracing) as trace, \
+            instr.span('transform_image', image=imname, points=len(xs_2d)):
+        try:
+            # get path to transformation file
+            trans_file_path = gf.get_transformation_file_path(animal_data_path, imname,
+                                                              registration_suffix)
+            # apply transformix
+            with instr.span('2D_to_2D', engine=point_engine):
+                tr_2d = register_2D_to_2D(list(xs_2d), list(ys_2d), trans_file_path)
+
+            # get their positions in the 3D space
+            if tr_2d is not None:  # transformix was successful
+                # get the mobie position file
+                mobie_file_path = gf.get_mobie_file_path(animal_data_path, imname)
+                # apply 2D to 3D transformation
+                with instr.span('2D_to_3D'):
+                    coords = register_2D_to_3D_affine_array(
+                        np.array(tr_2d, dtype='float64').reshape(-1, 2),
+                        resolution, mobie_file_path)
+            else:
+                error = 'no transformation file {}'.format(trans_file_path)
+        except Exception as e:
+            error = repr(e)
+
+    return {'name': imname,
+            'wall_time': time.perf_counter() - start,
+            'error': error,
+            'coords': coords,
+            'trace': trace}
 
 
 if __name__ == '__main__':
-    # check input
-    if len(sys.argv) not in [2, 3]:
-        sys.exit('Incorrect number of arguments, please run like this:\
+    parser = argparse.ArgumentParser(
+        description='Transform points to the ARA, e.g.\
             python points_transformation.py path_to_dataframe optional:resolution_of_ARA')
-    # catch input
-    inpath = sys.argv[1]
-    if len(sys.argv) == 3:
-        res = sys.argv[2]
-        # run function
-        points_to_ARA(path_to_dataframe=inpath, resolution=res)
-    else:
-        points_to_ARA(path_to_dataframe=inpath)
+    parser.add_argument('path_to_dataframe')
+    parser.add_argument('resolution', nargs='?', type=int, default=25,
+                        help='resolution of the ARA in um/px')
+    parser.add_argument('--engine', choices=['transformix', 'numpy', 'field'], default='transformix',
+                        help='how to evaluate the elastix transformations on the points')
+    parser.add_argument('--backend', choices=eb.BACKEND_NAMES, default=None,
+                        help='how transformix is run: the executable (local, the default), the\
+                            ITK-elastix python bindings (itk) or numpy, for tests (fake)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a transformix run is stopped')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='number of times a failed transformix run is repeated')
+    parser.add_argument('--field-tolerance', type=float, default=FIELD_TOLERANCE,
+                        help='maximum error (in pixels) of the displacement fields of --engine field,\
+                            slices above it are evaluated exactly (0 to always evaluate exactly)')
+    parser.add_argument('--registration-profile', choices=['default', 'fast'], default='default',
+                        help='use the registrations of this profile (fast: *_reg_output_fast)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of images to transform in parallel')
+    parser.add_argument('--executor', choices=['process', 'thread'], default='process',
+                        help='type of pool used for the parallel transformations')
+    parser.add_argument('--cache-dir', default=None,
+                        help='folder to keep parsed transformation files between runs')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='process the dataframe in chunks that fit in this many MB')
+    parser.add_argument('--data-path', default=None,
+                        help='path to the images, if it is not stored in the dataframe')
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'feather', 'npy'],
+                        default='csv', help='format of the file with the ARA coordinates')
+    parser.add_argument('--annotation', default=None,
+                        help='annotation volume of the ARA (.npy or raw .nrrd) to add the\
+                            region of each cell')
+    parser.add_argument('--structures', default=None,
+                        help='table of brain structures (.csv) to add the region acronyms')
+    parser.add_argument('--rollup-depth', type=int, action='append', default=[],
+                        help='add the region at this level of the hierarchy of structures\
+                            (can be repeated)')
+    parser.add_argument('--trace', default=None,
+                        help='json file where the time of each stage is saved')
+    parser.add_argument('--chrome-trace', action='store_true',
+                        help='save the trace in the Chrome trace event format')
+    parser.add_argument('--profile', default=None,
+                        help='file where the cProfile statistics are saved')
+    args = parser.parse_args()
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 1e6)
+
+    if args.trace is not None:
+        instr.enable_tracing()
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    eb.set_default_backend(args.backend, args.timeout, args.retries)
+    points_to_ARA(path_to_dataframe=args.path_to_dataframe, resolution=args.resolution,
+                  point_engine=args.engine, n_workers=args.workers, executor=args.executor,
+                  cache_dir=args.cache_dir, memory_budget=memory_budget,
+                  data_path=args.data_path, output_format=args.output_format,
+                  field_tolerance=args.field_tolerance,
+                  registration_suffix={'default': '_reg_output',
+                                       'fast': '_reg_output_fast'}[args.registration_profile],
+                  annotation_path=args.annotation, structures_path=args.structures,
+                  rollup_depths=args.rollup_depth)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.trace is not None:
+        instr.write_trace(args.trace, chrome=args.chrome_trace)
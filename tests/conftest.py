@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the modules of the repository as the scripts do
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# Writes the transformation files in tests/data/elastix_chain (an affine transformation
+# and a B-spline transformation on it, like the ones of registration_parameters) and
+# transforms inputpoints.txt with transformix (ITK-elastix, pip install itk-elastix) to
+# make outputpoints.txt, the reference of tests/test_elastix_transform.py
+# e.g. python tests/data/make_transformix_reference.py
+
+import os
+import numpy as np
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'elastix_chain')
+IMAGE_SIZE = (60, 40)
+# the affine transformation has exact binary fractions, so that the points mapped to the
+# region where the B-spline displacement is 0 land exactly on .5
+AFFINE = [1.25, 0.25, 0, 0.75, -28.5, -15.25]
+CENTER = (30, 20)
+GRID_SPACING = 16
+GRID_ORIGIN = -24
+GRID_SIZE = (7, 6)
+# control points without displacement (their support is x, y in [-8, 8))
+ZERO_CONTROL_POINTS = 4
+
+
+def write_transformation_files(rng):
+    geometry = '\n'.join(['(FixedImageDimension 2)', '(MovingImageDimension 2)',
+                          '(Size {} {})'.format(*IMAGE_SIZE), '(Index 0 0)',
+                          '(Spacing 1.0000000000 1.0000000000)',
+                          '(Origin 0.0000000000 0.0000000000)',
+                          '(Direction 1.0000000000 0.0000000000 0.0000000000 1.0000000000)',
+                          '(UseDirectionCosines "true")', '(HowToCombineTransforms "Compose")',
+                          '(ResampleInterpolator "FinalBSplineInterpolator")',
+                          '(FinalBSplineInterpolationOrder 3)',
+                          '(Resampler "DefaultResampler")', '(DefaultPixelValue 0)',
+                          '(ResultImageFormat "tiff")', '(ResultImagePixelType "float")',
+                          '(FixedInternalImagePixelType "float")',
+                          '(MovingInternalImagePixelType "float")', ''])
+    with open(os.path.join(DATA_PATH, 'TransformParameters.0.txt'), 'w') as f:
+        f.write('(Transform "AffineTransform")\n(NumberOfParameters 6)\n')
+        f.write('(TransformParameters {})\n'.format(' '.join(repr(float(v)) for v in AFFINE)))
+        f.write('(InitialTransformParametersFileName "NoInitialTransform")\n')
+        f.write('(CenterOfRotationPoint {} {})\n'.format(*(float(c) for c in CENTER)))
+        f.write(geometry)
+
+    coefficients = np.round(rng.normal(0, 2, (2, GRID_SIZE[1], GRID_SIZE[0])), 4)
+    coefficients[:, :ZERO_CONTROL_POINTS, :ZERO_CONTROL_POINTS] = 0
+    with open(os.path.join(DATA_PATH, 'TransformParameters.1.txt'), 'w') as f:
+        f.write('(Transform "BSplineTransform")\n(NumberOfParameters {})\n'.format(
+            coefficients.size))
+        f.write('(TransformParameters {})\n'.format(' '.join(repr(float(v))
+                                                             for v in coefficients.ravel())))
+        f.write('(InitialTransformParametersFileName "TransformParameters.0.txt")\n')
+        f.write('(GridSize {} {})\n(GridIndex 0 0)\n'.format(*GRID_SIZE))
+        f.write('(GridSpacing {0} {0})\n(GridOrigin {1} {1})\n'.format(float(GRID_SPACING),
+                                                                        float(GRID_ORIGIN)))
+        f.write('(GridDirection 1 0 0 1)\n(BSplineTransformSplineOrder 3)\n')
+        f.write('(UseCyclicTransform "false")\n')
+        f.write(geometry)
+
+
+def make_points(rng):
+    # inside the image
+    inside = rng.uniform([0, 0], IMAGE_SIZE, (40, 2))
+    # around the border of the image and of the B-spline grid
+    border = np.array([[x, y] for x in [-12, -0.5, 0, 59, 59.5, 72] for y in [-6, 0, 39.5, 52]],
+                      dtype='float64')
+    # mapped by the affine transformation to .5 in the region without displacement
+    matrix = np.array(AFFINE[:4]).reshape(2, 2)
+    candidates = np.array([[x, y] for x in np.arange(-10, 60, 0.5)
+                           for y in np.arange(-10, 50, 0.5)])
+    mapped = (candidates - CENTER) @ matrix.T + CENTER + AFFINE[4:]
+    halves = np.any(mapped % 1 == 0.5, axis=1) & np.all((mapped >= -8) & (mapped < 8), axis=1)
+
+    return np.vstack([inside, border, candidates[halves][::12]])
+
+
+def run_transformix(points):
+    import itk
+    with open(os.path.join(DATA_PATH, 'inputpoints.txt'), 'w') as f:
+        f.write('point\n{}\n'.format(len(points)))
+        np.savetxt(f, points, fmt='%.17g')
+    parameter_object = itk.ParameterObject.New()
+    for name in ['TransformParameters.0.txt', 'TransformParameters.1.txt']:
+        parameter_object.AddParameterFile(os.path.join(DATA_PATH, name))
+    moving_image = itk.image_from_array(np.zeros((IMAGE_SIZE[1], IMAGE_SIZE[0]), dtype='float32'))
+    itk.transformix_pointset(moving_image, parameter_object,
+                             fixed_point_set_file_name=os.path.join(DATA_PATH, 'inputpoints.txt'),
+                             output_directory=DATA_PATH, log_to_console=False)
+
+
+if __name__ == '__main__':
+    if not os.path.exists(DATA_PATH):
+        os.makedirs(DATA_PATH)
+    rng = np.random.default_rng(2)
+    write_transformation_files(rng)
+    run_transformix(make_points(rng))
@@ -0,0 +1,29 @@
+import os
+import shutil
+import threading
+import numpy as np
+from functions import displacement_field as dfield
+from functions import elastix_transform as et
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'elastix_chain')
+
+
+def test_field_made_by_several_threads(tmp_path):
+    for name in ['TransformParameters.0.txt', 'TransformParameters.1.txt']:
+        shutil.copy(os.path.join(DATA_PATH, name), str(tmp_path))
+    transformation_file = str(tmp_path / 'TransformParameters.1.txt')
+    threads = [threading.Thread(target=dfield.make_displacement_field,
+                                args=(transformation_file,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not any(name.endswith('.tmp') or name.endswith('.tmp.npy')
+                   for name in os.listdir(str(tmp_path)))
+    field, info = dfield.load_displacement_field(transformation_file)
+    assert field.dtype == np.dtype(dfield.FIELD_DTYPE)
+    points = np.random.default_rng(0).uniform(0, 40, size=(200, 2))
+    transformed, _ = dfield.transform_points_with_field(points, transformation_file, np.inf)
+    exact = et.transform_points(points, transformation_file)
+    assert np.max(np.linalg.norm(transformed - exact, axis=1)) <= info['max_error'] + 1e-6
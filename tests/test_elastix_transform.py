@@ -0,0 +1,58 @@
+import os
+import numpy as np
+from functions import elastix_transform as et
+
+# transformation files of an elastix registration (affine and B-spline) and the output of
+# transformix for inputpoints.txt (see tests/data/make_transformix_reference.py)
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'elastix_chain')
+TRANSFORMATION_FILE = os.path.join(DATA_PATH, 'TransformParameters.1.txt')
+OUTPUT_POINTS_FILE = os.path.join(DATA_PATH, 'outputpoints.txt')
+# transformix writes the points with 6 decimals
+TOLERANCE = 1e-6
+
+
+def read_input_points():
+    return np.loadtxt(os.path.join(DATA_PATH, 'inputpoints.txt'), skiprows=2)
+
+
+def test_transform_points_matches_transformix():
+    reference = et.read_transformix_output_points(OUTPUT_POINTS_FILE, 'OutputPoint')
+
+    transformed = et.transform_points(read_input_points(), TRANSFORMATION_FILE)
+
+    np.testing.assert_allclose(transformed, reference, atol=TOLERANCE)
+
+
+def test_fixed_index_matches_transformix():
+    reference = et.read_transformix_output_points(OUTPUT_POINTS_FILE, 'OutputIndexFixed')
+    chain = et.load_transform_chain(TRANSFORMATION_FILE)
+
+    index = et.points_to_fixed_index(et.transform_points_with_chain(read_input_points(), chain),
+                                     chain[-1])
+
+    np.testing.assert_array_equal(index, reference)
+
+
+def test_border_points_match_transformix():
+    # points on and beyond the border of the image, some outside the B-spline grid
+    points = read_input_points()
+    size = np.array([60, 40])
+    border = np.any((points <= 0) | (points >= size - 1), axis=1)
+    reference = et.read_transformix_output_points(OUTPUT_POINTS_FILE, 'OutputPoint')
+    assert np.sum(border) >= 20
+
+    transformed = et.transform_points(points[border], TRANSFORMATION_FILE)
+
+    np.testing.assert_allclose(transformed, reference[border], atol=TOLERANCE)
+
+
+def test_points_on_half_pixels_round_as_transformix():
+    chain = et.load_transform_chain(TRANSFORMATION_FILE)
+    transformed = et.transform_points_with_chain(read_input_points(), chain)
+    halves = np.any(transformed % 1 == 0.5, axis=1)
+    reference = et.read_transformix_output_points(OUTPUT_POINTS_FILE, 'OutputIndexFixed')
+    assert np.sum(halves) >= 10
+
+    index = et.points_to_fixed_index(transformed[halves], chain[-1])
+
+    np.testing.assert_array_equal(index, reference[halves])
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pytest
+import tifffile
+from folder_register_ARA_to_histology import folder_register, FAILED_LOG_NAME
+from functions import execution_backends as eb
+from functions.register_2D_to_2D import run_transformix_on_points
+
+
+def make_registration_folder(folder_path, histology_shape=(40, 60)):
+    # histology and ARA screenshot of one slice (s1), the screenshot at half the size
+    ys, xs = np.mgrid[:histology_shape[0], :histology_shape[1]]
+    tifffile.imwrite(str(folder_path / 's1.tif'), ((xs + 2 * ys) % 200 + 1).astype('uint8'))
+    tifffile.imwrite(str(folder_path / 's1_ARA.tif'),
+                     ((xs[::2, ::2] + 2 * ys[::2, ::2]) % 200 + 1).astype('uint8'))
+    return str(folder_path / 's1_reg_output')
+
+
+def read_outputs(outdir_path):
+    return {name: open(os.path.join(outdir_path, name), 'rb').read()
+            for name in ['TransformParameters.0.txt', 'TransformParameters.1.txt']}
+
+
+def test_fake_registration(tmp_path):
+    outdir_path = make_registration_folder(tmp_path)
+    results = folder_register(str(tmp_path), backend=eb.make_backend('fake'))
+
+    assert [r['error'] for r in results] == [None]
+    assert results[0]['log_path'] == os.path.join(outdir_path, eb.LOG_NAMES['elastix'])
+    assert os.path.isfile(results[0]['log_path'])
+    assert os.path.isfile(os.path.join(outdir_path, 'result.1.tiff'))
+    assert os.path.isfile(tmp_path / 'registration_metrics.csv')
+    # nothing is left next to the output folder
+    assert sorted(os.listdir(tmp_path)) == ['registration_metrics.csv', 's1.tif',
+                                            's1_ARA.tif', 's1_reg_output']
+    # and it is up to date
+    assert folder_register(str(tmp_path), backend=eb.make_backend('fake')) == []
+
+
+def test_timeout_is_retried_and_keeps_results(tmp_path, monkeypatch):
+    outdir_path = make_registration_folder(tmp_path)
+    folder_register(str(tmp_path), backend=eb.make_backend('fake'))
+    outputs = read_outputs(outdir_path)
+    # the images change, and the new registration times out
+    make_registration_folder(tmp_path, (44, 60))
+    monkeypatch.setenv(eb.FAKE_SECONDS_ENVIRONMENT_VARIABLE, '0.2')
+    backend = eb.make_backend('fake', timeout=0.05, retries=1)
+    results = folder_register(str(tmp_path), backend=backend)
+
+    assert 'timed out' in results[0]['error']
+    assert results[0]['attempts'] == 2
+    assert read_outputs(outdir_path) == outputs
+    assert results[0]['log_path'] == os.path.join(outdir_path, FAILED_LOG_NAME)
+    with open(results[0]['log_path']) as f:
+        assert 'timed out' in f.read()
+
+
+def test_failed_registration_keeps_the_log(tmp_path):
+    outdir_path = make_registration_folder(tmp_path)
+    # the fake backend only registers 2D images
+    tifffile.imwrite(str(tmp_path / 's1.tif'), np.ones((3, 40, 60), dtype='uint8'),
+                     photometric='minisblack')
+    results = folder_register(str(tmp_path), backend=eb.make_backend('fake', retries=2))
+
+    assert results[0]['returncode'] == 1
+    assert results[0]['attempts'] == 3
+    assert results[0]['metrics'] is None
+    assert not os.path.exists(os.path.join(outdir_path, 'result.1.tiff'))
+    with open(os.path.join(outdir_path, FAILED_LOG_NAME)) as f:
+        assert 'only registers 2D images' in f.read()
+
+
+def test_failed_transformix_keeps_the_log(tmp_path, monkeypatch):
+    make_registration_folder(tmp_path)
+    folder_register(str(tmp_path), backend=eb.make_backend('fake'))
+    transformation_file = str(tmp_path / 's1_reg_output' / 'TransformParameters.1.txt')
+    points = np.array([[10.0, 12.0], [30.0, 20.0]])
+    indexes = run_transformix_on_points(points, transformation_file, str(tmp_path),
+                                        backend=eb.make_backend('fake'))
+    assert np.array_equal(indexes, [[5, 6], [15, 10]])
+
+    monkeypatch.setenv(eb.FAKE_SECONDS_ENVIRONMENT_VARIABLE, '0.2')
+    with pytest.raises(RuntimeError, match='timed out') as error:
+        run_transformix_on_points(points, transformation_file, str(tmp_path),
+                                  backend=eb.make_backend('fake', timeout=0.05))
+    log_path = str(error.value).rsplit('(log in ', 1)[1].rstrip(')')
+    assert os.path.dirname(log_path) == str(tmp_path)
+    with open(log_path) as f:
+        assert 'timed out' in f.read()
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+from functions import general_functions as gf
+
+
+def make_cells(slices):
+    df = pd.DataFrame({'AnimalID': 'PH301', 'ExperimentalCondition': 'A2A-Ai14',
+                       'Slide': 1, 'Slice': slices, 'Center_X': np.arange(len(slices))})
+    df.attrs = {'datapath': '/data'}
+    return df
+
+
+def test_images_are_not_split_between_chunks():
+    df = make_cells([0, 0, 0, 1, 1, 1, 1, 2, 2, 3])
+    chunks = [df.iloc[start:start + 4] for start in range(0, len(df), 4)]
+    columns = ['AnimalID', 'ExperimentalCondition', 'Slide', 'Slice']
+    kept = list(gf.keep_groups_together(chunks, columns))
+
+    assert pd.concat(kept).equals(df)
+    for i, chunk in enumerate(kept):
+        assert chunk.attrs == df.attrs
+        for other in kept[i + 1:]:
+            assert not set(chunk.Slice) & set(other.Slice)
+
+
+def test_image_larger_than_a_chunk():
+    df = make_cells([0] * 7 + [1])
+    chunks = [df.iloc[start:start + 3] for start in range(0, len(df), 3)]
+    kept = list(gf.keep_groups_together(chunks, ['Slice']))
+
+    assert [list(chunk.Slice.unique()) for chunk in kept] == [[0], [1]]
+    assert pd.concat(kept).equals(df)
+
+
+def make_analysis_frame():
+    # cells of two animals, with negative positions to check the truncation towards 0
+    df = pd.DataFrame({'AnimalID': ['PH301'] * 4 + ['PH302'] * 3,
+                       'ExperimentalCondition': 'A2A-Ai14',
+                       'Slide': ['1', '1', '2', '2', '1', '1', '1'],
+                       'Slice': ['0', '0', '3', '3', '10', '10', '10'],
+                       'Side': ['L', 'L', 'R', 'R', 'L', 'L', 'L'],
+                       'AP': 'Tail',
+                       'ROI': [1, 2, 1, 1, 7, 7, 8],
+                       'Center_X': [10.7, -40.2, 0.5, 33.3, 5.0, 12.9, -8.1],
+                       'Center_Y': [3.2, 7.9, -55.5, 0.1, 2.2, 18.6, 4.4]},
+                      index=[10, 11, 12, 13, 20, 21, 22])
+    df['manual_roi_name'] = [gf.make_core_name_from_series(row) for _, row in df.iterrows()]
+    return df
+
+
+def write_roi_files(df, data_path):
+    for roiname, rois in df.groupby('manual_roi_name').ROI:
+        rois_dir = os.path.join(data_path, roiname.split('_')[0], 'ROIs', '000_ManualROIs_info')
+        os.makedirs(rois_dir, exist_ok=True)
+        with open(os.path.join(rois_dir, roiname + '_roi_positions.txt'), 'w') as f:
+            f.write('roiID, high_res_x_pos, high_res_y_pos, registration_image_pixel_size, '
+                    'high_res_pixel_size\n')
+            for roi in sorted(set(rois)):
+                f.write('{}, {}, {}, 4.6, 0.7\n'.format(roi, 20 * roi - 30, 3 * roi))
+
+
+def old_prereg_coordinates(df, data_path):
+    # row by row version of get_prereg_coordinates (before the roi table)
+    df = df.copy()
+    df['x_coord_pre'] = np.nan
+    df['y_coord_pre'] = np.nan
+    for roiname in df.manual_roi_name.unique():
+        sub_idx = df[df.manual_roi_name == roiname].index.values
+        roi_df = gf.create_dataframe_from_roi_file(
+            gf.get_manual_rois_file_path(df.loc[sub_idx], data_path))
+        for index, row in df.loc[sub_idx].iterrows():
+            roi = roi_df[roi_df.roiID == str(row.ROI)].iloc[0]
+            hr_x = int(roi.high_res_x_pos) + float(row.Center_X)
+            hr_y = int(roi.high_res_y_pos) + float(row.Center_Y)
+            reg_im_res = float(roi.registration_image_pixel_size)
+            coords_res = float(roi.high_res_pixel_size)
+            df.at[index, 'x_coord_pre'] = int(hr_x * coords_res / reg_im_res)
+            df.at[index, 'y_coord_pre'] = int(hr_y * coords_res / reg_im_res)
+    return df
+
+
+def test_core_names_match_the_row_by_row_names():
+    df = make_analysis_frame()
+    reg_names = [gf.make_reg_core_name_from_series(row) for _, row in df.iterrows()]
+    assert list(gf.make_reg_core_names(df)) == reg_names
+    assert list(gf.make_core_names(df)) == list(df.manual_roi_name)
+
+    # numbers, and columns with numbers and strings, give the same names as strings
+    mixed = df.copy()
+    mixed['Slide'] = df.Slide.astype(int)
+    mixed['Slice'] = [int(s) if i % 2 else s for i, s in enumerate(df.Slice)]
+    assert list(gf.make_reg_core_names(mixed)) == reg_names
+    assert list(gf.make_core_names(mixed)) == list(df.manual_roi_name)
+
+
+def test_prereg_coordinates_match_the_row_by_row_version(tmp_path):
+    df = make_analysis_frame()
+    write_roi_files(df, str(tmp_path))
+    expected = old_prereg_coordinates(df, str(tmp_path))
+    result = gf.get_prereg_coordinates(df.copy(), str(tmp_path))
+
+    assert np.any(expected.x_coord_pre < 0) and np.any(expected.y_coord_pre < 0)
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+from functions import elastix_transform as et
+from functions import inverse_mapping as im
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'elastix_chain')
+
+SLICE_SPACING = 100
+
+
+def make_view_matrices(n_slices, flipped):
+    '''
+    MoBIE view matrices (atlas in um to view) of slices along z, SLICE_SPACING um apart.
+    The views of the flipped slices face the other side (rotated 180 degrees about y)
+    '''
+    matrices = []
+    for i in range(n_slices):
+        matrix = np.eye(4)
+        matrix[:3, 3] = [-20, -30, -SLICE_SPACING * i]
+        if flipped[i]:
+            matrix[0] *= -1
+            matrix[2] *= -1
+        matrices.append(matrix)
+
+    return np.array(matrices)
+
+
+def test_closest_planes_with_mixed_orientations():
+    n_slices = 10
+    flipped = np.arange(n_slices) % 2 == 1
+    matrices = make_view_matrices(n_slices, flipped)
+    # points 10 um after each slice
+    points = np.column_stack([np.full(n_slices, 500.), np.full(n_slices, 300.),
+                              SLICE_SPACING * np.arange(n_slices) + 10.])
+
+    closest, distance = im.find_closest_planes(points, matrices, im.make_plane_index(matrices))
+
+    np.testing.assert_array_equal(closest, np.arange(n_slices))
+    np.testing.assert_allclose(distance, 10)
+
+
+def test_plane_offsets_are_sorted_with_mixed_orientations():
+    n_slices = 6
+    matrices = make_view_matrices(n_slices, [False, True, True, False, True, False])
+    index = im.make_plane_index(matrices)
+
+    np.testing.assert_allclose(np.abs(index['offsets']), SLICE_SPACING * np.arange(n_slices))
+    np.testing.assert_array_equal(np.sort(index['order']), np.arange(n_slices))
+
+
+def test_points_that_converge_in_the_last_iteration():
+    chain = et.load_transform_chain(os.path.join(DATA_PATH, 'TransformParameters.1.txt'))
+    targets = et.transform_points_with_chain(
+        np.random.default_rng(0).uniform(0, 40, size=(100, 2)), chain)
+    for max_iterations in range(4):
+        points, converged = im.invert_transform_chain(targets, chain,
+                                                      max_iterations=max_iterations)
+        error = np.linalg.norm(et.transform_points_with_chain(points, chain) - targets, axis=1)
+        np.testing.assert_array_equal(converged, error < im.INVERSION_TOLERANCE)
+    assert np.all(converged)
+
+
+def test_points_where_the_transformation_folds(monkeypatch):
+    # transformation with no inverse for y < 0 (all the points are mapped to y = 0)
+    monkeypatch.setattr(et, 'transform_points_with_chain',
+                        lambda points, chain: np.column_stack([points[:, 0],
+                                                               np.maximum(points[:, 1], 0)]))
+    targets = np.array([[5., 3.], [5., -1.], [2., 1.]])
+    points, converged = im.invert_transform_chain(targets, [])
+
+    np.testing.assert_array_equal(converged, [True, False, True])
+    np.testing.assert_allclose(points[converged], targets[converged])
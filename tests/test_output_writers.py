@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from functions.output_writers import get_output_writer
+
+
+def make_chunks():
+    chunks = []
+    for start, labels in [(0, ['tdTomato', 'GFP', 'tdTomato']), (3, ['double', 'GFP'])]:
+        n = len(labels)
+        chunks.append(pd.DataFrame({'x_coord_post': np.arange(n) + 0.5 + start,
+                                    'y_coord_post': np.arange(n) * 2.0,
+                                    'z_coord_post': np.full(n, 100.25),
+                                    'cell_label': labels,
+                                    'cell_index': np.arange(start, start + n)}))
+    return chunks
+
+
+def write_chunks(output_format, tmp_path, chunks):
+    writer = get_output_writer(output_format, str(tmp_path / 'cells'))
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return writer.path
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'feather'])
+def test_arrow_formats_have_categorical_labels(output_format, tmp_path):
+    pytest.importorskip('pyarrow')
+    chunks = make_chunks()
+    path = write_chunks(output_format, tmp_path, chunks)
+    df = pd.read_parquet(path) if output_format == 'parquet' else pd.read_feather(path)
+    expected = pd.concat(chunks, ignore_index=True)
+
+    assert isinstance(df.cell_label.dtype, pd.CategoricalDtype)
+    assert list(df.cell_label) == list(expected.cell_label)
+    assert df.x_coord_post.dtype == np.float32
+    np.testing.assert_array_equal(df.x_coord_post, expected.x_coord_post)
+    np.testing.assert_array_equal(df.cell_index, expected.cell_index)
+
+
+def test_npy_bundle(tmp_path):
+    chunks = make_chunks()
+    path = write_chunks('npy', tmp_path, chunks)
+    expected = pd.concat(chunks, ignore_index=True)
+
+    coords = np.load(os.path.join(path, 'coords.npy'), mmap_mode='r')
+    np.testing.assert_array_equal(coords, expected[['x_coord_post', 'y_coord_post',
+                                                    'z_coord_post']].values)
+    codes = np.load(os.path.join(path, 'cell_label_codes.npy'))
+    categories = np.load(os.path.join(path, 'cell_label_categories.npy'))
+    assert list(categories[codes]) == list(expected.cell_label)
+    np.testing.assert_array_equal(np.load(os.path.join(path, 'cell_index.npy')),
+                                  expected.cell_index)
+
+
+def test_npy_bundle_does_not_truncate_later_chunks(tmp_path):
+    chunks = make_chunks()
+    chunks[0]['region'] = np.array([1, 2, 3])
+    chunks[1]['region'] = np.array([4.5, np.nan])
+    with pytest.raises(ValueError, match='region'):
+        write_chunks('npy', tmp_path, chunks)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from functions import registration_metrics as rm
+
+
+def make_table(ncc_default, ncc_fast):
+    rows = []
+    for suffix, values in [('_reg_output', ncc_default), ('_reg_output_fast', ncc_fast)]:
+        for i, ncc in enumerate(values):
+            name = 'slice-{}'.format(i)
+            rows.append({'slice': name, 'output_folder': name + suffix,
+                         'mutual_information': np.nan, 'ncc': ncc,
+                         'jacobian_negative_fraction': 0.0})
+    return pd.DataFrame(rows)
+
+
+def test_outliers_are_flagged_within_each_profile():
+    # the fast profile is worse for every slice, but only slice-3 is an outlier
+    ncc_default = [0.90, 0.91, 0.89, 0.90, 0.92, 0.88]
+    ncc_fast = [0.70, 0.71, 0.69, 0.40, 0.72, 0.68]
+    table = rm.flag_outliers(make_table(ncc_default, ncc_fast))
+
+    flagged = table[table.outlier]
+    assert list(zip(flagged.slice, flagged.output_folder)) == \
+        [('slice-3', 'slice-3_reg_output_fast')]
+
+
+def test_folding_transformations_are_outliers():
+    table = make_table([0.9, 0.9, 0.9], [0.7, 0.7, 0.7])
+    table.loc[1, 'jacobian_negative_fraction'] = 0.01
+    table = rm.flag_outliers(table)
+
+    assert list(table.outlier) == [False, True, False, False, False, False]
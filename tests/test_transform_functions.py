@@ -0,0 +1,84 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from functions import transform_functions as tf
+
+
+def parse_numbers(filepath):
+    return {'numbers': np.loadtxt(filepath, ndmin=1)}
+
+
+def test_disk_cache_only_evicts_its_files(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    other_file = cache_dir / 'points_histology.npz'
+    np.savez(other_file, numbers=np.zeros(3))
+    os.utime(other_file, (0, 0))
+    tf.set_disk_cache(str(cache_dir), max_entries=2)
+    try:
+        for i in range(4):
+            text_file = tmp_path / 'numbers_{}.txt'.format(i)
+            text_file.write_text('{} {}'.format(i, i + 1))
+            value = tf.cached_parse(str(text_file), parse_numbers, 'numbers')
+            assert np.array_equal(value['numbers'], [i, i + 1])
+    finally:
+        tf.set_disk_cache(None)
+
+    assert other_file.exists()
+    cache_files = [name for name in os.listdir(cache_dir) if name != other_file.name]
+    assert len(cache_files) == 2
+    assert all(name.startswith(tf.DISK_CACHE_PREFIX) for name in cache_files)
+
+
+def test_broken_disk_cache_files_are_parsed_again(tmp_path, monkeypatch):
+    text_file = tmp_path / 'numbers.txt'
+    text_file.write_text('1 2')
+    cache_dir = tmp_path / 'cache'
+    tf.set_disk_cache(str(cache_dir))
+    try:
+        tf.cached_parse(str(text_file), parse_numbers, 'numbers')
+        cache_file, = cache_dir.iterdir()
+        for broken in [cache_file.read_bytes()[:40], b'']:
+            cache_file.write_bytes(broken)
+            monkeypatch.setattr(tf, '_parsed_files_cache', OrderedDict())
+            value = tf.cached_parse(str(text_file), parse_numbers, 'numbers')
+            assert np.array_equal(value['numbers'], [1, 2])
+            with np.load(str(cache_file)) as data:
+                assert np.array_equal(data['numbers'], [1, 2])
+    finally:
+        tf.set_disk_cache(None)
+
+
+def test_cache_is_shared_between_threads(tmp_path, monkeypatch):
+    # fewer entries than files, so the threads keep evicting each other's files
+    monkeypatch.setattr(tf, '_parsed_files_cache', OrderedDict())
+    monkeypatch.setattr(tf, 'PARSED_FILES_CACHE_SIZE', 2)
+    text_files = []
+    for i in range(6):
+        text_file = tmp_path / 'numbers_{}.txt'.format(i)
+        text_file.write_text('{} {}'.format(i, i + 1))
+        text_files.append(str(text_file))
+    tf.set_disk_cache(str(tmp_path / 'cache'), max_entries=3)
+    errors = []
+
+    def parse_files(offset):
+        try:
+            for n in range(200):
+                i = (n + offset) % len(text_files)
+                value = tf.cached_parse(text_files[i], parse_numbers, 'numbers')
+                assert np.array_equal(value['numbers'], [i, i + 1])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=parse_files, args=(offset,)) for offset in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        tf.set_disk_cache(None)
+
+    assert errors == []
+    assert len(tf._parsed_files_cache) <= 2